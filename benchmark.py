@@ -0,0 +1,374 @@
+import os
+import math
+import random
+import torch
+import numpy as np
+import time
+import argparse
+from PIL import Image
+from model.fcos import FCOSDetector
+from model.mlfpn import build_net
+from model.cc import model as m2det_model
+from model.config import DefaultConfig
+from model.export import export_torchscript
+from dataset.VOC_dataset import VOCDataset
+from dataset.augment import _rotate_boxes
+from dataset.sampler import GroupedBatchSampler, aspect_ratio_groups, padding_ratio
+from eval_voc import iou_2d, _compute_ap, eval_ap_2d, eval_ap_2d_parallel, eval_coco_2d, sort_by_score
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--bench", type = str, default = "startup", choices = ["startup", "padding", "ap", "rotate", "export", "onnx"], help = "which benchmark to run")
+parser.add_argument("--root_dir", type = str, default = './data/VOCdevkit/VOC2007', help = "VOC root directory for the padding benchmark")
+parser.add_argument("--split", type = str, default = 'trainval', help = "image set for the padding benchmark")
+parser.add_argument("--num_imgs", type = int, default = 500, help = "number of synthetic images for the ap benchmark")
+parser.add_argument("--dets_per_img", type = int, default = 100, help = "detections per image for the ap benchmark")
+parser.add_argument("--num_workers", type = int, default = 8, help = "processes of the parallel ap evaluator")
+parser.add_argument("--height", type = int, default = 512, help = "height of the padded input image")
+parser.add_argument("--width", type = int, default = 512, help = "width of the padded input image")
+parser.add_argument("--batch_size", type = int, default = 1, help = "number of images per forward pass")
+parser.add_argument("--iters", type = int, default = 20, help = "number of timed steady-state iterations")
+parser.add_argument("--warmup", type = int, default = 3, help = "number of untimed warmup iterations")
+parser.add_argument("--device", type = str, default = "cuda" if torch.cuda.is_available() else "cpu", help = "device to run the benchmark on")
+
+def _sync(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def _timeit(fn, iters, device = 'cpu'):
+    times = []
+    for _ in range(iters):
+        _sync(device)
+        start_t = time.time()
+        fn()
+        _sync(device)
+        times.append(1000*(time.time()-start_t))
+    return np.array(times)
+
+def bench_startup_vs_steady(height, width, batch_size, iters, warmup, device):
+    '''
+    Compare the one-off cost of building the detector (and of building the
+    MLFPN neck on its own, which used to happen on every forward call) with
+    the steady-state latency of an inference forward pass.
+    '''
+    class Config(DefaultConfig):
+        pretrained = False
+
+    start_t = time.time()
+    detector = FCOSDetector(mode = "inference", config = Config, device = device).eval()
+    _sync(device)
+    startup_ms = 1000*(time.time()-start_t)
+
+    neck_ms = _timeit(lambda: build_net('train', size = 320, config = m2det_model['m2det_config']).to(device), 3, device)
+
+    imgs = torch.randn(batch_size, 3, height, width, device = device)
+
+    def step():
+        with torch.no_grad():
+            detector(imgs)
+
+    first_ms = _timeit(step, 1, device)[0]
+    _timeit(step, warmup, device)
+    steady_ms = _timeit(step, iters, device)
+
+    print("===>detector construction      : %.2f ms"%startup_ms)
+    print("===>MLFPN neck construction    : %.2f ms (previously paid on every forward)"%np.median(neck_ms))
+    print("===>first forward              : %.2f ms"%first_ms)
+    print("===>steady-state forward p50   : %.2f ms"%np.percentile(steady_ms, 50))
+    print("===>steady-state forward p99   : %.2f ms"%np.percentile(steady_ms, 99))
+    print("===>old per-forward estimate   : %.2f ms"%(np.percentile(steady_ms, 50) + np.median(neck_ms)))
+
+def bench_export(height, width, batch_size, iters, warmup, device):
+    '''
+    Eager FCOSDetector against the TorchScript graph of model/export.py: time to a first
+    result from a fresh process (construction/load + first forward) and steady-state latency.
+    '''
+    import io
+    class Config(DefaultConfig):
+        pretrained = False
+
+    start_t = time.time()
+    detector = FCOSDetector(mode = "inference", config = Config, device = device).eval()
+    imgs = torch.randn(batch_size, 3, height, width, device = device)
+    with torch.no_grad():
+        eager_out = detector(imgs)
+    _sync(device)
+    eager_startup_ms = 1000*(time.time()-start_t)
+
+    buffer = io.BytesIO()
+    torch.jit.save(export_torchscript(detector, example_size = (height, width)), buffer)
+    buffer.seek(0)
+    start_t = time.time()
+    exported = torch.jit.load(buffer, map_location = device)
+    with torch.no_grad():
+        exported_out = exported(imgs)
+    _sync(device)
+    exported_startup_ms = 1000*(time.time()-start_t)
+    assert all(torch.equal(a, b) for a, b in zip(eager_out, exported_out)), "===>exported outputs differ from eager"
+
+    results = {}
+    for name, fn in [("eager", detector), ("torchscript", exported)]:
+        def step():
+            with torch.no_grad():
+                fn(imgs)
+        _timeit(step, warmup, device)
+        results[name] = _timeit(step, iters, device)
+
+    print("===>outputs identical          : True")
+    print("===>eager build + first fwd    : %.2f ms"%eager_startup_ms)
+    print("===>script load + first fwd    : %.2f ms"%exported_startup_ms)
+    for name, times in results.items():
+        print("===>%-12s forward p50/p99 : %.2f / %.2f ms"%(name, np.percentile(times, 50), np.percentile(times, 99)))
+
+def bench_onnx(height, width, batch_size, iters, warmup):
+    '''
+    Eager FCOSDetector against OnnxDetector (ONNX Runtime body + NumPy decode/nms) on the CPU
+    '''
+    import os
+    import tempfile
+    from model.onnx_backend import export_onnx, OnnxDetector
+    class Config(DefaultConfig):
+        pretrained = False
+
+    detector = FCOSDetector(mode = "inference", config = Config).eval()
+    path = os.path.join(tempfile.mkdtemp(), "fcos.onnx")
+    export_onnx(detector, path, example_size = (height, width))
+    onnx_detector = OnnxDetector(path, Config, num_threads = torch.get_num_threads())
+    imgs = torch.randn(batch_size, 3, height, width)
+
+    results = {}
+    for name, fn in [("eager", detector), ("onnxruntime", onnx_detector)]:
+        def step():
+            with torch.no_grad():
+                return fn(imgs)
+        outputs = step()
+        _timeit(step, warmup)
+        results[name] = (_timeit(step, iters), outputs)
+
+    print("===>num_dets eager / onnx      : %s / %s"%(results["eager"][1][3].tolist(), results["onnxruntime"][1][3].tolist()))
+    for name, (times, _) in results.items():
+        print("===>%-12s forward p50/p99 : %.2f / %.2f ms"%(name, np.percentile(times, 50), np.percentile(times, 99)))
+
+def bench_padding(root_dir, split, batch_size, iters, device):
+    '''
+    Padding waste of shuffled batches versus aspect-ratio grouped batches, and the effective
+    (non-padding) pixels per second of inference forward passes over the first 'iters' batches.
+    '''
+    class Config(DefaultConfig):
+        pretrained = False
+
+    dataset = VOCDataset(root_dir = root_dir, resize_size = [800,1333], split = split, is_train = False)
+    padded_sizes = dataset.padded_sizes()
+    batchings = [("shuffled", [list(b) for b in torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(range(len(dataset))),
+                                                                              batch_size, False)]),
+                 ("grouped", GroupedBatchSampler(aspect_ratio_groups(padded_sizes), batch_size).batches())]
+
+    detector = FCOSDetector(mode = "inference", config = Config, device = device).eval()
+    for name, batches in batchings:
+        ratio, _, _ = padding_ratio(batches, padded_sizes)
+        img_pixels = 0
+        cost_t = 0.
+        for batch in batches[:iters]:
+            sizes = padded_sizes[batch]
+            imgs = torch.zeros(len(batch), 3, int(sizes[:,0].max()), int(sizes[:,1].max()), device = device)
+            cost_t += _timeit(lambda: detector(imgs), 1, device)[0]/1000
+            img_pixels += int((sizes[:,0]*sizes[:,1]).sum())
+        print("===>%-8s batches:%d padding ratio:%.3f effective pixels/s:%.0f"%(name, len(batches), ratio, img_pixels/max(cost_t, 1e-9)))
+
+def rotate_boxes_loop(boxes, a, rx0, ry0, w, h):
+    '''
+    previous per-box implementation of dataset.augment._rotate_boxes, the reference of bench_rotate
+    and tests/test_augment.py
+    '''
+    boxes = torch.from_numpy(boxes)
+    new_boxes = torch.zeros_like(boxes)
+    new_boxes[:, 0] = boxes[:, 1]
+    new_boxes[:, 1] = boxes[:, 0]
+    new_boxes[:, 2] = boxes[:, 3]
+    new_boxes[:, 3] = boxes[:, 2]
+    for i in range(boxes.shape[0]):
+        ymin, xmin, ymax, xmax = new_boxes[i, :]
+        xmin, ymin, xmax, ymax = float(xmin), float(ymin), float(xmax), float(ymax)
+        x0, y0 = xmin, ymin
+        x1, y1 = xmin, ymax
+        x2, y2 = xmax, ymin
+        x3, y3 = xmax, ymax
+        z = torch.FloatTensor([[y0, x0], [y1, x1], [y2, x2], [y3, x3]])
+        tp = torch.zeros_like(z)
+        
+        tp[:, 1] = (z[:, 1] - rx0) * math.cos(a) - (z[:, 0] - ry0) * math.sin(a) + rx0
+        tp[:, 0] = (z[:, 1] - rx0) * math.sin(a) + (z[:, 0] - ry0) * math.cos(a) + ry0
+        
+        ymax, xmax = torch.max(tp, dim = 0)[0]
+        ymin, xmin = torch.min(tp, dim = 0)[0]
+        
+        new_boxes[i] = torch.stack([ymin, xmin, ymax, xmax])
+    
+    new_boxes[:, 1::2].clamp_(min = 0, max = w-1)
+    new_boxes[:, 0::2].clamp_(min = 0, max = h-1)
+    boxes[:, 0] = new_boxes[:, 1]
+    boxes[:, 1] = new_boxes[:, 0]
+    boxes[:, 2] = new_boxes[:, 3]
+    boxes[:, 3] = new_boxes[:, 2]
+    return boxes.numpy()
+
+def bench_rotate():
+    '''
+    per-image random_rotation time, vectorized boxes vs the previous per-box loop
+    '''
+    img = Image.fromarray(np.random.randint(0, 255, (375, 500, 3), dtype = np.uint8))
+    w, h = img.size
+    for n in [1, 5, 10, 25, 50, 100]:
+        xy = np.random.rand(n, 2)*np.array([w-50, h-50])
+        boxes = np.concatenate([xy, xy + np.random.rand(n, 2)*50 + 1], axis = 1).astype(np.float32)
+        a = -random.uniform(-10, 10) / 180.0 * math.pi
+        assert np.allclose(_rotate_boxes(boxes, a, w/2.0, h/2.0, w, h),
+                           rotate_boxes_loop(boxes.copy(), a, w/2.0, h/2.0, w, h), atol = 1e-4)
+
+        cost = []
+        for rotate in [rotate_boxes_loop, _rotate_boxes]:
+            start_t = time.time()
+            for _ in range(50):
+                img.rotate(10)
+                rotate(boxes.copy(), a, w/2.0, h/2.0, w, h)
+            cost.append(1000*(time.time()-start_t)/50)
+        print("boxes:%3d  loop:%.3f ms  vectorized:%.3f ms  speedup:%.1fx"%(n, cost[0], cost[1], cost[0]/cost[1]))
+
+def synthetic_detections(num_imgs, dets_per_img, num_cls = 21, seed = 0):
+    '''
+    VOC-like gts and noisy, score-sorted detections around them plus random false positives
+    returns gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores (lists of arrays)
+    '''
+    rng = np.random.RandomState(seed)
+    gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores = [], [], [], [], []
+    for _ in range(num_imgs):
+        g = rng.randint(1, 8)
+        xy = rng.rand(g, 2)*400
+        gts = np.concatenate([xy, xy + rng.rand(g, 2)*200 + 10], axis = 1).astype(np.float32)
+        labels = rng.randint(1, num_cls, g)
+        src = rng.randint(0, g, dets_per_img)
+        noise = rng.randn(dets_per_img, 4).astype(np.float32)*np.where(rng.rand(dets_per_img, 1) < 0.3, 5., 80.)
+        gt_boxes.append(gts)
+        gt_labels.append(labels)
+        pred_boxes.append(gts[src] + noise)
+        pred_labels.append(np.where(rng.rand(dets_per_img) < 0.8, labels[src], rng.randint(1, num_cls, dets_per_img)))
+        pred_scores.append(np.round(rng.rand(dets_per_img), 2).astype(np.float32))        # rounded, so there are ties
+    pred_boxes, pred_labels, pred_scores = sort_by_score(pred_boxes, pred_labels, pred_scores)
+    return gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores
+
+def eval_ap_2d_loop(gt_boxes,           # list of 2d array,shape[(a,(x1,y1,x2,y2)),(b,(x1,y1,x2,y2))...] 
+               gt_labels,          # list of 1d array,shape[(a),(b)...],value is sparse label index
+               pred_boxes,         # list of 2d array, shape[(m,(x1,y1,x2,y2)),(n,(x1,y1,x2,y2))...]
+               pred_labels,        # list of 1d array,shape[(m),(n)...],value is sparse label index
+               pred_scores,        # list of 1d array,shape[(m),(n)...]
+               iou_thread, 
+               num_cls):           # total number of class including background which is equal to 0
+    '''
+    previous per-box implementation of eval_voc.eval_ap_2d, the reference of bench_ap and
+    tests/test_eval_voc.py
+    '''
+
+    all_ap = {}
+    for label in range(num_cls)[1:]:
+        # get samples with specific label
+        true_label_loc = [sample_labels == label for sample_labels in gt_labels]
+        gt_single_cls = [sample_boxes[mask] for sample_boxes, mask in zip(gt_boxes, true_label_loc)]
+
+        pred_label_loc = [sample_labels == label for sample_labels in pred_labels]
+        bbox_single_cls = [sample_boxes[mask] for sample_boxes, mask in zip(pred_boxes, pred_label_loc)]
+        scores_single_cls = [sample_scores[mask] for sample_scores, mask in zip(pred_scores, pred_label_loc)]
+
+        fp = np.zeros((0,))
+        tp = np.zeros((0,))
+        scores = np.zeros((0,))
+        total_gts = 0
+        # loop for each sample
+        for sample_gts, sample_pred_box, sample_scores in zip(gt_single_cls, bbox_single_cls, scores_single_cls):
+            total_gts = total_gts + len(sample_gts)
+            assigned_gt = []  # one gt can only be assigned to one predicted bbox
+            # loop for each predicted bbox
+            for index in range(len(sample_pred_box)):
+                scores = np.append(scores, sample_scores[index])
+                if len(sample_gts) == 0:  # if no gts found for the predicted bbox, assign the bbox to fp
+                    fp = np.append(fp, 1)
+                    tp = np.append(tp, 0)
+                    continue
+                pred_box = np.expand_dims(sample_pred_box[index], axis = 0)
+                iou = iou_2d(sample_gts, pred_box)
+                gt_for_box = np.argmax(iou, axis = 0)
+                max_overlap = iou[gt_for_box, 0]
+                if max_overlap >= iou_thread and gt_for_box not in assigned_gt:
+                    fp = np.append(fp, 0)
+                    tp = np.append(tp, 1)
+                    assigned_gt.append(gt_for_box)
+                else:
+                    fp = np.append(fp, 1)
+                    tp = np.append(tp, 0)
+        # sort by score
+        indices = np.argsort(-scores)
+        fp = fp[indices]
+        tp = tp[indices]
+        # compute cumulative false positives and true positives
+        fp = np.cumsum(fp)
+        tp = np.cumsum(tp)
+        # compute recall and precision
+        recall = tp / total_gts
+        precision = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        ap = _compute_ap(recall, precision)
+        all_ap[label] = ap
+        # print(recall, precision)
+    
+    return all_ap               # a dict containing average precision for each cls
+
+def bench_ap(num_imgs, dets_per_img, num_workers, iou_thread = 0.5, num_cls = 21):
+    '''
+    eval_ap_2d against the previous per-box loop on synthetic detections, then the per-class
+    evaluator over 10 IoU thresholds, serial and in the process pool, against one eval_ap_2d
+    per threshold, results must be identical
+    '''
+    data = synthetic_detections(num_imgs, dets_per_img, num_cls)
+    cost = []
+    results = []
+    for fn in [eval_ap_2d_loop, eval_ap_2d]:
+        start_t = time.time()
+        results.append(fn(*data, iou_thread, num_cls))
+        cost.append(time.time()-start_t)
+    assert results[0] == results[1], "AP differs from the reference loop"
+    print("===>%d imgs x %d dets  loop:%.2f s  vectorized:%.3f s  speedup:%.0fx  mAP:%.4f (identical)"%(
+          num_imgs, dets_per_img, cost[0], cost[1], cost[0]/cost[1], np.mean(list(results[1].values()))))
+
+    iou_threads = np.linspace(0.5, 0.95, 10)
+    start_t = time.time()
+    reference = {float(t): eval_ap_2d(*data, t, num_cls) for t in iou_threads}
+    per_threshold = time.time()-start_t
+    cost = []
+    results = []
+    for workers in [0, num_workers]:
+        start_t = time.time()
+        results.append(eval_ap_2d_parallel(*data, iou_threads, num_cls, num_workers = workers))
+        cost.append(time.time()-start_t)
+    assert results[0] == results[1], "parallel AP differs from the serial path"
+    assert results[0] == reference, "per-class matching differs from eval_ap_2d"
+    workers = min(num_workers, os.cpu_count() or 1, num_cls-1)
+    print("===>10 IoU thresholds x %d classes  eval_ap_2d per threshold:%.2f s  serial:%.2f s  %d workers (%d cpus):%.2f s  speedup:%.1fx (identical)"%(
+          num_cls-1, per_threshold, cost[0], workers, os.cpu_count() or 1, cost[1], per_threshold/cost[1]))
+
+    start_t = time.time()
+    coco = eval_coco_2d(*data, num_cls)
+    print("===>coco protocol, 10 thresholds x 4 areas x 3 maxDets in one pass:%.2f s  AP:%.4f AP50:%.4f"%(
+          time.time()-start_t, coco['stats'][0], coco['stats'][1]))
+
+if __name__=="__main__":
+    opt = parser.parse_args()
+    if opt.bench == "startup":
+        bench_startup_vs_steady(opt.height, opt.width, opt.batch_size, opt.iters, opt.warmup, opt.device)
+    elif opt.bench == "padding":
+        with torch.no_grad():
+            bench_padding(opt.root_dir, opt.split, opt.batch_size, opt.iters, opt.device)
+    elif opt.bench == "ap":
+        bench_ap(opt.num_imgs, opt.dets_per_img, opt.num_workers)
+    elif opt.bench == "rotate":
+        bench_rotate()
+    elif opt.bench == "export":
+        bench_export(opt.height, opt.width, opt.batch_size, opt.iters, opt.warmup, opt.device)
+    elif opt.bench == "onnx":
+        bench_onnx(opt.height, opt.width, opt.batch_size, opt.iters, opt.warmup)
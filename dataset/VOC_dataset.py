@@ -3,9 +3,12 @@ import xml.etree.ElementTree as ET
 import os
 import cv2
 import numpy as np
-from torchvision import transforms
 from PIL import  Image
 import random
+import hashlib
+from .anno_index import AnnotationIndex
+from .image_shards import ImageShards
+from .augment import AffineTransforms, get_resize_scale
 
 def flip(img, boxes):
     img = img.transpose(Image.FLIP_LEFT_RIGHT)
@@ -17,6 +20,16 @@ def flip(img, boxes):
         boxes[:, 0] = xmin
     return img, boxes
 
+def _new_buffer(shape, dtype):
+    '''
+    collate_fn output. Inside a DataLoader worker it is allocated in shared memory directly, like
+    default_collate does, so passing the batch to the main process copies nothing. In the main
+    process it is pinned when cuda is available, so the copy to the gpu can be non_blocking.
+    '''
+    if torch.utils.data.get_worker_info() is not None:
+        return torch.empty(shape, dtype = dtype).share_memory_()
+    return torch.empty(shape, dtype = dtype, pin_memory = torch.cuda.is_available())
+
 class VOCDataset(torch.utils.data.Dataset):
     CLASSES_NAME = (
         "__background__ ",
@@ -41,7 +54,7 @@ class VOCDataset(torch.utils.data.Dataset):
         "train",
         "tvmonitor",
     )
-    def __init__(self, root_dir, resize_size = [800,1333], split = 'trainval', use_difficult = False, is_train = True, augment = None):
+    def __init__(self, root_dir, resize_size = [800,1333], split = 'trainval', use_difficult = False, is_train = True, augment = None, anno_index_dir = None, image_shards_dir = None, return_img_hw = False, random_flip = True):
         self.root = root_dir
         self.use_difficult = use_difficult
         self.imgset = split
@@ -61,6 +74,23 @@ class VOCDataset(torch.utils.data.Dataset):
         self.std = [0.229, 0.224, 0.225]
         self.train = is_train
         self.augment = augment
+        # samples carry the (h, w) of the resized image inside the padding, collate_fn returns them as a 4th output
+        self.return_img_hw = return_img_hw
+        # off when a later stage (BatchAugment) flips the batch
+        self.random_flip = random_flip
+        if return_img_hw and is_train and isinstance(augment, AffineTransforms):
+            raise ValueError("===>return_img_hw is not supported with AffineTransforms")
+        # parse every xml once into a memory-mapped index instead of on each __getitem__
+        self.anno_index = None
+        if anno_index_dir is not None:
+            # one directory per dataset root and split, several roots can share anno_index_dir
+            root_hash = hashlib.md5(os.path.abspath(self.root).encode()).hexdigest()[:8]
+            self.anno_index = AnnotationIndex(self._annopath, self.img_ids, self.name2id,
+                                              os.path.join(anno_index_dir, "%s_%s"%(self.imgset, root_hash)))
+        # pre-resized uint8 images written by preprocess_voc.py
+        self.image_shards = None
+        if image_shards_dir is not None:
+            self.image_shards = ImageShards(image_shards_dir, self.img_ids, self.resize_size)
         print("voc_dataset init finished BOSS !!")
 
     def __len__(self):
@@ -69,8 +99,95 @@ class VOCDataset(torch.utils.data.Dataset):
     def __getitem__(self,index):
 
         img_id = self.img_ids[index]
-        img = Image.open(self._imgpath%img_id)
 
+        boxes, classes = self.load_anno(index)
+
+        affine = self.train and isinstance(self.augment, AffineTransforms)
+        if self.image_shards is not None:
+            img_paded, (nh, nw), scale = self.image_shards.get(index)
+            boxes = boxes * float(scale)
+            if not self.train:
+                # already resized and padded, no decode and no copy until collate_fn
+                img = torch.from_numpy(img_paded).permute(2,0,1)
+                return self._sample(img, boxes, classes, (nh, nw))
+            if affine:
+                img = img_paded[:nh, :nw]
+            else:
+                img = Image.fromarray(np.ascontiguousarray(img_paded[:nh, :nw]))
+        elif affine:
+            img = cv2.imread(self._imgpath%img_id)
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst = img)
+        else:
+            img = Image.open(self._imgpath%img_id)
+
+        if affine:
+            # flip, augmentation, resize and padding in one warp on the uint8 array
+            img, boxes = self.augment(img, boxes, self.resize_size)
+            img = torch.from_numpy(img).permute(2,0,1)
+            return img,torch.from_numpy(boxes),torch.from_numpy(classes)
+
+        if self.train:
+            if self.random_flip and random.random() < 0.5:
+                img, boxes = flip(img, boxes)
+            if self.augment is not None:
+                img, boxes = self.augment(img, boxes)
+        img = np.array(img)
+        h, w, _ = img.shape
+        scale = get_resize_scale(h, w, self.resize_size)
+        img,boxes = self.preprocess_img_boxes(img,boxes,self.resize_size)
+
+        # uint8 [3,h,w], collate_fn converts and normalizes
+        img = torch.from_numpy(img).permute(2,0,1)
+
+        return self._sample(img, boxes, classes, (int(scale * h), int(scale * w)))
+
+    def _sample(self, img, boxes, classes, img_hw):
+        sample = (img, torch.from_numpy(boxes), torch.from_numpy(classes))
+        if self.return_img_hw:
+            sample += (torch.tensor(img_hw, dtype = torch.int64),)
+        return sample
+
+    def img_sizes(self):
+        '''
+        returns [num_imgs,2] (height, width) of the original images without decoding them,
+        from the annotation index or the xml 'size' tag, falling back to the jpeg header
+        '''
+        if self.anno_index is not None:
+            sizes = self.anno_index.sizes()
+        else:
+            sizes = np.zeros((len(self.img_ids), 2), dtype = np.int32)
+            for i, img_id in enumerate(self.img_ids):
+                _size = ET.parse(self._annopath%img_id).getroot().find("size")
+                if _size is not None:
+                    sizes[i] = [int(float(_size.find("height").text)), int(float(_size.find("width").text))]
+        for i in np.nonzero(sizes.min(axis = 1) <= 0)[0]:
+            w, h = Image.open(self._imgpath%self.img_ids[i]).size
+            sizes[i] = [h, w]
+        
+        return sizes
+
+    def padded_sizes(self):
+        '''
+        returns [num_imgs,2] (height, width) of the images after preprocess_img_boxes
+        '''
+        sizes = self.img_sizes()
+        padded = np.zeros_like(sizes)
+        for i, (h, w) in enumerate(sizes):
+            scale = get_resize_scale(h, w, self.resize_size)
+            nh, nw = int(scale * h), int(scale * w)
+            padded[i] = [nh + 32 - nh%32, nw + 32 - nw%32]
+        
+        return padded
+
+    def load_anno(self, index):
+        '''
+        boxes [n,4] float32 in original image pixels, classes [n] int64 of image 'index'
+        '''
+        if self.anno_index is not None:
+            return self.anno_index.get(index, self.use_difficult)
+        return self._parse_anno(self.img_ids[index])
+
+    def _parse_anno(self, img_id):
         anno = ET.parse(self._annopath%img_id).getroot()
         boxes = []
         classes = []
@@ -97,31 +214,12 @@ class VOCDataset(torch.utils.data.Dataset):
             name = obj.find("name").text.lower().strip()
             classes.append(self.name2id[name])
 
-        boxes = np.array(boxes,dtype=np.float32)
-        if self.train:
-            if random.random() < 0.5:
-                img, boxes = flip(img, boxes)
-            if self.augment is not None:
-                img, boxes = self.augment(img, boxes)
-        img = np.array(img)
-        img,boxes = self.preprocess_img_boxes(img,boxes,self.resize_size)
-
-        img = transforms.ToTensor()(img)
-        boxes = torch.from_numpy(boxes)
-        classes = torch.LongTensor(classes)
-
-        return img,boxes,classes
+        return np.array(boxes,dtype=np.float32).reshape(-1,4), np.array(classes,dtype=np.int64)
 
     # Function to resize image and bboxes
     def preprocess_img_boxes(self,image,boxes,input_ksize):
-        min_side, max_side = input_ksize
         h,  w, _  = image.shape
-
-        smallest_side = min(w,h)
-        largest_side = max(w,h)
-        scale = min_side/smallest_side
-        if largest_side*scale > max_side:
-            scale = max_side/largest_side
+        scale = get_resize_scale(h, w, input_ksize)
         
         nw, nh = int(scale * w), int(scale * h)
         image_resized = cv2.resize(image, (nw, nh))
@@ -139,40 +237,48 @@ class VOCDataset(torch.utils.data.Dataset):
             boxes[:, [1, 3]] = boxes[:, [1, 3]] * scale
             return image_paded, boxes
     def collate_fn(self,data):
-        imgs_list,boxes_list,classes_list = zip(*data)
+        '''
+        data: (uint8 img [3,h,w], boxes [n,4], classes [n]) per image
+        Writes every image straight into one preallocated [batch_size,3,max_h,max_w] float buffer,
+        normalized on the way (x*scale + bias per channel), and only fills the padding strips.
+        Padding is 0 before normalization and -1 for boxes and classes, as before.
+        With return_img_hw the samples carry a 4th element and batch_img_hw [batch_size,2] (h, w of
+        each resized image inside the padding) is returned after batch_classes.
+        '''
+        fields = list(zip(*data))
+        imgs_list,boxes_list,classes_list = fields[:3]
         assert len(imgs_list) == len(boxes_list) == len(classes_list)
         batch_size = len(boxes_list)
-        pad_imgs_list = []
-        pad_boxes_list = []
-        pad_classes_list = []
-
-        h_list = [int(s.shape[1]) for s in imgs_list]
-        w_list = [int(s.shape[2]) for s in imgs_list]
-        max_h = np.array(h_list).max()
-        max_w = np.array(w_list).max()
-        
-        for i in range(batch_size):
-            img = imgs_list[i]
-            pad_imgs_list.append(transforms.Normalize(self.mean, 
-                                                      self.std,inplace = True)(torch.nn.functional.pad(img,
-                                                                                                       (0, int(max_w-img.shape[2]), 0,
-                                                                                                        int(max_h-img.shape[1])), value = 0.)))
 
+        max_h = max(int(s.shape[1]) for s in imgs_list)
+        max_w = max(int(s.shape[2]) for s in imgs_list)
+        max_num = max(int(b.shape[0]) for b in boxes_list)
 
-        max_num = 0
-        for i in range(batch_size):
-            n = boxes_list[i].shape[0]
-            if n > max_num:max_num = n
-        
-        for i in range(batch_size):
-            pad_boxes_list.append(torch.nn.functional.pad(boxes_list[i],(0, 0, 0, max_num-boxes_list[i].shape[0]), value = -1))
-            pad_classes_list.append(torch.nn.functional.pad(classes_list[i],(0, max_num-classes_list[i].shape[0]), value = -1))
+        mean = torch.tensor(self.mean, dtype = torch.float32)
+        std = torch.tensor(self.std, dtype = torch.float32)
+        # same arithmetic as transforms.Normalize on a black pixel, a 0 input gives exactly this
+        bias = torch.zeros(3).sub_(mean).div_(std)[:, None, None]
+        scale = (1./(255.*std))[:, None, None]
 
+        batch_imgs = _new_buffer([batch_size, 3, max_h, max_w], torch.float32)
+        batch_boxes = _new_buffer([batch_size, max_num, 4], torch.float32)
+        batch_classes = _new_buffer([batch_size, max_num], torch.int64)
+        for i in range(batch_size):
+            img = imgs_list[i]
+            h, w = int(img.shape[1]), int(img.shape[2])
+            torch.mul(img, scale, out = batch_imgs[i, :, :h, :w])
+            batch_imgs[i, :, :h, :w].add_(bias)
+            batch_imgs[i, :, h:, :] = bias
+            batch_imgs[i, :, :h, w:] = bias
 
-        batch_boxes = torch.stack(pad_boxes_list)
-        batch_classes = torch.stack(pad_classes_list)
-        batch_imgs = torch.stack(pad_imgs_list)
+            n = boxes_list[i].shape[0]
+            batch_boxes[i, :n] = boxes_list[i]
+            batch_boxes[i, n:] = -1
+            batch_classes[i, :n] = classes_list[i]
+            batch_classes[i, n:] = -1
 
+        if len(fields) == 4:
+            return batch_imgs,batch_boxes,batch_classes,torch.stack(fields[3])
         return batch_imgs,batch_boxes,batch_classes
 
 
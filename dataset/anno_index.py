@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import numpy as np
+import xml.etree.ElementTree as ET
+from .cache_meta import invalidate_meta, write_meta, read_meta
+
+
+class AnnotationIndex(object):
+    '''
+    One-time parse of the VOC xml annotations of a split into flat arrays
+        boxes     [num_objects,4] float32, 0-based (x1,y1,x2,y2)
+        classes   [num_objects]   int64
+        difficult [num_objects]   bool
+        offsets   [num_imgs+1]    int64, objects of image i are offsets[i]:offsets[i+1]
+        sizes     [num_imgs,2]    int32, (height, width) from the xml, 0 when missing
+    saved as .npy files in 'cache_dir' and memory-mapped on load, so every DataLoader
+    worker shares the same pages. The cache is rebuilt when the annotation directory, the
+    image id list, the class names or any annotation file (name, size, mtime) changes.
+    '''
+    FILES = ['boxes', 'classes', 'difficult', 'offsets', 'sizes']
+
+    def __init__(self, anno_path, img_ids, name2id, cache_dir):
+        self.anno_path = anno_path                      # e.g. ".../Annotations/%s.xml"
+        self.img_ids = img_ids
+        self.name2id = name2id
+        self.cache_dir = cache_dir
+        self._arrays = None
+
+        fingerprint = self.fingerprint()
+        if self._read_fingerprint() != fingerprint:
+            self.build(fingerprint)
+
+    def fingerprint(self):
+        md5 = hashlib.md5()
+        md5.update(os.path.abspath(self.anno_path).encode())
+        md5.update(json.dumps(sorted(self.name2id.items())).encode())
+        for img_id in self.img_ids:
+            st = os.stat(self.anno_path%img_id)
+            md5.update(("%s %d %d\n"%(img_id, st.st_size, st.st_mtime_ns)).encode())
+
+        return md5.hexdigest()
+
+    def _read_fingerprint(self):
+        meta = read_meta(self.cache_dir, ['%s.npy'%name for name in self.FILES])
+        return None if meta is None else meta.get('fingerprint')
+
+    def build(self, fingerprint):
+        boxes = []
+        classes = []
+        difficult = []
+        offsets = [0]
+        sizes = []
+        for img_id in self.img_ids:
+            anno = ET.parse(self.anno_path%img_id).getroot()
+            _size = anno.find("size")
+            if _size is not None:
+                sizes.append([int(float(_size.find("height").text)), int(float(_size.find("width").text))])
+            else:
+                sizes.append([0, 0])
+            for obj in anno.iter("object"):
+                _box = obj.find("bndbox")
+                boxes.append([_box.find(key).text for key in ("xmin", "ymin", "xmax", "ymax")])
+                classes.append(self.name2id[obj.find("name").text.lower().strip()])
+                difficult.append(int(obj.find("difficult").text) == 1)
+            offsets.append(len(classes))
+
+        # Make pixel indexes 0-based
+        arrays = dict(boxes = (np.array(boxes, dtype = np.float64).reshape(-1, 4) - 1).astype(np.float32),
+                      classes = np.array(classes, dtype = np.int64),
+                      difficult = np.array(difficult, dtype = np.bool_),
+                      offsets = np.array(offsets, dtype = np.int64),
+                      sizes = np.array(sizes, dtype = np.int32).reshape(-1, 2))
+
+        os.makedirs(self.cache_dir, exist_ok = True)
+        invalidate_meta(self.cache_dir)
+        for name in self.FILES:
+            np.save(os.path.join(self.cache_dir, '%s.npy'%name), arrays[name])
+        write_meta(self.cache_dir, dict(fingerprint = fingerprint, num_imgs = len(self.img_ids)))
+        print("INFO===>annotation index built for %d imgs in %s"%(len(self.img_ids), self.cache_dir))
+
+    def _load(self):
+        self._arrays = {name: np.load(os.path.join(self.cache_dir, '%s.npy'%name), mmap_mode = 'r')
+                        for name in self.FILES}
+
+    def __getstate__(self):
+        # workers re-open the memory maps instead of receiving pickled copies
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def sizes(self):
+        if self._arrays is None:
+            self._load()
+        return np.array(self._arrays['sizes'])
+
+    def get(self, index, use_difficult = False):
+        '''
+        returns boxes [n,4] float32, classes [n] int64 of image 'index' as writable copies
+        '''
+        if self._arrays is None:
+            self._load()
+        start, end = self._arrays['offsets'][index], self._arrays['offsets'][index+1]
+        boxes = np.array(self._arrays['boxes'][start:end])
+        classes = np.array(self._arrays['classes'][start:end])
+        if not use_difficult:
+            keep = ~self._arrays['difficult'][start:end]
+            boxes, classes = boxes[keep], classes[keep]
+
+        return boxes, classes
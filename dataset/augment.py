@@ -1,10 +1,32 @@
 import torch
+import numpy as np
+import cv2
 import math, random
 from PIL import Image
 import random
 import torchvision.transforms as transforms
 
 
+def get_resize_scale(h, w, input_ksize):
+    min_side, max_side = input_ksize
+    smallest_side = min(w,h)
+    largest_side = max(w,h)
+    scale = min_side/smallest_side
+    if largest_side*scale > max_side:
+        scale = max_side/largest_side
+    return scale
+
+def seed_worker(worker_id):
+    '''
+    DataLoader worker_init_fn. torch gives every worker the seed base_seed + worker_id,
+    where base_seed is drawn from the main process generator (torch.manual_seed), the
+    python and numpy generators of the worker are seeded from it as well.
+    '''
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+
+
 class Transforms(object):
     def __init__(self):
         pass
@@ -33,40 +55,23 @@ def random_rotation(img, boxes, degree = 10):
     rx0, ry0 = w / 2.0, h / 2.0
     img = img.rotate(d)
     a = -d / 180.0 * math.pi
-    boxes = torch.from_numpy(boxes)
-    new_boxes = torch.zeros_like(boxes)
-    new_boxes[:, 0] = boxes[:, 1]
-    new_boxes[:, 1] = boxes[:, 0]
-    new_boxes[:, 2] = boxes[:, 3]
-    new_boxes[:, 3] = boxes[:, 2]
-    for i in range(boxes.shape[0]):
-        ymin, xmin, ymax, xmax = new_boxes[i, :]
-        xmin, ymin, xmax, ymax = float(xmin), float(ymin), float(xmax), float(ymax)
-        x0, y0 = xmin, ymin
-        x1, y1 = xmin, ymax
-        x2, y2 = xmax, ymin
-        x3, y3 = xmax, ymax
-        z = torch.FloatTensor([[y0, x0], [y1, x1], [y2, x2], [y3, x3]])
-        tp = torch.zeros_like(z)
-        
-        tp[:, 1] = (z[:, 1] - rx0) * math.cos(a) - (z[:, 0] - ry0) * math.sin(a) + rx0
-        tp[:, 0] = (z[:, 1] - rx0) * math.sin(a) + (z[:, 0] - ry0) * math.cos(a) + ry0
-        
-        ymax, xmax = torch.max(tp, dim = 0)[0]
-        ymin, xmin = torch.min(tp, dim = 0)[0]
-        
-        new_boxes[i] = torch.stack([ymin, xmin, ymax, xmax])
-    
-    new_boxes[:, 1::2].clamp_(min = 0, max = w-1)
-    new_boxes[:, 0::2].clamp_(min = 0, max = h-1)
-    boxes[:, 0] = new_boxes[:, 1]
-    boxes[:, 1] = new_boxes[:, 0]
-    boxes[:, 2] = new_boxes[:, 3]
-    boxes[:, 3] = new_boxes[:, 2]
-    boxes = boxes.numpy()
+    boxes = _rotate_boxes(boxes, a, rx0, ry0, w, h)
     return img, boxes
 
+def _rotate_boxes(boxes, a, rx0, ry0, w, h):
+    '''
+    boxes [n,4] float32 (x1,y1,x2,y2) --> axis aligned hull of the four corners rotated by
+    'a' radians around (rx0, ry0), clipped to the image. All boxes in one numpy step.
+    '''
+    x = boxes[:, [0, 0, 2, 2]]                                                     # [n,4] corners
+    y = boxes[:, [1, 3, 1, 3]]
+    tx = (x - rx0) * math.cos(a) - (y - ry0) * math.sin(a) + rx0
+    ty = (x - rx0) * math.sin(a) + (y - ry0) * math.cos(a) + ry0
 
+    new_boxes = np.stack([tx.min(axis = 1), ty.min(axis = 1), tx.max(axis = 1), ty.max(axis = 1)], axis = 1)
+    new_boxes[:, 0::2] = np.clip(new_boxes[:, 0::2], 0, w-1)
+    new_boxes[:, 1::2] = np.clip(new_boxes[:, 1::2], 0, h-1)
+    return new_boxes.astype(np.float32)
 
 def _box_inter(box1, box2):
     tl = torch.max(box1[:,None,:2], box2[:,:2])                      # [n,m,2]
@@ -123,4 +128,158 @@ def random_crop_resize(img, boxes, crop_scale_min = 0.2, aspect_ratio = [3./4, 4
         # img = img.resize((ow,oh), Image.BILINEAR)
         # boxes *= torch.FloatTensor([sw,sh,sw,sh])
     boxes = boxes.numpy()
-    return img, boxes
\ No newline at end of file
+    return img, boxes
+
+
+
+def _color_jitter_np(img, brightness = 0.1, contrast = 0.1, saturation = 0.1, hue = 0.1):
+    '''
+    img [h,w,3] uint8 RGB. Same factor ranges, random order and uint8 arithmetic as
+    transforms.ColorJitter on a PIL image, with lookup tables instead of float copies.
+    '''
+    b = random.uniform(1-brightness, 1+brightness)
+    c = random.uniform(1-contrast, 1+contrast)
+    s = random.uniform(1-saturation, 1+saturation)
+    hf = random.uniform(-hue, hue)
+    order = [0, 1, 2, 3]
+    random.shuffle(order)
+
+    levels = np.arange(256, dtype = np.float32)
+    for op in order:
+        if op == 0:
+            img = cv2.LUT(img, np.clip(levels*b + 0.5, 0, 255).astype(np.uint8))
+        elif op == 1:
+            mean = int(cv2.cvtColor(img, cv2.COLOR_RGB2GRAY).mean() + 0.5)
+            img = cv2.LUT(img, np.clip((levels - mean)*c + mean + 0.5, 0, 255).astype(np.uint8))
+        elif op == 2:
+            gray = cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_RGB2GRAY), cv2.COLOR_GRAY2RGB)
+            img = cv2.addWeighted(img, s, gray, 1-s, 0)
+        else:
+            hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV_FULL)                               # h in [0,255] like PIL
+            hsv[:, :, 0] += np.uint8(int(hf*255) % 256)                                     # wraps around
+            img = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB_FULL)
+    return img
+
+def _random_crop_params(w, h, boxes, crop_scale_min = 0.2, aspect_ratio = [3./4, 4./3], remain_min = 0.7, attempt_max = 10):
+    '''
+    the crop window search of random_crop_resize on numpy boxes, drawing the same random numbers
+    returns (x, y, w, h) or None when no attempt keeps enough of every box
+    '''
+    box_area = (boxes[:, 2]-boxes[:, 0])*(boxes[:, 3]-boxes[:, 1])                    # [N]
+    for attempt in range(attempt_max):
+        target_area = random.uniform(crop_scale_min, 1.0) * w * h
+        aspect_ratio_ = random.uniform(aspect_ratio[0], aspect_ratio[1])
+        cw = int(round(math.sqrt(target_area * aspect_ratio_)))
+        ch = int(round(math.sqrt(target_area / aspect_ratio_)))
+        if random.random() < 0.5:
+            cw, ch = ch, cw
+
+        if cw <= w and ch <= h:
+            x = random.randint(0, w - cw)
+            y = random.randint(0, h - ch)
+            iw = (np.minimum(boxes[:, 2], x + cw) - np.maximum(boxes[:, 0], x)).clip(min = 0)
+            ih = (np.minimum(boxes[:, 3], y + ch) - np.maximum(boxes[:, 1], y)).clip(min = 0)
+            inter = iw * ih                                                           # [N]
+            mask = inter > 0.0001
+            if not mask.any() or (inter[mask] / box_area[mask] > remain_min).all():
+                return x, y, cw, ch
+    return None
+
+class AffineTransforms(object):
+    '''
+    NumPy/OpenCV replacement for the VOCDataset flip + Transforms + preprocess_img_boxes chain.
+    Works on one [h,w,3] uint8 RGB array: with a rotation, the flip, rotation, crop and the
+    final resize are composed into one 2x3 matrix and sampled once by cv2.warpAffine. Without
+    one the crop is a view of the source and a plain cv2.resize is cheaper than the warp.
+    Only the color jitter touches the source pixels.
+
+    The parameters follow the same distribution as the PIL path (flip 0.5, color jitter 0.3,
+    rotation 0.5, crop 0.5) and are drawn from the python 'random' module, use seed_worker
+    as worker_init_fn for reproducible per-worker streams. Pixels differ slightly from the PIL
+    path since rotation and resize are sampled once with bilinear interpolation.
+    '''
+    def __init__(self, degree = 10, interpolation = cv2.INTER_LINEAR):
+        self.degree = degree
+        self.interpolation = interpolation
+
+    def __call__(self, img, boxes, input_ksize):
+        '''
+        img [h,w,3] uint8, boxes [n,4] float32
+        returns the padded [H,W,3] uint8 image (H,W multiples of 32) and the boxes in its coordinates
+        '''
+        h, w, _ = img.shape
+        boxes = boxes.copy()
+        M = np.eye(3)                                                                 # source pixel --> output pixel
+        flipped = rotated = False
+        x, y = 0, 0
+
+        if random.random() < 0.5:
+            flipped = True
+            M = np.array([[-1., 0., w-1], [0., 1., 0.], [0., 0., 1.]]) @ M
+            xmin = w - boxes[:, 2]
+            xmax = w - boxes[:, 0]
+            boxes[:, 0] = xmin
+            boxes[:, 2] = xmax
+        if random.random() < 0.3:
+            img = _color_jitter_np(img)
+        if random.random() < 0.5:
+            rotated = True
+            d = random.uniform(-self.degree, self.degree)
+            # same center as Image.rotate, (w/2,h/2) in pixel corner coordinates
+            M = np.vstack([cv2.getRotationMatrix2D((w/2.0-0.5, h/2.0-0.5), d, 1.0), [0., 0., 1.]]) @ M
+            boxes = _rotate_boxes(boxes, -d / 180.0 * math.pi, w / 2.0, h / 2.0, w, h)
+        src_w = w
+        if random.random() < 0.5:
+            crop = _random_crop_params(w, h, boxes)
+            if crop is not None:
+                x, y, w, h = crop
+                M = np.array([[1., 0., -x], [0., 1., -y], [0., 0., 1.]]) @ M
+                boxes -= np.array([x, y, x, y], dtype = np.float32)
+                boxes[:, 1::2] = boxes[:, 1::2].clip(0, h-1)
+                boxes[:, 0::2] = boxes[:, 0::2].clip(0, w-1)
+
+        scale = get_resize_scale(h, w, input_ksize)
+        nw, nh = int(scale * w), int(scale * h)
+        pad_w = 32-nw%32
+        pad_h = 32-nh%32
+        img_paded = np.zeros(shape = [nh+pad_h, nw+pad_w, 3], dtype = np.uint8)
+
+        if rotated:
+            # pixel centers map like cv2.resize: x' = (x+0.5)*nw/w-0.5
+            sx, sy = nw / w, nh / h
+            M = np.array([[sx, 0., 0.5*sx-0.5], [0., sy, 0.5*sy-0.5], [0., 0., 1.]]) @ M
+            img_paded[:nh, :nw] = cv2.warpAffine(img, M[:2], (nw, nh), flags = self.interpolation,
+                                                 borderMode = cv2.BORDER_CONSTANT, borderValue = 0)
+        else:
+            # axis aligned: the crop is a view of the source, flipping commutes with the resize
+            x0 = src_w - x - w if flipped else x
+            resized = cv2.resize(img[y:y+h, x0:x0+w], (nw, nh), interpolation = self.interpolation)
+            img_paded[:nh, :nw] = cv2.flip(resized, 1) if flipped else resized
+
+        boxes *= scale
+        return img_paded, boxes
+
+
+if __name__=="__main__":
+    import time
+    # per-sample flip + Transforms + resize/pad, PIL round-trips vs one affine warp
+    from .VOC_dataset import VOCDataset, flip
+    img = np.random.randint(0, 255, (375, 500, 3), dtype = np.uint8)
+    boxes = np.array([[50, 60, 200, 220], [300, 100, 450, 300]], dtype = np.float32)
+
+    def pil_chain():
+        pil_img, pil_boxes = Image.fromarray(img), boxes.copy()
+        if random.random() < 0.5:
+            pil_img, pil_boxes = flip(pil_img, pil_boxes)
+        pil_img, pil_boxes = Transforms()(pil_img, pil_boxes)
+        return VOCDataset.preprocess_img_boxes(None, np.array(pil_img), pil_boxes, [800, 1333])
+
+    affine = AffineTransforms()
+    cost = []
+    for fn in [pil_chain, lambda: affine(img, boxes, [800, 1333])]:
+        random.seed(0)
+        start_t = time.time()
+        for _ in range(200):
+            fn()
+        cost.append(1000*(time.time()-start_t)/200)
+    print("flip+Transforms+resize  PIL:%.3f ms  affine:%.3f ms  speedup:%.1fx"%(cost[0], cost[1], cost[0]/cost[1]))
@@ -0,0 +1,264 @@
+import torch
+import math
+import torch.nn.functional as F
+
+
+# rgb <--> yiq, a hue shift is a rotation of the (i,q) chroma plane
+_RGB2YIQ = torch.tensor([[0.299, 0.587, 0.114],
+                         [0.596, -0.274, -0.322],
+                         [0.211, -0.523, 0.312]])
+_GRAY = _RGB2YIQ[0]
+
+def _fill_padding(out, extents, pad_value):
+    '''
+    out [n,3,H,W], extents [n,2] (h, w) on the device of out, pad_value [3]
+    returns out with the rows/columns beyond each extent set to pad_value
+    '''
+    H, W = out.shape[2:]
+    rows = torch.arange(H, device = out.device, dtype = extents.dtype)
+    cols = torch.arange(W, device = out.device, dtype = extents.dtype)
+    pad = (rows[None, :, None] >= extents[:, 0, None, None]) | (cols[None, None, :] >= extents[:, 1, None, None])   # [n,H,W]
+    return torch.where(pad[:, None], pad_value.to(out)[None, :, None, None], out)
+
+class BatchAugment(object):
+    '''
+    Color jitter, horizontal flip and crop applied to a collated, normalized batch on its own
+    device, with per-sample random parameters drawn from the torch generator:
+        flip 0.5, color jitter 0.3 (same ranges as Transforms), crop 0.5 (same window search as
+        random_crop_resize, the 10 attempts are evaluated at once and the first valid one is used)
+    A crop is resized with its aspect ratio kept to the largest size that fits the image extent
+    and padded like collate_fn, so the batch shape is unchanged. The random_crop_resize +
+    preprocess_img_boxes path instead rescales the crop to the 800 short side, so cropped images
+    here are smaller (never upscaled beyond the original extent) and carry more padding.
+    Flip and crop of a sample are sampled once with grid_sample. Each image only uses its own
+    extent (img_hw from VOCDataset(return_img_hw = True)), the padding stays padding.
+    The jitter order is drawn per sample.
+    '''
+    def __init__(self, mean, std, flip_prob = 0.5, jitter_prob = 0.3, crop_prob = 0.5,
+                 brightness = 0.1, contrast = 0.1, saturation = 0.1, hue = 0.1,
+                 crop_scale_min = 0.2, aspect_ratio = [3./4, 4./3], remain_min = 0.7, attempt_max = 10):
+        self.mean = torch.tensor(mean, dtype = torch.float32)
+        self.std = torch.tensor(std, dtype = torch.float32)
+        # same arithmetic as transforms.Normalize(inplace = True) on the zero padding
+        self.pad_value = torch.zeros(3).sub_(self.mean).div_(self.std)
+        self.flip_prob = flip_prob
+        self.jitter_prob = jitter_prob
+        self.crop_prob = crop_prob
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.crop_scale_min = crop_scale_min
+        self.aspect_ratio = aspect_ratio
+        self.remain_min = remain_min
+        self.attempt_max = attempt_max
+
+    def __call__(self, batch_imgs, batch_boxes, batch_classes, batch_img_hw):
+        '''
+        batch_imgs [batch_size,3,H,W], batch_boxes [batch_size,m,4], batch_classes [batch_size,m] (-1 is padding)
+        batch_img_hw [batch_size,2] (h, w) of each image inside the padding, the 4th output of collate_fn
+        returns new batch_imgs, batch_boxes
+        '''
+        with torch.no_grad():
+            device = batch_imgs.device
+            batch_size = batch_imgs.shape[0]
+            extents = batch_img_hw.to(device).float()                                # [batch_size,2]
+            valid_boxes = batch_classes > 0                                          # [batch_size,m]
+            batch_boxes = batch_boxes.clone()
+
+            batch_imgs = self._jitter(batch_imgs, extents, torch.rand(batch_size, device = device) < self.jitter_prob)
+
+            flip = torch.rand(batch_size, device = device) < self.flip_prob
+            h, w = extents[:, 0:1], extents[:, 1:2]                                  # [batch_size,1]
+            flipped = torch.stack([w - batch_boxes[..., 2], batch_boxes[..., 1],
+                                   w - batch_boxes[..., 0], batch_boxes[..., 3]], dim = -1)
+            flipped = torch.max(torch.min(flipped, torch.cat([w - 1, h - 1]*2, dim = 1)[:, None]), torch.zeros_like(flipped))
+            batch_boxes = torch.where((flip[:, None] & valid_boxes)[..., None], flipped, batch_boxes)
+
+            crop = self._crop_windows(extents, batch_boxes, valid_boxes)            # [batch_size,4] x,y,w,h
+            do_crop = (torch.rand(batch_size, device = device) < self.crop_prob) & (crop[:, 2] > 0)
+            crop = torch.where(do_crop[:, None], crop, torch.cat([torch.zeros_like(extents), w, h], dim = 1))
+
+            x0, y0, cw, ch = crop.unbind(dim = 1)
+            # like get_resize_scale, one scale for both axes, limited by the image extent
+            scale = torch.min(w[:, 0]/cw, h[:, 0]/ch)                                # [batch_size]
+            cropped = (batch_boxes - torch.stack([x0, y0, x0, y0], dim = 1)[:, None])
+            cropped = torch.min(cropped.clamp(min = 0), torch.stack([cw, ch, cw, ch], dim = 1)[:, None] - 1)
+            cropped = cropped * scale[:, None, None]
+            batch_boxes = torch.where((do_crop[:, None] & valid_boxes)[..., None], cropped, batch_boxes)
+
+            resample = torch.nonzero(flip | do_crop).view(-1)
+            if resample.numel() > 0:
+                warped = self._warp(batch_imgs[resample], extents[resample], crop[resample], scale[resample], flip[resample])
+                batch_imgs = batch_imgs.index_copy(0, resample, warped)
+
+        return batch_imgs, batch_boxes
+
+    def _jitter(self, batch_imgs, extents, selected):
+        '''
+        Brightness, contrast, saturation and hue are all affine in rgb, so the jitter of each sample
+        is composed into one 3x3 matrix + offset (in the per-sample random order) and applied in a
+        single pass over the normalized pixels, clipped to [0,1] once at the end. The contrast mean
+        is derived from the per-channel means of the image extent, the hue shift rotates the yiq
+        chroma plane instead of going through hsv.
+        '''
+        if not bool(selected.any()):
+            return batch_imgs
+        idx = torch.nonzero(selected).view(-1)
+        n = idx.numel()
+        device = batch_imgs.device
+        imgs = batch_imgs[idx]
+        H, W = imgs.shape[2:]
+        mean, std, pad_value = self.mean.to(device), self.std.to(device), self.pad_value.to(device)
+        area = extents[idx].prod(dim = 1)                                            # [n]
+        # everything outside the extent is padding
+        channel_mean = (imgs.sum(dim = [2, 3]) - (H*W - area)[:, None]*pad_value)/area[:, None]*std + mean    # [n,3] pixel space
+        A, t = self._jitter_affine(channel_mean)
+
+        # fold the normalization in: y' = diag(1/std) A diag(std) y + (A mean + t - mean)/std
+        A_norm = A * std[None, None, :] / std[None, :, None]
+        t_norm = ((A @ mean[:, None] + t).squeeze(-1) - mean)/std                    # [n,3]
+        out = torch.baddbmm(t_norm[..., None], A_norm, imgs.reshape(n, 3, -1)).view(n, 3, H, W)
+        lo, hi = ((0 - self.mean)/self.std).tolist(), ((1 - self.mean)/self.std).tolist()
+        for ch in range(3):
+            out[:, ch].clamp_(min = lo[ch], max = hi[ch])
+        out = _fill_padding(out, extents[idx], pad_value)
+        return batch_imgs.index_copy(0, idx, out)
+
+    def _jitter_affine(self, channel_mean):
+        '''
+        channel_mean [n,3] per-channel means in pixel space ([0,1])
+        returns the random jitter of each sample as A [n,3,3], t [n,3,1] with pixel' = A pixel + t
+        '''
+        n = channel_mean.shape[0]
+        device = channel_mean.device
+
+        def factor(amount):
+            return (1 - amount + 2 * amount * torch.rand(n, device = device))[:, None, None]
+        b, c, s = factor(self.brightness), factor(self.contrast), factor(self.saturation)
+        angle = (torch.rand(n, device = device) * 2 - 1) * self.hue * 2 * math.pi
+
+        eye = torch.eye(3, device = device).expand(n, 3, 3)
+        gray = _GRAY.to(device).expand(n, 3, 3)                                      # every row is the gray weights
+        yiq = _RGB2YIQ.to(device)
+        rot = torch.eye(3, device = device).repeat(n, 1, 1)
+        rot[:, 1, 1], rot[:, 1, 2] = torch.cos(angle), -torch.sin(angle)
+        rot[:, 2, 1], rot[:, 2, 2] = torch.sin(angle), torch.cos(angle)
+        hue = torch.inverse(yiq) @ rot @ yiq
+        saturation = s*eye + (1 - s)*gray
+
+        A = eye.clone()                                                               # [n,3,3] pixel --> pixel
+        t = torch.zeros(n, 3, 1, device = device)
+        order = torch.rand(n, 4, device = device).argsort(dim = 1)                   # per-sample op order
+        for step in range(4):
+            op = order[:, step, None, None]
+            cur_mean = (gray[:, :1] @ (A @ channel_mean[..., None] + t))                 # [n,1,1] gray mean after the previous ops
+            A_new = torch.where(op == 0, b*A, torch.where(op == 1, c*A, torch.where(op == 2, saturation @ A, hue @ A)))
+            t_new = torch.where(op == 0, b*t, torch.where(op == 1, c*t + (1 - c)*cur_mean, torch.where(op == 2, saturation @ t, hue @ t)))
+            A, t = A_new, t_new
+        return A, t
+
+    def _crop_windows(self, extents, boxes, valid_boxes):
+        '''
+        returns [batch_size,4] (x, y, w, h) of the first of 'attempt_max' random windows that keeps
+        more than remain_min of every box it touches, w = h = 0 when no attempt succeeds
+        '''
+        batch_size, k = extents.shape[0], self.attempt_max
+        device = extents.device
+        h, w = extents[:, 0:1], extents[:, 1:2]                                      # [batch_size,1]
+        target_area = (self.crop_scale_min + (1 - self.crop_scale_min) * torch.rand(batch_size, k, device = device)) * w * h
+        aspect = self.aspect_ratio[0] + (self.aspect_ratio[1] - self.aspect_ratio[0]) * torch.rand(batch_size, k, device = device)
+        cw = torch.round(torch.sqrt(target_area * aspect))
+        ch = torch.round(torch.sqrt(target_area / aspect))
+        swap = torch.rand(batch_size, k, device = device) < 0.5
+        cw, ch = torch.where(swap, ch, cw), torch.where(swap, cw, ch)
+        fits = (cw <= w) & (ch <= h)
+        x = torch.floor(torch.rand(batch_size, k, device = device) * (w - cw + 1)).clamp(min = 0)
+        y = torch.floor(torch.rand(batch_size, k, device = device) * (h - ch + 1)).clamp(min = 0)
+
+        ix = (torch.min(boxes[:, None, :, 2], (x + cw)[..., None]) - torch.max(boxes[:, None, :, 0], x[..., None])).clamp(min = 0)
+        iy = (torch.min(boxes[:, None, :, 3], (y + ch)[..., None]) - torch.max(boxes[:, None, :, 1], y[..., None])).clamp(min = 0)
+        inter = ix * iy                                                              # [batch_size,k,m]
+        area = ((boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1]))[:, None]
+        touched = (inter > 0.0001) & valid_boxes[:, None]
+        ok = fits & ~(touched & ~(inter / area.clamp(min = 1e-6) > self.remain_min)).any(dim = -1)   # [batch_size,k]
+
+        first = torch.where(ok, torch.arange(k, 0, -1, device = device), torch.zeros_like(cw, dtype = torch.long)).argmax(dim = 1)
+        window = torch.stack([x, y, cw, ch], dim = -1).gather(1, first[:, None, None].expand(-1, 1, 4)).squeeze(1)
+        return window * ok.any(dim = 1, keepdim = True)
+
+    def _warp(self, imgs, extents, crop, scale, flip):
+        '''
+        samples output pixel (u,v) of the crop window of the (flipped) image resized by 'scale' to
+        (int(scale * ch), int(scale * cw)), bilinear with pixel centers at +0.5 like cv2.resize,
+        everything beyond is padding
+        '''
+        n, _, H, W = imgs.shape
+        x0, y0, cw, ch = crop.unbind(dim = 1)
+        h, w = extents.unbind(dim = 1)
+        # the limiting side is exactly the extent, the small epsilon keeps float error from losing a pixel
+        nh = torch.min(torch.floor(scale * ch + 1e-3), h)
+        nw = torch.min(torch.floor(scale * cw + 1e-3), w)
+        ax, bx = cw / nw, x0 + 0.5 * cw / nw - 0.5                                   # x_src = ax*u + bx
+        ay, by = ch / nh, y0 + 0.5 * ch / nh - 0.5
+        ax, bx = torch.where(flip, -ax, ax), torch.where(flip, w - 1 - bx, bx)
+
+        theta = torch.zeros(n, 2, 3, device = imgs.device)
+        theta[:, 0, 0] = ax
+        theta[:, 0, 2] = ax - ax / W + (2 * bx + 1) / W - 1
+        theta[:, 1, 1] = ay
+        theta[:, 1, 2] = ay - ay / H + (2 * by + 1) / H - 1
+        grid = F.affine_grid(theta, [n, 3, H, W], align_corners = False)
+        out = F.grid_sample(imgs, grid, mode = 'bilinear', padding_mode = 'border', align_corners = False)
+
+        return _fill_padding(out, torch.stack([nh, nw], dim = 1), self.pad_value)
+
+
+if __name__=="__main__":
+    # per-batch cost of the batched stage on the batch device against the worker cpu time of per-sample Transforms
+    import time
+    import random
+    import numpy as np
+    from PIL import Image
+    from torchvision import transforms
+    from .augment import Transforms
+    from .VOC_dataset import VOCDataset, flip
+
+    torch.manual_seed(0)
+    random.seed(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    augment = BatchAugment(mean, std)
+    for batch_size in [2, 8, 16]:
+        samples = []
+        for i in range(batch_size):
+            img = np.random.randint(0, 255, (375, 500, 3), dtype = np.uint8)
+            boxes = np.array([[50, 60, 200, 220], [300, 100, 450, 300]], dtype = np.float32)
+            samples.append((img, boxes))
+
+        start_t = time.time()
+        for img, boxes in samples:
+            pil_img, pil_boxes = Image.fromarray(img), boxes.copy()
+            if random.random() < 0.5:
+                pil_img, pil_boxes = flip(pil_img, pil_boxes)
+            Transforms()(pil_img, pil_boxes)
+        per_sample = 1000*(time.time()-start_t)
+
+        imgs, boxes_list = [], []
+        for img, boxes in samples:
+            img_paded, boxes = VOCDataset.preprocess_img_boxes(None, img, boxes.copy(), [800, 1333])
+            imgs.append(transforms.Normalize(mean, std)(transforms.ToTensor()(img_paded)))
+            boxes_list.append(torch.from_numpy(boxes))
+        batch_imgs, batch_boxes = torch.stack(imgs).to(device), torch.stack(boxes_list).to(device)
+        batch_classes = torch.ones(batch_size, 2, dtype = torch.long, device = device)
+        batch_img_hw = torch.tensor([[800, 1066]]).expand(batch_size, 2)                 # 375x500 resized, without the 32 alignment
+
+        start_t = time.time()
+        for _ in range(5):
+            imgs, boxes = augment(batch_imgs, batch_boxes, batch_classes, batch_img_hw)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        batched = 1000*(time.time()-start_t)/5
+        assert imgs.shape == batch_imgs.shape and bool((boxes[..., 2:] >= boxes[..., :2]).all())
+        assert bool((boxes >= 0).all()) and bool((boxes[..., 2] <= 1065).all()) and bool((boxes[..., 3] <= 799).all())
+        print("batch_size:%2d  per-sample Transforms (cpu):%.1f ms  BatchAugment (%s):%.1f ms"%(batch_size, per_sample, device.type, batched))
@@ -0,0 +1,30 @@
+import os
+import json
+
+
+# meta.json marks a cache directory as complete: writers drop it before touching the data files
+# and write it last (atomically, through a rename), so an interrupted build is never mistaken
+# for a valid cache by read_meta.
+
+def invalidate_meta(cache_dir):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+def write_meta(cache_dir, meta):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+
+def read_meta(cache_dir, files = ()):
+    '''
+    returns the meta dict, None when the directory is incomplete or one of 'files' is missing
+    '''
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    if not all(os.path.exists(os.path.join(cache_dir, name)) for name in files):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
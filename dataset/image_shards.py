@@ -0,0 +1,104 @@
+import os
+import hashlib
+import numpy as np
+from .cache_meta import invalidate_meta, write_meta, read_meta
+
+
+def _ids_digest(img_ids):
+    return hashlib.md5('\n'.join(img_ids).encode()).hexdigest()
+
+class ShardWriter(object):
+    '''
+    Appends uint8 HWC images to raw shard files 'shard_xxxxx.bin' of about 'shard_size_mb' each.
+    close() writes index.npz with per-image shard id, byte offset, shape and resize scale,
+    and meta.json, which marks the directory as complete.
+    '''
+    def __init__(self, out_dir, img_ids, resize_size, shard_size_mb = 1024):
+        self.out_dir = out_dir
+        self.img_ids = img_ids
+        self.resize_size = list(resize_size)
+        self.shard_size = shard_size_mb*1024*1024
+        self.shard = []
+        self.offset = []
+        self.shape = []
+        self.scale = []
+        self.num_shards = 0
+        self._file = None
+        self._written = 0
+        os.makedirs(out_dir, exist_ok = True)
+        invalidate_meta(out_dir)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(os.path.join(self.out_dir, 'shard_%05d.bin'%self.num_shards), 'wb')
+        self.num_shards += 1
+        self._written = 0
+
+    def append(self, img_paded, resized_hw, scale):
+        if self._file is None or self._written + img_paded.nbytes > self.shard_size:
+            self._next_shard()
+        self.shard.append(self.num_shards - 1)
+        self.offset.append(self._written)
+        self.shape.append([img_paded.shape[0], img_paded.shape[1], resized_hw[0], resized_hw[1]])
+        self.scale.append(scale)
+        self._file.write(np.ascontiguousarray(img_paded, dtype = np.uint8).tobytes())
+        self._written += img_paded.nbytes
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        assert len(self.shard) == len(self.img_ids)
+        np.savez(os.path.join(self.out_dir, 'index.npz'),
+                 shard = np.array(self.shard, dtype = np.int32),
+                 offset = np.array(self.offset, dtype = np.int64),
+                 shape = np.array(self.shape, dtype = np.int32).reshape(-1, 4),
+                 scale = np.array(self.scale, dtype = np.float64))
+        write_meta(self.out_dir, dict(resize_size = self.resize_size,
+                                      num_imgs = len(self.img_ids),
+                                      num_shards = self.num_shards,
+                                      img_ids = _ids_digest(self.img_ids)))
+
+class ImageShards(object):
+    '''
+    Reader for the shards written by preprocess_voc.py. get(index) returns a zero-copy
+    [H,W,3] uint8 view of the padded, resized image (copy-on-write memory map), the
+    (nh, nw) of the resized region and the resize scale applied to the original image.
+    '''
+    def __init__(self, shards_dir, img_ids, resize_size):
+        self.shards_dir = shards_dir
+        meta = read_meta(shards_dir, ['index.npz'])
+        if meta is None:
+            raise FileNotFoundError("no complete image shards in %s, run preprocess_voc.py first"%shards_dir)
+        if meta['img_ids'] != _ids_digest(img_ids) or list(meta['resize_size']) != list(resize_size):
+            raise ValueError("image shards in %s were written for another split or resize_size, run preprocess_voc.py again"%shards_dir)
+        self.num_shards = meta['num_shards']
+
+        index = np.load(os.path.join(shards_dir, 'index.npz'))
+        self.shard = index['shard']
+        self.offset = index['offset']
+        self.shape = index['shape']
+        self.scale = index['scale']
+        self._maps = None
+
+    def _open(self):
+        self._maps = [np.memmap(os.path.join(self.shards_dir, 'shard_%05d.bin'%i), dtype = np.uint8, mode = 'c')
+                      for i in range(self.num_shards)]
+
+    def __getstate__(self):
+        # workers open their own memory maps
+        state = self.__dict__.copy()
+        state['_maps'] = None
+        return state
+
+    def __len__(self):
+        return len(self.shard)
+
+    def get(self, index):
+        if self._maps is None:
+            self._open()
+        h, w, nh, nw = [int(v) for v in self.shape[index]]
+        start = int(self.offset[index])
+        img = self._maps[self.shard[index]][start:start + h*w*3].reshape(h, w, 3)
+
+        return img, (nh, nw), self.scale[index]
@@ -0,0 +1,79 @@
+import torch
+import numpy as np
+
+
+def aspect_ratio_groups(padded_sizes, aspect_ratio_bins = [0.5, 0.75, 1.0, 1.33, 2.0], size_bins = 4):
+    '''
+    padded_sizes [num_imgs,2] (height, width) after resizing, e.g. VOCDataset.padded_sizes()
+    returns group ids [num_imgs] combining the quantized aspect ratio (w/h) with a
+    quantile-based size class of the padded area
+    '''
+    padded_sizes = np.asarray(padded_sizes, dtype = np.float64)
+    aspect = padded_sizes[:, 1]/padded_sizes[:, 0]
+    aspect_group = np.digitize(aspect, aspect_ratio_bins)
+
+    area = padded_sizes[:, 0]*padded_sizes[:, 1]
+    edges = np.unique(np.quantile(area, np.linspace(0, 1, size_bins + 1)[1:-1]))
+    size_group = np.digitize(area, edges)
+
+    return aspect_group*(len(edges) + 1) + size_group
+
+class GroupedBatchSampler(torch.utils.data.Sampler):
+    '''
+    Yields batches whose images all share a group id, so collate_fn pads portrait and
+    landscape images separately. Indices are reshuffled every epoch (seed + epoch), the
+    batches of all groups are then shuffled together. Incomplete group remainders are
+    yielded as smaller batches unless drop_last.
+    '''
+    def __init__(self, group_ids, batch_size, shuffle = True, drop_last = False, seed = 0):
+        self.group_ids = np.asarray(group_ids)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.group_ids)) if self.shuffle else np.arange(len(self.group_ids))
+        batches = []
+        for group in np.unique(self.group_ids):
+            members = order[self.group_ids[order] == group]
+            for start in range(0, len(members), self.batch_size):
+                batch = members[start:start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        return batches
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        counts = np.unique(self.group_ids, return_counts = True)[1]
+        if self.drop_last:
+            return int((counts//self.batch_size).sum())
+        return int(((counts + self.batch_size - 1)//self.batch_size).sum())
+
+def padding_ratio(batches, padded_sizes):
+    '''
+    fraction of the pixels seen by the network that are collate_fn padding
+    returns ratio, total image pixels, total batch pixels
+    '''
+    padded_sizes = np.asarray(padded_sizes, dtype = np.int64)
+    img_pixels = 0
+    batch_pixels = 0
+    for batch in batches:
+        sizes = padded_sizes[batch]
+        img_pixels += int((sizes[:, 0]*sizes[:, 1]).sum())
+        batch_pixels += int(len(batch)*sizes[:, 0].max()*sizes[:, 1].max())
+
+    return 1. - img_pixels/max(batch_pixels, 1), img_pixels, batch_pixels
@@ -1,33 +1,25 @@
-import cv2
+import os
+import argparse
 from model.fcos import FCOSDetector
 import torch
-from torchvision import transforms
 import numpy as np
 from dataset.VOC_dataset import VOCDataset
-import time
-import matplotlib.patches as patches
-import  matplotlib.pyplot as plt
-from matplotlib.ticker import NullLocator
+from inference_runner import InferenceRunner
+from visualize import AsyncRenderer, DetectionWriter
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--img_dir", type = str, default = "./test_images/", help = "directory of the images to detect")
+parser.add_argument("--out_dir", type = str, default = "./out_images/", help = "directory of the rendered images")
+parser.add_argument("--output", type = str, default = None, help = "write detections to a .jsonl or .npz file, no rendering unless --render cv2")
+parser.add_argument("--render", type = str, default = None, choices = ["cv2", "none"], help = "draw detections into out_dir, default cv2 without --output")
+parser.add_argument("--render_workers", type = int, default = 4, help = "threads drawing and encoding the rendered images")
+parser.add_argument("--checkpoint", type = str, default = "./checkpoint/voc_78.7.pth", help = "model weights, or the file written by export_model.py for the torchscript and onnx backends")
+parser.add_argument("--backend", type = str, default = "torch", choices = ["torch", "torchscript", "onnx"], help = "eager model, torch.jit graph or ONNX Runtime on the CPU")
+parser.add_argument("--batch_size", type = int, default = 4, help = "max images of the same padded size per forward pass")
+parser.add_argument("--n_threads", type = int, default = 4, help = "threads decoding and resizing images")
+parser.add_argument("--max_wait_ms", type = float, default = 10, help = "max time an image waits for a full batch")
+parser.add_argument("--device", type = str, default = "cuda" if torch.cuda.is_available() else "cpu", help = "device to run the model on")
 
-def preprocess_img(image,input_ksize):
-    min_side, max_side = input_ksize
-    h,  w, _  = image.shape
-
-    smallest_side = min(w,h)
-    largest_side = max(w,h)
-    scale = min_side/smallest_side 
-    if largest_side*scale>max_side:
-        scale = max_side/largest_side
-    nw, nh  = int(scale * w), int(scale * h)
-    image_resized = cv2.resize(image, (nw, nh))
-
-    pad_w = 32-nw%32
-    pad_h = 32-nh%32
-
-    image_paded = np.zeros(shape = [nh+pad_h, nw+pad_w, 3], dtype = np.uint8)
-    image_paded[:nh, :nw, :] = image_resized
-    return image_paded
-    
 def convertSyncBNtoBN(module):
     module_output = module
     if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
@@ -48,8 +40,6 @@ def convertSyncBNtoBN(module):
     return module_output
 
 if __name__=="__main__":
-    cmap = plt.get_cmap('tab20b')
-    colors = [cmap(i) for i in np.linspace(0, 1, 20)]
     class Config():
         #backbone
         pretrained = False
@@ -80,78 +70,54 @@ if __name__=="__main__":
         nms_iou_threshold = 0.4
         max_detection_boxes_num = 300
 
-    model = FCOSDetector(mode = "inference",
-                         config = Config
-                         )
-    # model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
-    # print("INFO===>success convert BN to SyncBN")
+    opt = parser.parse_args()
+    if opt.backend == "onnx":
+        from model.onnx_backend import OnnxDetector
+        opt.device = "cpu"
+        model = OnnxDetector(opt.checkpoint, Config)
+    elif opt.backend == "torchscript":
+        model = torch.jit.load(opt.checkpoint, map_location = opt.device).eval()
+        model.head.score_threshold = Config.score_threshold
+        model.head.nms_iou_threshold = Config.nms_iou_threshold
+        model.head.max_detection_boxes_num = Config.max_detection_boxes_num
+    else:
+        model = FCOSDetector(mode = "inference",
+                             config = Config
+                             )
+        # model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        # print("INFO===>success convert BN to SyncBN")
     
-    model = torch.nn.DataParallel(model)
-    model.load_state_dict(torch.load("./checkpoint/voc_78.7.pth"
-                                     ,map_location = torch.device('cpu')))
-    # model = convertSyncBNtoBN(model)
-    # print("INFO===>success convert SyncBN to BN")
+        model = torch.nn.DataParallel(model)
+        model.load_state_dict(torch.load(opt.checkpoint
+                                         ,map_location = torch.device('cpu')))
+        # model = convertSyncBNtoBN(model)
+        # print("INFO===>success convert SyncBN to BN")
     
-    model = model.eval()
+        model = model.to(opt.device).eval()
     print("===>success loading model")
 
-    import os
-    root = "./test_images/"
-    names = os.listdir(root)
-    for name in names:
-        img_bgr = cv2.imread(root+name)
-        img_pad = preprocess_img(img_bgr,[800,1333])
-        img = cv2.cvtColor(img_pad.copy(),cv2.COLOR_BGR2RGB)
-        img1 = transforms.ToTensor()(img)
-        img1 = transforms.Normalize([0.485,0.456,0.406], 
-                                    [0.229,0.224,0.225],
-                                    inplace = True)(img1)
-        img1 = img1
-        
-
-        start_t = time.time()
-        with torch.no_grad():
-            out = model(img1.unsqueeze_(dim = 0))
-        end_t = time.time()
-        cost_t = 1000*(end_t-start_t)
-        print("===>success processing img, cost time %.2f ms"%cost_t)
-        # print(out)
-        scores, classes, boxes = out
-
-        boxes = boxes[0].cpu().numpy().tolist()
-        classes = classes[0].cpu().numpy().tolist()
-        scores = scores[0].cpu().numpy().tolist()
-        plt.figure()
-        fig, ax = plt.subplots(1)
-        ax.imshow(img)
-        for i,box in enumerate(boxes):
-            pt1 = (int(box[0]),int(box[1]))
-            pt2 = (int(box[2]),int(box[3]))
-            img_pad = cv2.rectangle(img_pad, pt1, pt2, (0,255,0))
-            b_color = colors[int(classes[i]) - 1]
-            bbox = patches.Rectangle((box[0], box[1]), 
-                                     width = box[2]-box[0],
-                                     height = box[3]-box[1],
-                                     linewidth = 1,
-                                     facecolor = 'none',
-                                     edgecolor = b_color
-                                     )
-            ax.add_patch(bbox)
-            plt.text(box[0], box[1], 
-                     s = "%s %.3f"%(VOCDataset.CLASSES_NAME[int(classes[i])],scores[i]), 
-                     color = 'white',
-                     verticalalignment = 'top',
-                     bbox = {'color': b_color, 'pad': 0})
-        plt.axis('off')
-        plt.gca().xaxis.set_major_locator(NullLocator())
-        plt.gca().yaxis.set_major_locator(NullLocator())
-        plt.savefig('out_images/{}'.format(name), 
-                    bbox_inches = 'tight', 
-                    pad_inches = 0.0
-                    )
-        plt.close()
-
-
-
-
-
+    if opt.render is None:
+        opt.render = "none" if opt.output else "cv2"
+    writer = DetectionWriter(opt.output, VOCDataset.CLASSES_NAME) if opt.output else None
+    renderer = AsyncRenderer(opt.out_dir, VOCDataset.CLASSES_NAME, opt.render_workers) if opt.render == "cv2" else None
+
+    def sink(result):
+        # runs on the writer thread of the runner, drawing goes on to the render pool
+        if writer is not None:
+            writer.write(result)
+        if renderer is not None:
+            renderer.submit(result)
+
+    names = sorted(os.listdir(opt.img_dir))
+    runner = InferenceRunner(model, [800,1333],
+                             batch_size = opt.batch_size,
+                             num_threads = opt.n_threads,
+                             max_wait_ms = opt.max_wait_ms,
+                             device = opt.device)
+    stats = runner.run([os.path.join(opt.img_dir, name) for name in names], sink = sink)
+    if writer is not None:
+        writer.close()
+    if renderer is not None:
+        renderer.close()
+    print("===>%d imgs in %.2f s, %.2f imgs/s, latency p50 %.2f ms, p99 %.2f ms"%(stats['num_imgs'], stats['cost_time'],
+          stats['imgs_per_s'], stats['latency_p50'], stats['latency_p99']))
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import torch
+from model.fcos import DetectHead
+from dataset.VOC_dataset import get_resize_scale
+from dataset.cache_meta import invalidate_meta, write_meta, read_meta
+
+
+def checkpoint_hash(path, chunk_size = 1<<24):
+    '''
+    md5 of the checkpoint file content, a retrained model saved under the same name gets a new cache
+    '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+class DetectionCache(object):
+    '''
+    On-disk cache of the top-k candidates of every image of an eval split, taken before the
+    score threshold, nms and box clipping (FCOSDetector mode "topk")
+        scores  [num_imgs,k]   float32, descending per image
+        classes [num_imgs,k]   int16
+        boxes   [num_imgs,k,4] float32, unclipped
+        clip_hw [num_imgs,2]   int32, padded (height, width) of the batch the image was run in
+    stored as .npy files under cache_root/<key>, key = (checkpoint hash, dataset root and split,
+    image ids, resize_size, k). Changing score_threshold, nms_iou_threshold, max detections or
+    the metric only replays post-processing and evaluation from the memory maps.
+    '''
+    FILES = ['scores', 'classes', 'boxes', 'clip_hw']
+
+    def __init__(self, cache_root, checkpoint_path, dataset, topk):
+        self.dataset = dataset
+        self.topk = topk
+        self.key = dict(checkpoint = checkpoint_hash(checkpoint_path),
+                        root = os.path.abspath(dataset.root),
+                        split = dataset.imgset,
+                        img_ids = hashlib.md5("\n".join(dataset.img_ids).encode()).hexdigest(),
+                        resize_size = list(dataset.resize_size),
+                        topk = topk)
+        digest = hashlib.md5(json.dumps(self.key, sort_keys = True).encode()).hexdigest()
+        self.cache_dir = os.path.join(cache_root, "%s_%s_%s"%(dataset.imgset, "x".join(map(str, dataset.resize_size)), digest[:16]))
+        self._arrays = None
+
+    def complete(self):
+        meta = read_meta(self.cache_dir, ['%s.npy'%name for name in self.FILES])
+        return meta is not None and meta.get('key') == self.key
+
+    def fill(self, model, loader, device = 'cuda'):
+        '''
+        model in mode "topk" (DataParallel is fine), loader over the same dataset in order (shuffle = False)
+        '''
+        num_imgs = len(self.dataset)
+        os.makedirs(self.cache_dir, exist_ok = True)
+        invalidate_meta(self.cache_dir)
+        arrays = dict(scores = self._open('scores', np.float32, (num_imgs, self.topk)),
+                      classes = self._open('classes', np.int16, (num_imgs, self.topk)),
+                      boxes = self._open('boxes', np.float32, (num_imgs, self.topk, 4)),
+                      clip_hw = self._open('clip_hw', np.int32, (num_imgs, 2)))
+
+        start_t = time.time()
+        num = 0
+        for img, _, _ in loader:
+            with torch.no_grad():
+                scores, classes, boxes = model(img.to(device, non_blocking = True))
+            assert scores.shape[1] == self.topk, "===>model max_detection_boxes_num does not match the cache topk"
+            end = num + len(img)
+            arrays['scores'][num:end] = scores.cpu().numpy()
+            arrays['classes'][num:end] = classes.cpu().numpy()
+            arrays['boxes'][num:end] = boxes.cpu().numpy()
+            arrays['clip_hw'][num:end] = img.shape[2:]
+            num = end
+            print(num, end = '\r')
+        assert num == num_imgs, "===>loader yielded %d of %d imgs"%(num, num_imgs)
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+        write_meta(self.cache_dir, dict(key = self.key, num_imgs = num_imgs))
+        print("INFO===>cached top-%d detections of %d imgs in %s, cost time %.1f s"%(self.topk, num_imgs, self.cache_dir, time.time()-start_t))
+
+    def _open(self, name, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(self.cache_dir, '%s.npy'%name), mode = 'w+', dtype = dtype, shape = shape)
+
+    def _load(self):
+        self._arrays = {name: np.load(os.path.join(self.cache_dir, '%s.npy'%name), mmap_mode = 'r')
+                        for name in self.FILES}
+
+    def replay(self, score_threshold, nms_iou_threshold, max_detection_boxes_num = None, batch_size = 64, device = 'cpu'):
+        '''
+        post-processes the cached candidates like FCOSDetector inference does and yields per batch
+        scores, classes [batch_size,n], boxes [batch_size,n,4], num_dets [batch_size],
+        gt_boxes [batch_size,m,4], gt_classes [batch_size,m] padded with -1, scales [batch_size]
+        i.e. the arguments of StreamingEvaluator.add. max_detection_boxes_num <= topk keeps only
+        the best candidates, as a smaller top-k in DetectHead would.
+        '''
+        if self._arrays is None:
+            self._load()
+        max_num = self.topk if max_detection_boxes_num is None else min(max_detection_boxes_num, self.topk)
+        head = DetectHead(score_threshold, nms_iou_threshold, max_num, strides = None)
+        sizes = self.dataset.img_sizes()
+        scales = np.array([get_resize_scale(h, w, self.dataset.resize_size) for h, w in sizes])
+
+        for start in range(0, len(self.dataset), batch_size):
+            end = min(start + batch_size, len(self.dataset))
+            scores = torch.from_numpy(np.array(self._arrays['scores'][start:end, :max_num])).to(device)
+            # candidates are sorted by score, those above the threshold are a prefix of every row
+            n = int((scores >= score_threshold).sum(dim = 1).max())
+            scores = scores[:, :n]
+            classes = torch.from_numpy(self._arrays['classes'][start:end, :n].astype(np.int64)).to(device)
+            boxes = torch.from_numpy(np.array(self._arrays['boxes'][start:end, :n])).to(device)
+
+            scores, classes, boxes, num_dets = head._post_process([scores, classes, boxes])
+            # same clamps as ClipBoxes, with the padded size of the batch each image was run in
+            clip_hw = torch.from_numpy(self._arrays['clip_hw'][start:end].astype(np.float32)).to(device)
+            boxes = boxes.clamp_(min = 0)
+            boxes[..., [0, 2]] = torch.min(boxes[..., [0, 2]], clip_hw[:, None, None, 1] - 1)
+            boxes[..., [1, 3]] = torch.min(boxes[..., [1, 3]], clip_hw[:, None, None, 0] - 1)
+
+            gt = [self.dataset.load_anno(i) for i in range(start, end)]
+            max_gt = max(len(c) for _, c in gt)
+            gt_boxes = torch.full([end - start, max_gt, 4], -1, dtype = torch.float32)
+            gt_classes = torch.full([end - start, max_gt], -1, dtype = torch.int64)
+            for i, (_boxes, _classes) in enumerate(gt):
+                # same arithmetic as preprocess_img_boxes
+                _boxes[:, [0, 2]] = _boxes[:, [0, 2]] * float(scales[start + i])
+                _boxes[:, [1, 3]] = _boxes[:, [1, 3]] * float(scales[start + i])
+                gt_boxes[i, :len(_classes)] = torch.from_numpy(_boxes)
+                gt_classes[i, :len(_classes)] = torch.from_numpy(_classes)
+
+            yield scores, classes, boxes, num_dets, gt_boxes, gt_classes, scales[start:end]
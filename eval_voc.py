@@ -1,6 +1,11 @@
+import os
+import tempfile
 import torch
 import numpy as np
 import cv2
+from multiprocessing import Pool
+import threading
+import queue
 
 def sort_by_score(pred_boxes, pred_labels, pred_scores):
     score_seq = [(-score).argsort() for index, score in enumerate(pred_scores)]
@@ -38,9 +43,8 @@ def _compute_ap(recall, precision):
     mrec = np.concatenate(([0.], recall, [1.]))
     mpre = np.concatenate(([0.], precision, [0.]))
 
-    # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    # compute the precision envelope, a running max from the right
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -51,6 +55,26 @@ def _compute_ap(recall, precision):
     
     return ap
 
+def _match_image(gt_boxes, gt_labels, pred_boxes, pred_labels, iou_thread):
+    '''
+    greedy matching of all predictions of one image, in their given order, against the gts of
+    their class: one [m,g] IoU matrix, other classes masked out. A prediction is a tp when its
+    best gt (first maximum) reaches iou_thread and no earlier prediction took that gt.
+    returns tp [m] bool
+    '''
+    tp = np.zeros(len(pred_labels), dtype = np.bool_)
+    if len(pred_labels) == 0 or len(gt_labels) == 0:
+        return tp
+    iou = iou_2d(pred_boxes, gt_boxes)                                          # [m,g]
+    iou = np.where(pred_labels[:, None] == gt_labels[None, :], iou, -np.inf)
+    gt_for_box = np.argmax(iou, axis = 1)                                       # [m]
+    max_overlap = iou[np.arange(len(gt_for_box)), gt_for_box]
+    candidates = np.nonzero(max_overlap >= iou_thread)[0]
+    # the first candidate of every gt wins, later ones are fp
+    _, first = np.unique(gt_for_box[candidates], return_index = True)
+    tp[candidates[first]] = True
+    return tp
+
 def eval_ap_2d(gt_boxes,           # list of 2d array,shape[(a,(x1,y1,x2,y2)),(b,(x1,y1,x2,y2))...] 
                gt_labels,          # list of 1d array,shape[(a),(b)...],value is sparse label index
                pred_boxes,         # list of 2d array, shape[(m,(x1,y1,x2,y2)),(n,(x1,y1,x2,y2))...]
@@ -58,104 +82,512 @@ def eval_ap_2d(gt_boxes,           # list of 2d array,shape[(a,(x1,y1,x2,y2)),(b
                pred_scores,        # list of 1d array,shape[(m),(n)...]
                iou_thread, 
                num_cls):           # total number of class including background which is equal to 0
+    '''
+    Same AP as the previous per-box loop (benchmark.eval_ap_2d_loop). Every image is matched
+    once for all classes, the tp flags go into one preallocated array in image order, so the
+    per-class arrays are plain masks of it and keep the order (and the score ties) of the reference.
+    '''
+    num_preds = [len(sample_labels) for sample_labels in pred_labels]
+    tp_all = np.zeros(sum(num_preds), dtype = np.float64)
+    start = 0
+    for sample_gts, sample_gt_labels, sample_pred_box, sample_pred_labels, n in zip(gt_boxes, gt_labels, pred_boxes, pred_labels, num_preds):
+        tp_all[start:start+n] = _match_image(sample_gts, sample_gt_labels, sample_pred_box, sample_pred_labels, iou_thread)
+        start += n
+
+    labels_all = np.concatenate([np.zeros((0,), dtype = np.int64)] + list(pred_labels))
+    scores_all = np.concatenate([np.zeros((0,))] + list(pred_scores)).astype(np.float64)
+    gt_labels_all = np.concatenate([np.zeros((0,), dtype = np.int64)] + list(gt_labels))
 
     all_ap = {}
     for label in range(num_cls)[1:]:
-        # get samples with specific label
-        true_label_loc = [sample_labels == label for sample_labels in gt_labels]
-        gt_single_cls = [sample_boxes[mask] for sample_boxes, mask in zip(gt_boxes, true_label_loc)]
-
-        pred_label_loc = [sample_labels == label for sample_labels in pred_labels]
-        bbox_single_cls = [sample_boxes[mask] for sample_boxes, mask in zip(pred_boxes, pred_label_loc)]
-        scores_single_cls = [sample_scores[mask] for sample_scores, mask in zip(pred_scores, pred_label_loc)]
-
-        fp = np.zeros((0,))
-        tp = np.zeros((0,))
-        scores = np.zeros((0,))
-        total_gts = 0
-        # loop for each sample
-        for sample_gts, sample_pred_box, sample_scores in zip(gt_single_cls, bbox_single_cls, scores_single_cls):
-            total_gts = total_gts + len(sample_gts)
-            assigned_gt = []  # one gt can only be assigned to one predicted bbox
-            # loop for each predicted bbox
-            for index in range(len(sample_pred_box)):
-                scores = np.append(scores, sample_scores[index])
-                if len(sample_gts) == 0:  # if no gts found for the predicted bbox, assign the bbox to fp
-                    fp = np.append(fp, 1)
-                    tp = np.append(tp, 0)
-                    continue
-                pred_box = np.expand_dims(sample_pred_box[index], axis = 0)
-                iou = iou_2d(sample_gts, pred_box)
-                gt_for_box = np.argmax(iou, axis = 0)
-                max_overlap = iou[gt_for_box, 0]
-                if max_overlap >= iou_thread and gt_for_box not in assigned_gt:
-                    fp = np.append(fp, 0)
-                    tp = np.append(tp, 1)
-                    assigned_gt.append(gt_for_box)
-                else:
-                    fp = np.append(fp, 1)
-                    tp = np.append(tp, 0)
-        # sort by score
-        indices = np.argsort(-scores)
-        fp = fp[indices]
-        tp = tp[indices]
-        # compute cumulative false positives and true positives
-        fp = np.cumsum(fp)
-        tp = np.cumsum(tp)
-        # compute recall and precision
-        recall = tp / total_gts
-        precision = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-        ap = _compute_ap(recall, precision)
-        all_ap[label] = ap
-        # print(recall, precision)
+        mask = labels_all == label
+        all_ap[label] = _ap_from_tp(scores_all[mask], tp_all[mask], int(np.sum(gt_labels_all == label)))
     
     return all_ap               # a dict containing average precision for each cls
 
+def _ap_from_tp(scores, tp, total_gts):
+    '''
+    scores, tp [n] of one class in image order, as the per-box loop builds them
+    '''
+    # sort by score
+    indices = np.argsort(-scores)
+    tp = tp[indices]
+    fp = 1. - tp
+    # compute cumulative false positives and true positives
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    # compute recall and precision
+    recall = tp / total_gts
+    precision = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    return _compute_ap(recall, precision)
+
+def _iou_pairs(boxes_a, boxes_b):
+    '''
+    element-wise (broadcast) version of iou_2d, same arithmetic
+    '''
+    overlap = np.maximum(0.0,
+                         np.minimum(boxes_a[..., 2:], boxes_b[..., 2:]) -
+                         np.maximum(boxes_a[..., :2], boxes_b[..., :2]))
+    overlap = np.prod(overlap, axis = -1)
+    area_a = np.prod(boxes_a[..., 2:] - boxes_a[..., :2], axis = -1)
+    area_b = np.prod(boxes_b[..., 2:] - boxes_b[..., :2], axis = -1)
+    return overlap / (area_a + area_b - overlap)
+
+def _match_class(pred_boxes, pred_img, gt_boxes, gt_img, num_imgs, iou_threads, chunk_size = 65536):
+    '''
+    the greedy matching of _match_image for one class over all images at once, for every
+    threshold of iou_threads [T]. pred_* in image-major order, gt_* in image order. Every
+    prediction is compared with the gts of its image, padded to the largest per-image count and
+    masked with -inf. The best gt and its overlap do not depend on the threshold, they are
+    computed once and only the first-come rule runs per threshold.
+    returns tp [T,m] bool
+    '''
+    tp = np.zeros((len(iou_threads), len(pred_img)), dtype = np.bool_)
+    if len(pred_img) == 0 or len(gt_img) == 0:
+        return tp
+    gt_count = np.bincount(gt_img, minlength = num_imgs)
+    gt_start = np.cumsum(gt_count) - gt_count
+    slots = np.arange(gt_count.max())
+
+    max_overlap = np.empty(len(pred_img))
+    matched_gt = np.empty(len(pred_img), dtype = np.int64)
+    for start in range(0, len(pred_img), chunk_size):
+        img = pred_img[start:start+chunk_size]
+        valid = slots[None, :] < gt_count[img][:, None]                                 # [m,max_gts]
+        gt_idx = np.where(valid, gt_start[img][:, None] + slots[None, :], 0)
+        iou = np.where(valid, _iou_pairs(pred_boxes[start:start+chunk_size, None, :], gt_boxes[gt_idx]), -np.inf)
+        gt_for_box = np.argmax(iou, axis = 1)
+        max_overlap[start:start+len(img)] = iou[np.arange(len(img)), gt_for_box]
+        matched_gt[start:start+len(img)] = gt_idx[np.arange(len(img)), gt_for_box]
+    for t, iou_thread in enumerate(iou_threads):
+        candidates = np.nonzero(max_overlap >= iou_thread)[0]
+        _, first = np.unique(matched_gt[candidates], return_index = True)
+        tp[t, candidates[first]] = True
+    return tp
+
+_inputs = None
+
+def _shared_memory_dir():
+    '''
+    /dev/shm is tmpfs on linux, so .npy files there are shared memory pages that every worker
+    maps without a disk round trip (multiprocessing.shared_memory needs python 3.8).
+    falls back to the default temporary directory elsewhere
+    '''
+    shm = '/dev/shm'
+    return shm if os.path.isdir(shm) and os.access(shm, os.W_OK) else None
+
+def _init_ap_worker(input_dir, keys):
+    global _inputs
+    _inputs = {key: np.load(os.path.join(input_dir, key + '.npy'), mmap_mode = 'r') for key in keys}
+
+def _class_aps(label):
+    '''
+    work item label --> [ap per threshold], reading its slice of the label-sorted inputs from _inputs
+    '''
+    p0, p1 = _inputs['pred_offsets'][label], _inputs['pred_offsets'][label+1]
+    g0, g1 = _inputs['gt_offsets'][label], _inputs['gt_offsets'][label+1]
+    tp = _match_class(_inputs['pred_boxes'][p0:p1], _inputs['pred_img'][p0:p1],
+                      _inputs['gt_boxes'][g0:g1], _inputs['gt_img'][g0:g1],
+                      int(_inputs['num_imgs'][0]), _inputs['iou_threads'])
+    scores = np.asarray(_inputs['pred_scores'][p0:p1])
+    return [_ap_from_tp(scores, tp_t.astype(np.float64), int(g1 - g0)) for tp_t in tp]
+
+def eval_ap_2d_parallel(gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores, iou_threads, num_cls, num_workers = 8):
+    '''
+    eval_ap_2d for several IoU thresholds, one work item per class (all thresholds share its
+    IoU matrix) spread over a process pool. The inputs are concatenated and sorted by label once,
+    so an item reads one contiguous slice; workers get them as read-only np.memmap of .npy files
+    in a temporary directory under /dev/shm when available. num_workers is capped by the cpu count and the number of
+    classes, 0 (or a single cpu) runs the same work items in this process.
+    returns {iou_thread: {label: ap}}, equal to eval_ap_2d(..., iou_thread, num_cls) for every threshold
+    '''
+    global _inputs
+    num_preds = [len(sample_labels) for sample_labels in pred_labels]
+    num_gts = [len(sample_labels) for sample_labels in gt_labels]
+    all_pred_labels = np.concatenate([np.zeros((0,), dtype = np.int64)] + list(pred_labels)).astype(np.int64)
+    all_gt_labels = np.concatenate([np.zeros((0,), dtype = np.int64)] + list(gt_labels)).astype(np.int64)
+    # stable, image-major order is kept inside every class
+    pred_order = np.argsort(all_pred_labels, kind = 'stable')
+    gt_order = np.argsort(all_gt_labels, kind = 'stable')
+    arrays = dict(pred_boxes = np.concatenate([np.zeros((0, 4), dtype = np.float32)] + list(pred_boxes)).astype(np.float32)[pred_order],
+                  pred_scores = np.concatenate([np.zeros((0,))] + list(pred_scores)).astype(np.float64)[pred_order],
+                  pred_img = np.repeat(np.arange(len(num_preds)), num_preds)[pred_order],
+                  pred_offsets = np.searchsorted(all_pred_labels[pred_order], np.arange(num_cls + 1)),
+                  gt_boxes = np.concatenate([np.zeros((0, 4), dtype = np.float32)] + list(gt_boxes)).astype(np.float32)[gt_order],
+                  gt_img = np.repeat(np.arange(len(num_gts)), num_gts)[gt_order],
+                  gt_offsets = np.searchsorted(all_gt_labels[gt_order], np.arange(num_cls + 1)),
+                  num_imgs = np.array([len(gt_labels)]),
+                  iou_threads = np.array(iou_threads, dtype = np.float64))
+    labels = list(range(num_cls)[1:])
+    num_workers = min(num_workers, os.cpu_count() or 1, len(labels))
+
+    if num_workers <= 1:
+        _inputs = arrays
+        try:
+            aps = [_class_aps(label) for label in labels]
+        finally:
+            _inputs = None
+    else:
+        with tempfile.TemporaryDirectory(dir = _shared_memory_dir()) as input_dir:
+            for key, value in arrays.items():
+                np.save(os.path.join(input_dir, key + '.npy'), value)
+            with Pool(num_workers, initializer = _init_ap_worker, initargs = (input_dir, list(arrays))) as pool:
+                aps = pool.map(_class_aps, labels, chunksize = 1)
+
+    results = {float(iou_thread): {} for iou_thread in iou_threads}
+    for label, class_aps in zip(labels, aps):
+        for iou_thread, ap in zip(iou_threads, class_aps):
+            results[float(iou_thread)][label] = ap
+    return results
+
+COCO_AREA_RANGES = [('all', 0., 1e5**2), ('small', 0., 32.**2), ('medium', 32.**2, 96.**2), ('large', 96.**2, 1e5**2)]
+
+def eval_coco_2d(gt_boxes,           # list of 2d array,shape[(a,(x1,y1,x2,y2)),(b,(x1,y1,x2,y2))...]
+                 gt_labels,          # list of 1d array,shape[(a),(b)...]
+                 pred_boxes,         # list of 2d array, shape[(m,(x1,y1,x2,y2)),(n,(x1,y1,x2,y2))...]
+                 pred_labels,        # list of 1d array,shape[(m),(n)...]
+                 pred_scores,        # list of 1d array,shape[(m),(n)...]
+                 num_cls,            # total number of class including background which is equal to 0
+                 iou_threads = np.linspace(.5, 0.95, 10),
+                 area_ranges = COCO_AREA_RANGES,
+                 max_dets = [1, 10, 100]):
+    '''
+    COCO bbox protocol (pycocotools evaluateImg + accumulate) for every IoU threshold, area range
+    and max_dets in one pass. The IoU of every prediction with the gts of its (image, class) is
+    computed once. Matching walks the score ranks once, all (image, class) groups and all
+    thresholds and area ranges at the same time: a prediction takes the best unmatched gt with
+    IoU >= threshold, gts outside the area range only when no other gt qualifies, and is then
+    ignored. Unmatched predictions outside the area range are ignored too. Areas are w*h of
+    the boxes as given, pass boxes in original image pixels for the usual small/medium/large.
+    returns dict(precision [T,101,K,A,M], recall [T,K,A,M], -1 where a class has no gts,
+                 stats: the 12 numbers of COCOeval.summarize)
+    '''
+    dets, gts = _coco_match(gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores, num_cls, iou_threads, area_ranges, max_dets)
+    return _coco_accumulate(dets, gts, num_cls, iou_threads, area_ranges, max_dets)
+
+def _coco_match(gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores, num_cls, iou_threads, area_ranges, max_dets):
+    '''
+    per-image part of eval_coco_2d. Returns the per-prediction records, in (image, class, score)
+    order, and the per-gt labels and area ignore flags. Records of consecutive image chunks can
+    be concatenated, see StreamingEvaluator.
+    '''
+    T, A = len(iou_threads), len(area_ranges)
+    num_imgs = len(gt_labels)
+
+    p_img = np.repeat(np.arange(num_imgs), [len(l) for l in pred_labels])
+    p_label = np.concatenate([np.zeros((0,), dtype = np.int64)] + list(pred_labels)).astype(np.int64)
+    p_box = np.concatenate([np.zeros((0, 4))] + list(pred_boxes)).astype(np.float64)
+    p_score = np.concatenate([np.zeros((0,))] + list(pred_scores)).astype(np.float64)
+    g_img = np.repeat(np.arange(num_imgs), [len(l) for l in gt_labels])
+    g_label = np.concatenate([np.zeros((0,), dtype = np.int64)] + list(gt_labels)).astype(np.int64)
+    g_box = np.concatenate([np.zeros((0, 4))] + list(gt_boxes)).astype(np.float64)
+
+    # predictions by (image, class), score descending, stable like pycocotools; keep max(max_dets) each
+    p_group = p_img*num_cls + p_label
+    order = np.lexsort((-p_score, p_group))
+    p_group, p_label, p_box, p_score = p_group[order], p_label[order], p_box[order], p_score[order]
+    _, group_start, group_inverse = np.unique(p_group, return_index = True, return_inverse = True)
+    rank = np.arange(len(p_group)) - group_start[group_inverse.reshape(-1)]
+    keep = rank < max(max_dets)
+    p_group, p_label, p_box, p_score, rank = p_group[keep], p_label[keep], p_box[keep], p_score[keep], rank[keep]
+    P = len(p_group)
+
+    g_group = g_img*num_cls + g_label
+    g_order = np.argsort(g_group, kind = 'stable')
+    g_group, g_label, g_box = g_group[g_order], g_label[g_order], g_box[g_order]
+    G = len(g_group)
+
+    g_area = (g_box[:, 2] - g_box[:, 0])*(g_box[:, 3] - g_box[:, 1])
+    p_area = (p_box[:, 2] - p_box[:, 0])*(p_box[:, 3] - p_box[:, 1])
+    lo = np.array([r[1] for r in area_ranges])[:, None]
+    hi = np.array([r[2] for r in area_ranges])[:, None]
+    g_ignore = (g_area[None] < lo) | (g_area[None] > hi)                               # [A,G]
+    p_outside = (p_area[None] < lo) | (p_area[None] > hi)                              # [A,P]
+
+    # IoU with the gts of the same (image, class), computed once
+    g_first = np.searchsorted(g_group, p_group, side = 'left')
+    g_count = np.searchsorted(g_group, p_group, side = 'right') - g_first
+    max_gts = int(g_count.max()) if P > 0 else 0
+    slots = np.arange(max_gts)
+    g_valid = slots[None, :] < g_count[:, None]                                        # [P,max_gts]
+    g_idx = np.where(g_valid, g_first[:, None] + slots[None, :], 0)
+    iou = np.where(g_valid, _iou_pairs(p_box[:, None, :], g_box[g_idx]), -1.) if G > 0 else np.zeros((P, 0))
+
+    threads = np.minimum(np.asarray(iou_threads, dtype = np.float64), 1-1e-10)
+    gt_taken = np.zeros((G, A, T), dtype = np.bool_)
+    p_matched = np.zeros((P, A, T), dtype = np.bool_)
+    p_ignored = np.zeros((P, A, T), dtype = np.bool_)
+    for r in range(int(rank.max()) + 1 if P > 0 else 0):
+        sel = np.nonzero((rank == r) & (g_count > 0))[0]
+        if len(sel) == 0:
+            continue
+        n = len(sel)
+        io = iou[sel][:, None, None, :]                                                 # [n,1,1,max_gts]
+        idx = g_idx[sel]
+        ignored = g_ignore[:, idx].transpose(1, 0, 2)[:, :, None, :]                   # [n,A,1,max_gts]
+        free = g_valid[sel][:, None, None, :] & ~gt_taken[idx].transpose(0, 2, 3, 1)   # [n,A,T,max_gts]
+        candidate = free & (io >= threads[None, None, :, None])
+        # not ignored gts first, then the highest IoU, the last of equal ones like pycocotools
+        priority = np.where(candidate, io + 2.*~ignored, -1.)
+        best = max_gts - 1 - np.argmax(priority[..., ::-1], axis = -1)                 # [n,A,T]
+        hit = np.take_along_axis(priority, best[..., None], axis = -1)[..., 0] >= 0
+        gt_hit = idx[np.arange(n)[:, None, None], best]
+        a_hit, t_hit = np.nonzero(hit)[1:]
+        gt_taken[gt_hit[hit], a_hit, t_hit] = True
+        p_matched[sel] = hit
+        p_ignored[sel] = hit & np.take_along_axis(np.broadcast_to(ignored, priority.shape), best[..., None], axis = -1)[..., 0]
+    p_ignored |= ~p_matched & p_outside.T[:, :, None]
+
+    return (dict(label = p_label, score = p_score, rank = rank, matched = p_matched, ignored = p_ignored),
+            dict(label = g_label, ignored = g_ignore))
+
+def _coco_accumulate(dets, gts, num_cls, iou_threads, area_ranges, max_dets):
+    T, A, M = len(iou_threads), len(area_ranges), len(max_dets)
+    K = num_cls - 1
+    rec_threads = np.linspace(.0, 1.00, 101)
+    p_label, p_score, rank, p_matched, p_ignored = dets['label'], dets['score'], dets['rank'], dets['matched'], dets['ignored']
+    g_label, g_ignore = gts['label'], gts['ignored']
+
+    precision = -np.ones((T, len(rec_threads), K, A, M))
+    recall = -np.ones((T, K, A, M))
+    for k, label in enumerate(range(num_cls)[1:]):
+        in_class = p_label == label
+        gt_in_class = g_label == label
+        for a in range(A):
+            num_pos = int(np.sum(gt_in_class & ~g_ignore[a]))
+            if num_pos == 0:
+                continue
+            for m, max_det in enumerate(max_dets):
+                mask = in_class & (rank < max_det)
+                order = np.argsort(-p_score[mask], kind = 'mergesort')
+                matched = p_matched[mask][order][:, a].T                                # [T,nd]
+                ignored = p_ignored[mask][order][:, a].T
+                tp = np.cumsum(matched & ~ignored, axis = 1).astype(np.float64)
+                fp = np.cumsum(~matched & ~ignored, axis = 1).astype(np.float64)
+                nd = tp.shape[1]
+                if nd == 0:
+                    recall[:, k, a, m] = 0
+                    precision[:, :, k, a, m] = 0
+                    continue
+                rc = tp / num_pos
+                pr = tp / (fp + tp + np.spacing(1))
+                pr = np.maximum.accumulate(pr[:, ::-1], axis = 1)[:, ::-1]             # precision envelope
+                recall[:, k, a, m] = rc[:, -1]
+                for t in range(T):
+                    inds = np.searchsorted(rc[t], rec_threads, side = 'left')
+                    q = np.zeros(len(rec_threads))
+                    q[inds < nd] = pr[t][inds[inds < nd]]
+                    precision[t, :, k, a, m] = q
+
+    def _summarize(values, iou_thread = None):
+        if iou_thread is not None:
+            values = values[np.isclose(iou_threads, iou_thread)]
+        values = values[values > -1]
+        return float(np.mean(values)) if values.size else -1.
+
+    m_last = M - 1
+    stats = [_summarize(precision[:, :, :, 0, m_last]),
+             _summarize(precision[:, :, :, 0, m_last], .5),
+             _summarize(precision[:, :, :, 0, m_last], .75)]
+    stats += [_summarize(precision[:, :, :, a, m_last]) for a in range(1, A)]
+    stats += [_summarize(recall[:, :, 0, m]) for m in range(M)]
+    stats += [_summarize(recall[:, :, a, m_last]) for a in range(1, A)]
+
+    return dict(precision = precision, recall = recall, stats = stats)
+
+def print_coco_table(results, id2name = None, area_ranges = COCO_AREA_RANGES, max_dets = [1, 10, 100]):
+    '''
+    COCOeval.summarize style AP/AR table and a per-class AP@[.5:.95] / AP50 table
+    '''
+    names = [r[0] for r in area_ranges]
+    rows = [("AP", "0.50:0.95", names[0], max_dets[-1]), ("AP", "0.50", names[0], max_dets[-1]), ("AP", "0.75", names[0], max_dets[-1])]
+    rows += [("AP", "0.50:0.95", name, max_dets[-1]) for name in names[1:]]
+    rows += [("AR", "0.50:0.95", names[0], m) for m in max_dets]
+    rows += [("AR", "0.50:0.95", name, max_dets[-1]) for name in names[1:]]
+    for (metric, iou, area, max_det), value in zip(rows, results['stats']):
+        print(" Average %-9s (%s) @[ IoU=%-9s | area=%6s | maxDets=%3d ] = %.3f"%(
+              "Precision" if metric == "AP" else "Recall", metric, iou, area, max_det, value))
+
+    precision = results['precision'][:, :, :, 0, -1]                                  # [T,R,K]
+    print("%-14s %9s %9s"%("class", "AP", "AP50"))
+    for k in range(precision.shape[2]):
+        ap = precision[:, :, k]
+        name = id2name[k + 1] if id2name is not None else str(k + 1)
+        print("%-14s %9.3f %9.3f"%(name.strip(), np.mean(ap[ap > -1]) if (ap > -1).any() else -1., np.mean(ap[0][ap[0] > -1]) if (ap[0] > -1).any() else -1.))
+
+class StreamingEvaluator(object):
+    '''
+    Accumulates detector outputs batch by batch on a background thread, so the device keeps
+    running the next batch while the host slices, sorts and matches the previous one.
+    Only per-prediction records are kept (score, label, tp flag / COCO match flags), no boxes.
+
+    add() copies the padded outputs of FCOSDetector (scores, classes, boxes, num_dets) to the host
+    without blocking and records a cuda event, the worker waits on it. The queue is bounded, a
+    slow host side throttles the producer instead of holding more device outputs.
+    summarize() returns the eval_ap_2d dict at iou_thread and, with coco = True, the
+    eval_coco_2d dict; both equal the offline functions on the same inputs.
+    '''
+    def __init__(self, num_cls, iou_thread = 0.5, coco = True, queue_size = 4,
+                 iou_threads = np.linspace(.5, 0.95, 10), area_ranges = COCO_AREA_RANGES, max_dets = [1, 10, 100]):
+        self.num_cls = num_cls
+        self.iou_thread = iou_thread
+        self.coco = coco
+        self.coco_args = (iou_threads, area_ranges, max_dets)
+        self.num_imgs = 0
+        self._tp, self._scores, self._labels, self._gt_labels = [], [], [], []
+        self._coco_dets, self._coco_gts = [], []
+        self._error = None
+        self._queue = queue.Queue(maxsize = queue_size)
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def add(self, scores, classes, boxes, num_dets, gt_boxes, gt_classes, scales = None):
+        '''
+        scores, classes [batch_size,max_dets], boxes [batch_size,max_dets,4], num_dets [batch_size]
+        gt_boxes [batch_size,m,4], gt_classes [batch_size,m] padded with -1 (VOCDataset.collate_fn)
+        scales [batch_size] resize scale per image, boxes are divided by it for the COCO areas
+        '''
+        if self._error is not None:
+            raise self._error
+        outputs = [scores, classes, boxes, num_dets]
+        event = None
+        if scores.is_cuda:
+            outputs = [t.to('cpu', non_blocking = True) for t in outputs]
+            event = torch.cuda.Event()
+            event.record()
+        self._queue.put((outputs, event, gt_boxes, gt_classes, scales))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                if self._error is None:
+                    self._accumulate(*item)
+            except Exception as e:
+                self._error = e
+
+    def _accumulate(self, outputs, event, gt_boxes, gt_classes, scales):
+        if event is not None:
+            event.synchronize()
+        scores, classes, boxes, num_dets = [t.numpy() if torch.is_tensor(t) else np.asarray(t) for t in outputs]
+        gt_boxes = gt_boxes.numpy() if torch.is_tensor(gt_boxes) else np.asarray(gt_boxes)
+        gt_classes = gt_classes.numpy() if torch.is_tensor(gt_classes) else np.asarray(gt_classes)
+
+        batch = ([], [], [], [], [])
+        for i in range(len(num_dets)):
+            n = int(num_dets[i])
+            order = (-scores[i][:n]).argsort()                                          # like sort_by_score
+            keep = gt_classes[i] > 0
+            pred_boxes, pred_labels, pred_scores = boxes[i][:n][order], classes[i][:n][order], scores[i][:n][order]
+            sample_gts, sample_gt_labels = gt_boxes[i][keep], gt_classes[i][keep]
+
+            self._tp.append(_match_image(sample_gts, sample_gt_labels, pred_boxes, pred_labels, self.iou_thread))
+            self._scores.append(pred_scores.astype(np.float64))
+            self._labels.append(pred_labels)
+            self._gt_labels.append(sample_gt_labels)
+            if self.coco:
+                scale = 1. if scales is None else float(scales[i])
+                for lst, value in zip(batch, [sample_gts/scale, sample_gt_labels, pred_boxes/scale, pred_labels, pred_scores]):
+                    lst.append(value)
+        if self.coco:
+            dets, gts = _coco_match(*batch, self.num_cls, *self.coco_args)
+            self._coco_dets.append(dets)
+            self._coco_gts.append(gts)
+        self.num_imgs += len(num_dets)
+
+    def summarize(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+        labels_all = np.concatenate([np.zeros((0,), dtype = np.int64)] + self._labels)
+        scores_all = np.concatenate([np.zeros((0,))] + self._scores)
+        tp_all = np.concatenate([np.zeros((0,))] + self._tp).astype(np.float64)
+        gt_labels_all = np.concatenate([np.zeros((0,), dtype = np.int64)] + self._gt_labels)
+        all_ap = {}
+        for label in range(self.num_cls)[1:]:
+            mask = labels_all == label
+            all_ap[label] = _ap_from_tp(scores_all[mask], tp_all[mask], int(np.sum(gt_labels_all == label)))
+        if not self.coco:
+            return all_ap, None
+
+        if len(self._coco_dets) == 0:
+            self._accumulate([np.zeros((0, 0)), np.zeros((0, 0)), np.zeros((0, 0, 4)), np.zeros((0,))], None, np.zeros((0, 0, 4)), np.zeros((0, 0)), None)
+        dets = {key: np.concatenate([d[key] for d in self._coco_dets]) for key in ['label', 'score', 'rank', 'matched', 'ignored']}
+        gts = dict(label = np.concatenate([g['label'] for g in self._coco_gts]),
+                   ignored = np.concatenate([g['ignored'] for g in self._coco_gts], axis = 1))
+        return all_ap, _coco_accumulate(dets, gts, self.num_cls, *self.coco_args)
+
 if __name__=="__main__":
-    from model.fcos_copy import FCOSDetector
+    import argparse
+    from model.fcos import FCOSDetector
+    from model.config import DefaultConfig
+    from eval_cache import DetectionCache
     #from demo import convertSyncBNtoBN
-    from dataset.VOC_dataset import VOCDataset
-    
+    from dataset.VOC_dataset import VOCDataset, get_resize_scale
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type = int, default = 8, help = "images per forward pass")
+    parser.add_argument("--n_cpu", type = int, default = 4, help = "data loader workers")
+    parser.add_argument("--checkpoint", type = str, default = "./checkpoint/model_16.pth", help = "model weights")
+    parser.add_argument("--device", type = str, default = "cuda" if torch.cuda.is_available() else "cpu", help = "device to run the model on")
+    parser.add_argument("--cache_dir", type = str, default = None, help = "cache the pre-nms top-k detections here, reruns only post-process and evaluate")
+    parser.add_argument("--score_threshold", type = float, default = DefaultConfig.score_threshold)
+    parser.add_argument("--nms_iou_threshold", type = float, default = DefaultConfig.nms_iou_threshold)
+    opt = parser.parse_args()
 
     eval_dataset = VOCDataset(root_dir = 'root_directory_path', resize_size = [800, 1333],
                                split = 'test', use_difficult = False, is_train = False, augment = None)
     print("INFO===>eval dataset has %d imgs"%len(eval_dataset))
     eval_loader = torch.utils.data.DataLoader(eval_dataset,
-                                              batch_size = 1,
+                                              batch_size = opt.batch_size,
                                               shuffle = False,
+                                              num_workers = opt.n_cpu,
                                               collate_fn = eval_dataset.collate_fn)
 
-    model = FCOSDetector(mode = "inference")
-    # model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
-    # print("INFO===>success convert BN to SyncBN")
-    model = torch.nn.DataParallel(model)
-    model.load_state_dict(torch.load("./checkpoint/model_16.pth",
-                                     map_location = torch.device('cpu')))
-    # model = convertSyncBNtoBN(model)
-    # print("INFO===>success convert SyncBN to BN")
-    model = model.cuda().eval()
-    print("===>success loading model")
-
-    gt_boxes = []
-    gt_classes = []
-    pred_boxes = []
-    pred_classes = []
-    pred_scores = []
-    num = 0
+    cache = None
+    if opt.cache_dir is not None:
+        cache = DetectionCache(opt.cache_dir, opt.checkpoint, eval_dataset, DefaultConfig.max_detection_boxes_num)
     
-    for img,boxes,classes in eval_loader:
-        with torch.no_grad():
-            out = model(img.cuda())
-            pred_boxes.append(out[2][0].cpu().numpy())
-            pred_classes.append(out[1][0].cpu().numpy())
-            pred_scores.append(out[0][0].cpu().numpy())
-        gt_boxes.append(boxes[0].numpy())
-        gt_classes.append(classes[0].numpy())
-        num += 1
-        print(num, end='\r')
-
-    pred_boxes,pred_classes,pred_scores = sort_by_score(pred_boxes, pred_classes, pred_scores)
-    all_AP = eval_ap_2d(gt_boxes, gt_classes, pred_boxes, pred_classes, pred_scores, 0.5, len(eval_dataset.CLASSES_NAME))
+    # COCO metrics on boxes in original image pixels, so the small/medium/large buckets mean the usual sizes
+    scales = np.array([get_resize_scale(h, w, eval_dataset.resize_size) for h, w in eval_dataset.img_sizes()])
+    evaluator = StreamingEvaluator(len(eval_dataset.CLASSES_NAME), iou_thread = 0.5)
+    num = 0
+
+    if cache is not None and cache.complete():
+        print("===>replaying cached detections from %s"%cache.cache_dir)
+    else:
+        model = FCOSDetector(mode = "inference" if cache is None else "topk")
+        model.detection_head.score_threshold = opt.score_threshold
+        model.detection_head.nms_iou_threshold = opt.nms_iou_threshold
+        # model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        # print("INFO===>success convert BN to SyncBN")
+        model = torch.nn.DataParallel(model)
+        model.load_state_dict(torch.load(opt.checkpoint,
+                                         map_location = torch.device('cpu')))
+        # model = convertSyncBNtoBN(model)
+        # print("INFO===>success convert SyncBN to BN")
+        model = model.to(opt.device).eval()
+        print("===>success loading model")
+
+        if cache is not None:
+            cache.fill(model, eval_loader, device = opt.device)
+        else:
+            for img,boxes,classes in eval_loader:
+                with torch.no_grad():
+                    scores, pred_classes, pred_boxes, num_dets = model(img.to(opt.device, non_blocking = True))
+                evaluator.add(scores, pred_classes, pred_boxes, num_dets, boxes, classes, scales[num:num+len(img)])
+                num += len(img)
+                print(num, end='\r')
+
+    if cache is not None:
+        for outputs in cache.replay(opt.score_threshold, opt.nms_iou_threshold, device = opt.device):
+            evaluator.add(*outputs)
+
+    all_AP, coco = evaluator.summarize()
     print("all classes AP=====>\n")
     
     for key,value in all_AP.items():
@@ -166,4 +598,7 @@ if __name__=="__main__":
         mAP += float(class_mAP)
     mAP /= (len(eval_dataset.CLASSES_NAME)-1)
     
-    print("mAP=====>%.3f\n"%mAP)
\ No newline at end of file
+    print("mAP=====>%.3f\n"%mAP)
+
+    print("coco metrics=====>\n")
+    print_coco_table(coco, eval_dataset.id2name)
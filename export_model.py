@@ -0,0 +1,29 @@
+import argparse
+import torch
+from model.fcos import FCOSDetector
+from model.config import DefaultConfig
+from model.export import export_torchscript
+from model.onnx_backend import export_onnx
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--checkpoint", type = str, default = "./checkpoint/model_16.pth", help = "model weights (DataParallel state dict)")
+parser.add_argument("--format", type = str, default = "torchscript", choices = ["torchscript", "onnx"], help = "one torch.jit graph with decode and nms, or the onnx body for OnnxDetector")
+parser.add_argument("--out", type = str, default = None, help = "output file, ./checkpoint/fcos.pt or ./checkpoint/fcos.onnx by default")
+parser.add_argument("--height", type = int, default = 800, help = "height of the example input used for tracing")
+parser.add_argument("--width", type = int, default = 1088, help = "width of the example input used for tracing")
+parser.add_argument("--device", type = str, default = "cpu", help = "device the graph is exported on")
+
+if __name__=="__main__":
+    opt = parser.parse_args()
+    class Config(DefaultConfig):
+        pretrained = False
+
+    model = torch.nn.DataParallel(FCOSDetector(mode = "inference", config = Config))
+    model.load_state_dict(torch.load(opt.checkpoint, map_location = torch.device('cpu')))
+    model = model.module.to(opt.device).eval()
+    print("===>success loading model")
+
+    if opt.format == "onnx":
+        export_onnx(model, opt.out or "./checkpoint/fcos.onnx", example_size = (opt.height, opt.width))
+    else:
+        export_torchscript(model, opt.out or "./checkpoint/fcos.pt", example_size = (opt.height, opt.width))
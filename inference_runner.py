@@ -0,0 +1,182 @@
+import time
+import queue
+import threading
+import cv2
+import numpy as np
+import torch
+from dataset.augment import get_resize_scale
+
+
+def preprocess_img(image,input_ksize):
+    '''
+    resize so the short side is input_ksize[0] (long side at most input_ksize[1]) and pad bottom/right
+    to a multiple of 32, like VOCDataset.preprocess_img_boxes
+    returns the padded uint8 image and the resize scale
+    '''
+    h,  w, _  = image.shape
+    scale = get_resize_scale(h, w, input_ksize)
+    nw, nh  = int(scale * w), int(scale * h)
+    image_resized = cv2.resize(image, (nw, nh))
+
+    pad_w = 32-nw%32
+    pad_h = 32-nh%32
+
+    image_paded = np.zeros(shape = [nh+pad_h, nw+pad_w, 3], dtype = np.uint8)
+    image_paded[:nh, :nw, :] = image_resized
+    return image_paded, scale
+
+class InferenceRunner(object):
+    '''
+    Runs an FCOSDetector (mode "inference") over a list of image files.
+        producers  num_threads threads decode (cv2.imread), convert to RGB and resize/pad, cv2 releases
+                   the GIL so they run in parallel; their output goes through a bounded queue
+        batcher    the calling thread groups images of the same padded size and runs one forward pass
+                   per group once batch_size images are there, or the oldest waited max_wait_ms
+        writer     a background thread waits for the device outputs and hands one result per image
+                   to 'sink', a slow sink throttles the batcher through the bounded writer queue
+    A result is a dict: path, img (padded RGB uint8 [h,w,3]), img_hw (original height, width), scale,
+    scores [n], classes [n], boxes [n,4] in pixels of the padded image (divide by scale for the
+    original image), latency (s, from the start of the decode to the outputs being on the host).
+    '''
+    def __init__(self, model, input_ksize = [800,1333], batch_size = 8, num_threads = 4, queue_size = 32,
+                 max_wait_ms = 10, device = None, mean = [0.485,0.456,0.406], std = [0.229,0.224,0.225]):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.model = model
+        self.input_ksize = input_ksize
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.queue_size = queue_size
+        self.max_wait = max_wait_ms/1000.
+        self.device = torch.device(device)
+        std = torch.tensor(std, dtype = torch.float32)
+        # same arithmetic as VOCDataset.collate_fn
+        self.scale = (1./(255.*std))[None, :, None, None].to(self.device)
+        self.bias = torch.zeros(3).sub_(torch.tensor(mean, dtype = torch.float32)).div_(std)[None, :, None, None].to(self.device)
+
+    def _produce(self, paths, ready):
+        while True:
+            try:
+                path = paths.get_nowait()
+            except queue.Empty:
+                break
+            start_t = time.time()
+            try:
+                img_bgr = cv2.imread(path)
+                if img_bgr is None:
+                    raise IOError("===>can not read image %s"%path)
+                img = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB, dst = img_bgr)
+                img_pad, scale = preprocess_img(img, self.input_ksize)
+            except Exception as e:
+                ready.put(e)
+                break
+            ready.put(dict(path = path, img = img_pad, img_hw = img.shape[:2], scale = scale, start_t = start_t))
+        ready.put(None)
+
+    def _forward(self, items, results):
+        imgs = torch.from_numpy(np.stack([item['img'] for item in items])).to(self.device, non_blocking = True)
+        imgs = imgs.permute(0,3,1,2).float().mul_(self.scale).add_(self.bias).contiguous()   # [batch_size,3,h,w]
+        with torch.no_grad():
+            outputs = self.model(imgs)
+        event = None
+        if self.device.type == 'cuda':
+            outputs = [t.to('cpu', non_blocking = True) for t in outputs]
+            event = torch.cuda.Event()
+            event.record()
+        results.put((items, outputs, event))
+
+    def _write(self, results, sink, latencies, errors):
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            if errors:
+                continue
+            try:
+                items, outputs, event = item
+                if event is not None:
+                    event.synchronize()
+                scores, classes, boxes, num_dets = [t.numpy() for t in outputs]
+                end_t = time.time()
+                for i, meta in enumerate(items):
+                    n = int(num_dets[i])
+                    latencies.append(end_t - meta['start_t'])
+                    if sink is not None:
+                        sink(dict(path = meta['path'], img = meta['img'], img_hw = meta['img_hw'], scale = meta['scale'],
+                                  scores = scores[i][:n], classes = classes[i][:n], boxes = boxes[i][:n],
+                                  latency = end_t - meta['start_t']))
+            except Exception as e:
+                errors.append(e)
+
+    def run(self, paths, sink = None):
+        '''
+        returns dict(num_imgs, cost_time (s), imgs_per_s, latency_p50, latency_p99 (ms))
+        '''
+        paths = list(paths)
+        todo = queue.Queue()
+        for path in paths:
+            todo.put(path)
+        ready = queue.Queue(maxsize = self.queue_size)
+        results = queue.Queue(maxsize = self.queue_size)
+        latencies = []
+        errors = []
+
+        start_t = time.time()
+        producers = [threading.Thread(target = self._produce, args = (todo, ready), daemon = True)
+                     for _ in range(self.num_threads)]
+        writer = threading.Thread(target = self._write, args = (results, sink, latencies, errors), daemon = True)
+        for t in producers + [writer]:
+            t.start()
+
+        pending = {}                                      # padded (h,w) -> images waiting for a batch
+        num_done = 0
+        try:
+            while num_done < len(producers) or pending:
+                if num_done == len(producers):
+                    # every image is decoded, flush the incomplete groups
+                    for key in list(pending):
+                        self._forward(pending.pop(key), results)
+                    break
+                try:
+                    item = ready.get(timeout = self.max_wait if pending else None)
+                except queue.Empty:
+                    item = False
+                if item is None:
+                    num_done += 1
+                elif isinstance(item, Exception):
+                    raise item
+                elif item is not False:
+                    item['ready_t'] = time.time()
+                    key = item['img'].shape[:2]
+                    pending.setdefault(key, []).append(item)
+                    if len(pending[key]) == self.batch_size:
+                        self._forward(pending.pop(key), results)
+                now = time.time()
+                for key in [k for k, v in pending.items() if now - v[0]['ready_t'] >= self.max_wait]:
+                    self._forward(pending.pop(key), results)
+                if errors:
+                    raise errors[0]
+        finally:
+            # let blocked producers finish, then stop the writer
+            while not todo.empty():
+                try:
+                    todo.get_nowait()
+                except queue.Empty:
+                    pass
+            while any(t.is_alive() for t in producers):
+                try:
+                    ready.get(timeout = 0.1)
+                except queue.Empty:
+                    pass
+            results.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
+        cost_time = time.time() - start_t
+
+        latencies = np.array(latencies)*1000. if latencies else np.zeros((1,))
+        return dict(num_imgs = len(paths),
+                    cost_time = cost_time,
+                    imgs_per_s = len(paths)/max(cost_time, 1e-9),
+                    latency_p50 = float(np.percentile(latencies, 50)),
+                    latency_p99 = float(np.percentile(latencies, 99)))
@@ -29,9 +29,11 @@ class BasicBlock(nn.Module):
         super(BasicBlock, self).__init__()
         self.conv1 = conv3x3(inplanes, planes, stride)
         self.bn1 = nn.BatchNorm2d(planes)
-        self.relu = nn.ReLU(inplace = True)
+        self.relu1 = nn.ReLU(inplace = True)
         self.conv2 = conv3x3(planes, planes)
         self.bn2 = nn.BatchNorm2d(planes)
+        # relu(out + residual), a quantized op after torch.quantization.convert
+        self.skip_add_relu = nn.quantized.FloatFunctional()
         self.downsample = downsample
         self.stride = stride
 
@@ -40,7 +42,7 @@ class BasicBlock(nn.Module):
 
         out = self.conv1(x)
         out = self.bn1(out)
-        out = self.relu(out)
+        out = self.relu1(out)
 
         out = self.conv2(out)
         out = self.bn2(out)
@@ -48,10 +50,13 @@ class BasicBlock(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
-        out = self.relu(out)
+        return self.skip_add_relu.add_relu(out, residual)
+
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1', 'relu1'], ['conv2', 'bn2']], inplace = True)
+        if self.downsample is not None:
+            torch.quantization.fuse_modules(self.downsample, [['0', '1']], inplace = True)
 
-        return out
 class Bottleneck(nn.Module):
     # ResNet-B
     expansion = 4
@@ -60,11 +65,14 @@ class Bottleneck(nn.Module):
         super(Bottleneck, self).__init__()
         self.conv1 = nn.Conv2d(inplanes, planes, kernel_size = 1, bias = False)
         self.bn1 = nn.BatchNorm2d(planes)
+        self.relu1 = nn.ReLU(inplace = True)
         self.conv2 = nn.Conv2d(planes, planes, kernel_size = 3, stride = stride, padding = 1, bias = False)
         self.bn2 = nn.BatchNorm2d(planes)
+        self.relu2 = nn.ReLU(inplace = True)
         self.conv3 = nn.Conv2d(planes, planes * 4, kernel_size = 1, bias = False)
         self.bn3 = nn.BatchNorm2d(planes * 4)
-        self.relu = nn.ReLU(inplace = True)
+        # relu(out + residual), a quantized op after torch.quantization.convert
+        self.skip_add_relu = nn.quantized.FloatFunctional()
         self.downsample = downsample
         self.stride = stride
 
@@ -73,11 +81,11 @@ class Bottleneck(nn.Module):
 
         out = self.conv1(x)
         out = self.bn1(out)
-        out = self.relu(out)
+        out = self.relu1(out)
 
         out = self.conv2(out)
         out = self.bn2(out)
-        out = self.relu(out)
+        out = self.relu2(out)
 
         out = self.conv3(out)
         out = self.bn3(out)
@@ -85,10 +93,13 @@ class Bottleneck(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
-        out = self.relu(out)
+        return self.skip_add_relu.add_relu(out, residual)
+
+    def fuse_model(self):
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1', 'relu1'], ['conv2', 'bn2', 'relu2'], ['conv3', 'bn3']], inplace = True)
+        if self.downsample is not None:
+            torch.quantization.fuse_modules(self.downsample, [['0', '1']], inplace = True)
 
-        return out
 class ResNet(nn.Module):
 
     def __init__(self, block, layers, num_classes = 1000, if_include_top = False):
@@ -151,6 +162,16 @@ class ResNet(nn.Module):
         else:
             return (out3, out4, out5)
     
+    def fuse_model(self):
+        '''
+        folds every BatchNorm (and the following ReLU) into its convolution for post-training quantization,
+        the model must be in eval mode
+        '''
+        torch.quantization.fuse_modules(self, [['conv1', 'bn1', 'relu']], inplace = True)
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            for block in layer:
+                block.fuse_model()
+
     def freeze_bn(self):
         for layer in self.modules():
             if isinstance(layer, nn.BatchNorm2d):
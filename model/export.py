@@ -0,0 +1,57 @@
+import torch
+import torch.nn as nn
+
+
+class _FlatBody(nn.Module):
+    '''
+    FCOS body with its [cls_logits, cnt_logits, reg_preds] lists of levels flattened into one tuple,
+    the form torch.jit.trace can record
+    '''
+    def __init__(self, fcos_body):
+        super().__init__()
+        self.fcos_body = fcos_body
+
+    def forward(self, x):
+        cls_logits, cnt_logits, reg_preds = self.fcos_body(x)
+        return tuple(cls_logits) + tuple(cnt_logits) + tuple(reg_preds)
+
+class ExportedDetector(nn.Module):
+    '''
+    traced body + the DetectHead and ClipBoxes of the detector, compiled by torch.jit.script
+    '''
+    def __init__(self, body, head, clip_boxes):
+        super().__init__()
+        self.body = body
+        self.head = head
+        self.clip_boxes = clip_boxes
+        self.num_levels = len(head.strides)
+
+    def forward(self, batch_imgs: torch.Tensor):
+        outs = list(self.body(batch_imgs))
+        n = self.num_levels
+        scores, classes, boxes, num_dets = self.head([outs[:n], outs[n:2*n], outs[2*n:]])
+        boxes = self.clip_boxes(batch_imgs, boxes)
+        return scores, classes, boxes, num_dets
+
+def export_torchscript(detector, path = None, example_size = (800, 1088)):
+    '''
+    detector FCOSDetector in mode "inference" (or wrapped in DataParallel)
+    Traces backbone, neck and head convolutions once at example_size (they contain no
+    shape-dependent Python), scripts the detector's own DetectHead and ClipBoxes (decode, top-k,
+    nms and clipping, data-dependent loops) and combines both into one ScriptModule, saved to 'path' if given. The file loads with
+    torch.jit.load, without this repository, and accepts any [batch_size,3,h,w] input.
+    returns the ScriptModule
+    '''
+    if isinstance(detector, nn.DataParallel):
+        detector = detector.module
+    device = next(detector.parameters()).device
+
+    body = _FlatBody(detector.fcos_body).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(body, torch.zeros(1, 3, *example_size, device = device), check_trace = False)
+    exported = torch.jit.script(ExportedDetector(traced, detector.detection_head, detector.clip_boxes))
+    if path is not None:
+        torch.jit.save(exported, path)
+        print("INFO===>exported torchscript model to %s"%path)
+
+    return exported
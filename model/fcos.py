@@ -1,10 +1,12 @@
 from .head import ClsCntRegHead
 from .backbone.resnet import resnet101
 import torch.nn as nn
-from .loss import GenTargets, LOSS, coords_fmap2orig
+from .loss import GenTargets, LOSS, coords_cache, _make_coords, unpack_targets
 import torch
+from typing import List
 from .config import DefaultConfig
 from .mlfpn import M2Det, build_net
+from .nms import batched_nms
 from .cc import model 
 
 class FCOS(nn.Module):
@@ -14,9 +16,14 @@ class FCOS(nn.Module):
         if config is None:
             config = DefaultConfig
         
-        self.backbone = resnet101(pretrained = True,
+        self.backbone = resnet101(pretrained = config.pretrained,
                                   if_include_top = False)
-        self.mlfpn = build_net(config = model['m2det_config'])
+        # The neck is built once here so its weights live in the state dict
+        # and forward() never constructs modules.
+        self.mlfpn = build_net('train',
+                               size = 320,
+                               config = model['m2det_config']
+                               )
         self.head = ClsCntRegHead(config.fpn_out_channels,
                                   config.class_num,
                                   config.use_GN_head,
@@ -24,9 +31,13 @@ class FCOS(nn.Module):
                                   config.prior
                                   )
         self.config = config
+        # identity until model/quantization.py converts the backbone and neck to int8
+        self.quant = torch.quantization.QuantStub()
     
     def train(self, mode = True):
-        super().train(mode = True)
+        super().train(mode = mode)
+        if not mode:
+            return self
         
         def freeze_bn(module):
             if isinstance(module, nn.BatchNorm2d):
@@ -43,33 +54,44 @@ class FCOS(nn.Module):
         if self.config.freeze_stage_1:
             self.backbone.freeze_stages(1)
             print("INFO===>success frozen backbone stage1")
+        return self
+
+    def fuse_model(self):
+        self.backbone.fuse_model()
+        self.mlfpn.fuse_model()
 
     def forward(self,x):
-        C3,C4,C5 = self.backbone(x)
-        m2det = build_net('train', 
-                size = 320, 
-                config = model['m2det_config']
-                )
-        
-        all_P = m2det(C3,C4)
+        C3,C4,C5 = self.backbone(self.quant(x))
+        all_P = self.mlfpn(C3,C4)
         cls_logits,cnt_logits,reg_preds = self.head(all_P)
         
         return [cls_logits,cnt_logits,reg_preds]
 
 class DetectHead(nn.Module):
+    '''
+    Compiles with torch.jit.script (model/export.py), the annotations and the coords branch are for that.
+    '''
     def __init__(self, score_threshold, nms_iou_threshold, max_detection_boxes_num, strides, config = None):
         super().__init__()
-        self.score_threshold = score_threshold
-        self.nms_iou_threshold = nms_iou_threshold
-        self.max_detection_boxes_num = max_detection_boxes_num
-        self.strides = strides
+        self.score_threshold = float(score_threshold)
+        self.nms_iou_threshold = float(nms_iou_threshold)
+        self.max_detection_boxes_num = int(max_detection_boxes_num)
+        self.strides = list(strides)
         
         if config is None:
             self.config = DefaultConfig
         else:
             self.config = config
+        self.add_centerness = bool(self.config.add_centerness)
+
+    def forward(self,inputs: List[List[torch.Tensor]]):
+        return self._post_process(self.topk(inputs))
 
-    def forward(self,inputs):
+    def topk(self,inputs: List[List[torch.Tensor]]):
+        '''
+        the max_detection_boxes_num highest scoring candidates before score threshold and nms
+        returns [scores [batch_size,max_num], classes [batch_size,max_num], boxes [batch_size,max_num,4]], sorted by score
+        '''
         cls_logits,coords = self._reshape_cat_out(inputs[0],self.strides)                 # [batch_size,sum(_h*_w),class_num]
         cnt_logits,_ = self._reshape_cat_out(inputs[1],self.strides)                      # [batch_size,sum(_h*_w),1]
         reg_preds,_ = self._reshape_cat_out(inputs[2],self.strides)                       # [batch_size,sum(_h*_w),4]
@@ -77,10 +99,8 @@ class DetectHead(nn.Module):
         cls_preds = cls_logits.sigmoid_()
         cnt_preds = cnt_logits.sigmoid_()
 
-        coords = coords.cuda() if torch.cuda.is_available() else coords
-
         cls_scores, cls_classes = torch.max(cls_preds, dim = -1)                          # [batch_size,sum(_h*_w)]
-        if self.config.add_centerness:
+        if self.add_centerness:
             cls_scores = torch.sqrt(cls_scores*(cnt_preds.squeeze(dim = -1)))             # [batch_size,sum(_h*_w)]
         cls_classes = cls_classes + 1                                                     # [batch_size,sum(_h*_w)] 
 
@@ -88,40 +108,39 @@ class DetectHead(nn.Module):
 
         # Select Top-k
         max_num = min(self.max_detection_boxes_num,cls_scores.shape[-1])
-        topk_ind = torch.topk(cls_scores,max_num, dim = -1, largest = True, sorted = True)[1]  #[batch_size,max_num]
-        _cls_scores = []
-        _cls_classes = []
-        _boxes = []
-        for batch in range(cls_scores.shape[0]):
-            _cls_scores.append(cls_scores[batch][topk_ind[batch]])                        # [max_num]
-            _cls_classes.append(cls_classes[batch][topk_ind[batch]])                      # [max_num]
-            _boxes.append(boxes[batch][topk_ind[batch]])                                  # [max_num,4]
-        
-        cls_scores_topk = torch.stack(_cls_scores,dim = 0)                                # [batch_size,max_num]
-        cls_classes_topk = torch.stack(_cls_classes,dim = 0)                              # [batch_size,max_num]
-        boxes_topk = torch.stack(_boxes, dim = 0)                                         # [batch_size,max_num,4]
+        cls_scores_topk, topk_ind = torch.topk(cls_scores,max_num, dim = -1, largest = True, sorted = True)  #[batch_size,max_num]
+        cls_classes_topk = torch.gather(cls_classes, 1, topk_ind)                         # [batch_size,max_num]
+        boxes_topk = torch.gather(boxes, 1, topk_ind[...,None].expand(-1,-1,4))           # [batch_size,max_num,4]
         assert boxes_topk.shape[-1] == 4
         
-        return self._post_process([cls_scores_topk, cls_classes_topk, boxes_topk])
+        return [cls_scores_topk, cls_classes_topk, boxes_topk]
 
-    def _post_process(self,preds_topk):
-        _cls_scores_post = []
-        _cls_classes_post = []
-        _boxes_post = []
+    def _post_process(self,preds_topk: List[torch.Tensor]):
+        '''
+        Returns fixed-size padded outputs for the whole batch
+        scores [batch_size,max_num], classes [batch_size,max_num], boxes [batch_size,max_num,4], num_dets [batch_size]
+        The first num_dets[b] entries of image b are its detections in descending score order,
+        the remaining entries are zero (class 0 is the background).
+        '''
         cls_scores_topk,cls_classes_topk,boxes_topk = preds_topk
+        max_num = cls_scores_topk.shape[-1]
+        
+        mask = cls_scores_topk >= self.score_threshold                                    # [batch_size,max_num]
+        keep = batched_nms(boxes_topk, cls_scores_topk, cls_classes_topk,
+                           self.nms_iou_threshold,
+                           valid = mask)                                                  # [batch_size,max_num]
+        num_dets = keep.sum(dim = -1)                                                     # [batch_size]
+
+        # move kept entries to the front, preserving their score order
+        ind = torch.arange(max_num, device = keep.device).expand_as(keep)
+        order = torch.where(keep, ind, ind + max_num).argsort(dim = -1)                   # [batch_size,max_num]
+        pad = ind >= num_dets[:,None]
+
+        scores = cls_scores_topk.gather(1, order).masked_fill(pad, 0)
+        classes = cls_classes_topk.gather(1, order).masked_fill(pad, 0)
+        boxes = boxes_topk.gather(1, order[...,None].expand(-1,-1,4)).masked_fill(pad[...,None], 0)
         
-        for batch in range(cls_classes_topk.shape[0]):
-            mask = cls_scores_topk[batch] >= self.score_threshold
-            _cls_scores_b = cls_scores_topk[batch][mask]
-            _cls_classes_b = cls_classes_topk[batch][mask]
-            _boxes_b = boxes_topk[batch][mask]
-            nms_ind = self.batched_nms(_boxes_b, _cls_scores_b, _cls_classes_b, self.nms_iou_threshold)
-            _cls_scores_post.append(_cls_scores_b[nms_ind])
-            _cls_classes_post.append(_cls_classes_b[nms_ind])
-            _boxes_post.append(_boxes_b[nms_ind])
-        scores,classes,boxes = torch.stack(_cls_scores_post, dim = 0), torch.stack(_cls_classes_post, dim = 0), torch.stack(_boxes_post, dim = 0)
-        
-        return scores,classes,boxes
+        return scores,classes,boxes,num_dets
     
     @staticmethod
     def box_nms(boxes,scores,thr):
@@ -163,11 +182,9 @@ class DetectHead(nn.Module):
                                dtype = torch.int64, 
                                device = boxes.device
                                )
-        max_coordinate = boxes.max()
-        offsets = idxs.to(boxes) * (max_coordinate + 1)
-        boxes_for_nms = boxes + offsets[:, None]
-        keep = self.box_nms(boxes_for_nms, scores, iou_threshold)
-        return keep
+        keep = batched_nms(boxes[None], scores[None], idxs[None], iou_threshold)[0]
+        keep_ind = torch.nonzero(keep).view(-1)
+        return keep_ind[scores[keep_ind].sort(0, descending = True)[1]]
 
     def _coords2boxes(self,coords,offsets):
         x1y1 = coords[None,:,:]-offsets[...,:2]
@@ -176,35 +193,50 @@ class DetectHead(nn.Module):
         return boxes
 
 
-    def _reshape_cat_out(self,inputs,strides):
+    def _reshape_cat_out(self,inputs: List[torch.Tensor],strides: List[int]):
         batch_size = inputs[0].shape[0]
         c = inputs[0].shape[1]
         out = []
         coords = []
         
-        for pred,stride in zip(inputs,strides):
-            pred = pred.permute(0,2,3,1)
-            coord = coords_fmap2orig(pred,stride).to(device = pred.device)
+        for i in range(len(inputs)):
+            pred = inputs[i].permute(0,2,3,1)
+            coord = self._level_coords(pred.shape[1], pred.shape[2], strides[i], pred.device)
             pred = torch.reshape(pred,[batch_size,-1,c])
             out.append(pred)
             coords.append(coord)
         return torch.cat(out,dim = 1), torch.cat(coords, dim = 0)
 
+    def _level_coords(self, h: int, w: int, stride: int, device: torch.device):
+        # same grid, the compiled graph can not reach the python cache
+        if torch.jit.is_scripting():
+            return _make_coords(h, w, stride, device, torch.float32)
+        return self._cached_coords(h, w, stride, device)
+
+    @torch.jit.unused
+    def _cached_coords(self, h: int, w: int, stride: int, device: torch.device) -> torch.Tensor:
+        return coords_cache.get(int(h), int(w), stride, device)
+
 class ClipBoxes(nn.Module):
     def __init__(self):
         super().__init__()
     
     def forward(self,batch_imgs,batch_boxes):
         batch_boxes = batch_boxes.clamp_(min = 0)
-        h,w = batch_imgs.shape[2:]
-        batch_boxes[...,[0,2]] = batch_boxes[...,[0,2]].clamp_(max = w-1)
-        batch_boxes[...,[1,3]] = batch_boxes[...,[1,3]].clamp_(max = h-1)
+        h,w = batch_imgs.shape[2],batch_imgs.shape[3]
+        batch_boxes[:,:,0::2].clamp_(max = w-1)
+        batch_boxes[:,:,1::2].clamp_(max = h-1)
         
         return batch_boxes
 
         
 class FCOSDetector(nn.Module):
-    def __init__(self,mode = "training", config = None):
+    def __init__(self,mode = "training", config = None, device = None):
+        '''
+        'device' places every submodule once at construction, e.g. 'cpu' or 'cuda:0'.
+        If omitted the model stays on the CPU and follows later .to()/.cuda() calls;
+        all intermediate tensors are created on the device of the input batch.
+        '''
         super().__init__()
         if config is None:
             config = DefaultConfig
@@ -218,7 +250,7 @@ class FCOSDetector(nn.Module):
                                            )
             self.loss_layer = LOSS()
         
-        elif mode == "inference":
+        elif mode in ("inference", "topk"):
             self.detection_head = DetectHead(config.score_threshold, 
                                              config.nms_iou_threshold,
                                             config.max_detection_boxes_num, 
@@ -227,19 +259,32 @@ class FCOSDetector(nn.Module):
                                             )
             self.clip_boxes = ClipBoxes()
         
+        if device is not None:
+            self.to(device)
     
     def forward(self, inputs):
 
         if self.mode == "training":
-            batch_imgs, batch_boxes, batch_classes = inputs
+            batch_imgs, batch_boxes, batch_classes = inputs[:3]
             out = self.fcos_body(batch_imgs)
-            targets = self.target_layer([out,batch_boxes,batch_classes])
+            if len(inputs) == 4:
+                # targets packed by loss.TargetCollate in the data loader
+                num_locations = sum(cls_logits.shape[2]*cls_logits.shape[3] for cls_logits in out[0])
+                targets = unpack_targets(inputs[3], num_locations)
+            else:
+                targets = self.target_layer([out,batch_boxes,batch_classes])
             losses = self.loss_layer([out,targets])
             return losses
         
         elif self.mode == "inference":
             batch_imgs = inputs
             out = self.fcos_body(batch_imgs)
-            scores,classes,boxes = self.detection_head(out)
+            scores,classes,boxes,num_dets = self.detection_head(out)
             boxes = self.clip_boxes(batch_imgs,boxes)
-            return scores, classes, boxes
\ No newline at end of file
+            return scores, classes, boxes, num_dets
+        
+        elif self.mode == "topk":
+            # unclipped candidates for eval_cache.DetectionCache, nms and clipping happen on replay
+            batch_imgs = inputs
+            out = self.fcos_body(batch_imgs)
+            return self.detection_head.topk(out)
\ No newline at end of file
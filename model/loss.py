@@ -1,29 +1,86 @@
-
 import torch
 import torch.nn as nn
+import math
+import threading
+from collections import OrderedDict
 from .config import DefaultConfig
 
 
 
 
-def coords_fmap2orig(feature, stride):
-    h,w = feature.shape[1:3]
-    shifts_x = torch.arange(0, w * stride, stride, dtype = torch.float32)
-    shifts_y = torch.arange(0, h * stride, stride, dtype = torch.float32)
-
-    shift_y, shift_x = torch.meshgrid(shifts_y, shifts_x)
+class CoordsCache(object):
+    '''
+    Bounded LRU cache of anchor-point grids keyed by (h, w, stride, device, dtype).
+    Shared by GenTargets and DetectHead; 'hits' and 'misses' count lookups.
+    The cached tensors are shared, callers must not modify them in place.
+    '''
+    def __init__(self, max_size = 64):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._grids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, h, w, stride, device, dtype = torch.float32):
+        key = (h, w, stride, torch.device(device), dtype)
+        with self._lock:
+            coords = self._grids.get(key)
+            if coords is not None:
+                self._grids.move_to_end(key)
+                self.hits += 1
+                return coords
+            self.misses += 1
+
+        coords = _make_coords(h, w, stride, device, dtype)
+        with self._lock:
+            self._grids[key] = coords
+            while len(self._grids) > self.max_size:
+                self._grids.popitem(last = False)
+        return coords
+
+    def clear(self):
+        with self._lock:
+            self._grids.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return dict(hits = self.hits, misses = self.misses, size = len(self._grids), max_size = self.max_size)
+
+coords_cache = CoordsCache()
+
+def _make_coords(h: int, w: int, stride: int, device: torch.device, dtype: torch.dtype):
+    # annotated, DetectHead calls it directly when compiled by torch.jit.script
+    shifts_x = torch.arange(0, w * stride, stride, dtype = dtype, device = device)
+    shifts_y = torch.arange(0, h * stride, stride, dtype = dtype, device = device)
+
+    shift_y, shift_x = torch.meshgrid([shifts_y, shifts_x])
     shift_x = torch.reshape(shift_x, [-1])
     shift_y = torch.reshape(shift_y, [-1])
     coords = torch.stack([shift_x, shift_y], -1) + stride // 2
     
     return coords
 
+def coords_fmap2orig(feature, stride, dtype = torch.float32):
+    '''
+    feature [batch_size,h,w,c]
+    returns the cached [h*w,2] anchor points of the level, on the device of 'feature'
+    '''
+    h,w = feature.shape[1:3]
+    return coords_cache.get(int(h), int(w), stride, feature.device, dtype)
+
 class GenTargets(nn.Module):
-    def __init__(self,strides,limit_range):
+    def __init__(self,strides,limit_range,assign_mode = 'sparse'):
+        '''
+        assign_mode 'dense' builds [batch_size,h*w,m] candidate tensors for every level,
+        'sparse' only looks at the grid cells around each gt box center and gives the same targets
+        '''
         super().__init__()
         self.strides = strides
         self.limit_range = limit_range
+        self.assign_mode = assign_mode
         assert len(strides)==len(limit_range)
+        assert assign_mode in ['dense','sparse']
 
     def forward(self,inputs):
         '''
@@ -50,16 +107,35 @@ class GenTargets(nn.Module):
         assert len(self.strides)==len(cls_logits)
         
         for level in range(len(cls_logits)):
-            level_out = [cls_logits[level],cnt_logits[level],reg_preds[level]]
-            level_targets = self._gen_level_targets(level_out, gt_boxes, classes,
-                                                  self.strides[level], 
-                                                  self.limit_range[level])
+            if self.assign_mode == 'sparse':
+                level_targets = self._gen_level_targets_sparse(cls_logits[level].shape[2:], gt_boxes, classes,
+                                                               self.strides[level],
+                                                               self.limit_range[level])
+            else:
+                level_out = [cls_logits[level],cnt_logits[level],reg_preds[level]]
+                level_targets = self._gen_level_targets(level_out, gt_boxes, classes,
+                                                      self.strides[level], 
+                                                      self.limit_range[level])
             cls_targets_all_level.append(level_targets[0])
             cnt_targets_all_level.append(level_targets[1])
             reg_targets_all_level.append(level_targets[2])
             
         return torch.cat(cls_targets_all_level, dim = 1), torch.cat(cnt_targets_all_level, dim = 1), torch.cat(reg_targets_all_level, dim = 1)
 
+    def targets_from_sizes(self, fmap_sizes, gt_boxes, classes):
+        '''
+        Sparse target assignment from the feature map sizes alone, no predictions needed.
+        'fmap_sizes' list contains five (h, w), one per level
+        '''
+        assert len(self.strides)==len(fmap_sizes)
+        level_targets = [self._gen_level_targets_sparse(fmap_sizes[level], gt_boxes, classes,
+                                                        self.strides[level],
+                                                        self.limit_range[level])
+                         for level in range(len(fmap_sizes))]
+        cls_targets,cnt_targets,reg_targets = zip(*level_targets)
+        
+        return torch.cat(cls_targets, dim = 1), torch.cat(cnt_targets, dim = 1), torch.cat(reg_targets, dim = 1)
+
     def _gen_level_targets(self, out, gt_boxes, classes, stride, limit_range, sample_radiu_ratio = 1.5):
         '''  
         'out' list contains [[batch_size, class_num, h, w], [batch_size, 1, h, w], [batch_size, 4, h, w]]  
@@ -70,7 +146,7 @@ class GenTargets(nn.Module):
         m = gt_boxes.shape[1]
 
         cls_logits = cls_logits.permute(0,2,3,1)                                    # [batch_size,h,w,class_num]  
-        coords = coords_fmap2orig(cls_logits,stride).to(device = gt_boxes.device)     # [h*w,2]
+        coords = coords_fmap2orig(cls_logits,stride)                                  # [h*w,2]
 
         cls_logits = cls_logits.reshape((batch_size,-1,class_num))                  #[batch_size,h*w,class_num]  
         cnt_logits = cnt_logits.permute(0,2,3,1)
@@ -149,7 +225,150 @@ class GenTargets(nn.Module):
         reg_targets[~mask_pos_2] = -1
         
         return cls_targets, cnt_targets,reg_targets
+
+    def _gen_level_targets_sparse(self, fmap_size, gt_boxes, classes, stride, limit_range, sample_radiu_ratio = 1.5):
+        '''
+        'fmap_size' (h, w) of the level
+        Same targets as _gen_level_targets. A location can only be positive for a box if it lies
+        within 'stride*sample_radiu_ratio' of the box center, so only that window of grid cells
+        (plus one cell of margin) is evaluated per box. Memory scales with the number of boxes
+        instead of h*w*m.
+        '''
+        batch_size, m = gt_boxes.shape[:2]
+        h, w = int(fmap_size[0]), int(fmap_size[1])
+        device = gt_boxes.device
+        coords = coords_cache.get(h, w, stride, device)                                  # [h*w,2]
+
+        cls_targets = torch.zeros((batch_size, h*w, 1), dtype = classes.dtype, device = device)
+        cnt_targets = torch.full((batch_size, h*w, 1), -1, dtype = gt_boxes.dtype, device = device)
+        reg_targets = torch.full((batch_size, h*w, 4), -1, dtype = gt_boxes.dtype, device = device)
+        if m == 0:
+            return cls_targets, cnt_targets, reg_targets
+
+        radiu = stride*sample_radiu_ratio
+        gt_center_x = (gt_boxes[...,0] + gt_boxes[...,2])/2                               # [batch_size,m]
+        gt_center_y = (gt_boxes[...,1] + gt_boxes[...,3])/2
+
+        win = int(math.ceil(2*sample_radiu_ratio)) + 3
+        steps = torch.arange(win, device = device)
+        col0 = torch.floor((gt_center_x - radiu - stride//2)/stride).long() - 1           # [batch_size,m]
+        row0 = torch.floor((gt_center_y - radiu - stride//2)/stride).long() - 1
+        cols = (col0[...,None] + steps)[:,:,None,:].expand(-1,-1,win,-1)                  # [batch_size,m,win,win]
+        rows = (row0[...,None] + steps)[:,:,:,None].expand(-1,-1,-1,win)
+        in_grid = (cols >= 0)&(cols < w)&(rows >= 0)&(rows < h)
+
+        b_ind, j_ind = torch.nonzero(in_grid)[:,:2].unbind(dim = 1)                      # [k]
+        loc = (rows*w + cols)[in_grid]                                                    # [k]
+        x = coords[loc,0]
+        y = coords[loc,1]
+        boxes = gt_boxes[b_ind, j_ind]                                                    # [k,4]
+
+        ltrb_off = torch.stack([x-boxes[:,0], y-boxes[:,1], boxes[:,2]-x, boxes[:,3]-y], dim = -1)   # [k,4]
+        areas = (ltrb_off[...,0]+ltrb_off[...,2])*(ltrb_off[...,1]+ltrb_off[...,3])    # [k]
+        off_min = torch.min(ltrb_off, dim = -1)[0]
+        off_max = torch.max(ltrb_off, dim = -1)[0]
+
+        center_x = gt_center_x[b_ind, j_ind]
+        center_y = gt_center_y[b_ind, j_ind]
+        c_ltrb_off = torch.stack([x-center_x, y-center_y, center_x-x, center_y-y], dim = -1)         # [k,4]
+        c_off_max = torch.max(c_ltrb_off, dim = -1)[0]
+
+        mask_pos = (off_min>0)&(off_max>limit_range[0])&(off_max <= limit_range[1])&(c_off_max<radiu)
+        if not bool(mask_pos.any()):
+            return cls_targets, cnt_targets, reg_targets
+        b_ind, j_ind, loc = b_ind[mask_pos], j_ind[mask_pos], loc[mask_pos]             # [num_pos_pairs]
+        ltrb_off, areas = ltrb_off[mask_pos], areas[mask_pos]
+
+        # for every location keep the box with the smallest area, ties go to the lower box index
+        flat_loc = b_ind*(h*w) + loc
+        area_rank = torch.unique(areas, sorted = True, return_inverse = True)[1]
+        order = torch.sort((flat_loc*areas.shape[0] + area_rank)*m + j_ind)[1]
+        flat_sorted = flat_loc[order]
+        first = torch.ones_like(flat_sorted, dtype = torch.bool)
+        first[1:] = flat_sorted[1:] != flat_sorted[:-1]
+        sel = order[first]
+
+        reg_pos = ltrb_off[sel]                                                           # [num_pos_loc,4]
+        left_right_min = torch.min(reg_pos[..., 0], reg_pos[..., 2])
+        left_right_max = torch.max(reg_pos[..., 0], reg_pos[..., 2])
+        top_bottom_min = torch.min(reg_pos[..., 1], reg_pos[..., 3])
+        top_bottom_max = torch.max(reg_pos[..., 1], reg_pos[..., 3])
+        cnt_pos = ((left_right_min*top_bottom_min)/(left_right_max*top_bottom_max+1e-10)).sqrt()
+
+        reg_targets.view(-1,4)[flat_loc[sel]] = reg_pos
+        cnt_targets.view(-1)[flat_loc[sel]] = cnt_pos
+        cls_targets.view(-1)[flat_loc[sel]] = classes[b_ind[sel], j_ind[sel]]
+
+        return cls_targets, cnt_targets, reg_targets
+        
+
+
+def pack_targets(targets):
+    '''
+    dense [cls_targets,cnt_targets,reg_targets] --> compact per-image positives, padded to the
+    largest positive count in the batch so the batch dimension can still be split across devices
+    pos_ind [batch_size,max_pos] LongTensor, location index or -1 for padding
+    cls [batch_size,max_pos], cnt [batch_size,max_pos], reg [batch_size,max_pos,4]
+    '''
+    cls_targets,cnt_targets,reg_targets = targets
+    batch_size, num_locations = cnt_targets.shape[:2]
+    mask = cnt_targets[...,0] > -1                                              # [batch_size,sum(_h*_w)]
+    num_pos = mask.sum(dim = -1)
+    max_pos = int(num_pos.max()) if batch_size > 0 else 0
+
+    ind = torch.arange(num_locations, device = mask.device).expand_as(mask)
+    order = torch.where(mask, ind, ind + num_locations).argsort(dim = -1)[:,:max_pos]  # positives first
+    pad = torch.arange(max_pos, device = mask.device)[None,:] >= num_pos[:,None]
+
+    pos_ind = order.masked_fill(pad, -1)
+    cls = cls_targets[...,0].gather(1, order)
+    cnt = cnt_targets[...,0].gather(1, order)
+    reg = reg_targets.gather(1, order[...,None].expand(-1,-1,4))
+    
+    return pos_ind, cls, cnt, reg
+
+def unpack_targets(packed, num_locations):
+    '''
+    inverse of pack_targets, rebuilds the dense targets on the device of 'packed'
+    '''
+    pos_ind,cls,cnt,reg = packed
+    batch_size = pos_ind.shape[0]
+    valid = pos_ind >= 0
+    batch_ind = torch.arange(batch_size, device = pos_ind.device)[:,None].expand_as(pos_ind)
+    flat_ind = (batch_ind*num_locations + pos_ind)[valid]
+
+    cls_targets = torch.zeros((batch_size, num_locations, 1), dtype = cls.dtype, device = cls.device)
+    cnt_targets = torch.full((batch_size, num_locations, 1), -1, dtype = cnt.dtype, device = cnt.device)
+    reg_targets = torch.full((batch_size, num_locations, 4), -1, dtype = reg.dtype, device = reg.device)
+    cls_targets.view(-1)[flat_ind] = cls[valid]
+    cnt_targets.view(-1)[flat_ind] = cnt[valid]
+    reg_targets.view(-1,4)[flat_ind] = reg[valid]
+    
+    return cls_targets, cnt_targets, reg_targets
+
+class TargetCollate(object):
+    '''
+    Wraps a collate_fn returning (batch_imgs, batch_boxes, batch_classes) and appends the packed
+    FCOS targets, computed from the padded image shape. Used as the DataLoader collate_fn this
+    moves target assignment into the worker processes, off the training device.
+    'fmap_sizes_fn' maps the padded (h, w) to the five (h, w) of the detector outputs.
+    '''
+    def __init__(self, collate_fn, strides, limit_range, fmap_sizes_fn):
+        self.collate_fn = collate_fn
+        self.fmap_sizes_fn = fmap_sizes_fn
+        self.target_layer = GenTargets(strides = strides,
+                                       limit_range = limit_range,
+                                       assign_mode = 'sparse'
+                                       )
+
+    def __call__(self, data):
+        batch_imgs,batch_boxes,batch_classes = self.collate_fn(data)
+        fmap_sizes = self.fmap_sizes_fn(*batch_imgs.shape[2:])
+        with torch.no_grad():
+            targets = self.target_layer.targets_from_sizes(fmap_sizes, batch_boxes, batch_classes)
         
+        return batch_imgs, batch_boxes, batch_classes, pack_targets(targets)
+
 
 
 def compute_cls_loss(preds,                # list contains five level pred [batch_size, class_num, _h, _w]
@@ -233,7 +452,58 @@ def compute_reg_loss(preds,targets,mask,mode='giou'):
             raise NotImplementedError("reg loss only implemented ['iou','giou']")
     return torch.cat(loss, dim = 0)/num_pos                             #[batch_size,]
 
-def iou_loss(preds,targets):
+def _flatten_preds(preds):
+    '''
+    list of five level preds [batch_size, c, _h, _w] --> [batch_size, sum(_h*_w), c]
+    '''
+    batch_size, c = preds[0].shape[:2]
+    return torch.cat([pred.permute(0,2,3,1).reshape(batch_size,-1,c) for pred in preds], dim = 1)
+
+def compute_fused_loss(preds,              # [cls_logits,cnt_logits,reg_preds], each a list of five levels
+                       targets,            # [cls_targets,cnt_targets,reg_targets]
+                       mask,               # [batch_size,sum(_h*_w)]
+                       mode = 'giou'):
+    '''
+    Same per-image losses as compute_cls_loss, compute_cnt_loss and compute_reg_loss, but the
+    predictions are flattened once and each loss is evaluated over the whole batch at once.
+    Positive samples of all images are gathered together and summed back per image.
+    returns cls_loss, cnt_loss, reg_loss each [batch_size,]
+    '''
+    cls_logits,cnt_logits,reg_preds = preds
+    cls_targets,cnt_targets,reg_targets = targets
+    batch_size = cls_targets.shape[0]
+    class_num = cls_logits[0].shape[1]
+
+    cls_preds = _flatten_preds(cls_logits)                                  # [batch_size,sum(_h*_w),class_num]
+    cnt_preds = _flatten_preds(cnt_logits)                                  # [batch_size,sum(_h*_w),1]
+    reg_preds = _flatten_preds(reg_preds)                                   # [batch_size,sum(_h*_w),4]
+    assert cls_preds.shape[:2] == cls_targets.shape[:2]
+    assert cnt_preds.shape == cnt_targets.shape
+    assert reg_preds.shape == reg_targets.shape
+
+    num_pos = torch.sum(mask,dim = 1).clamp_(min = 1).float()             # [batch_size,]
+    batch_ind = torch.nonzero(mask)[:,0]                                    # [num_pos_all,]
+
+    cls_onehot = (torch.arange(1, class_num + 1,
+                               device = cls_targets.device)[None,None,:] == cls_targets).float()  # sparse-->onehot
+    cls_loss = focal_loss_from_logits(cls_preds, cls_onehot, reduction = 'none').sum(dim = [1,2])
+
+    cnt_loss = nn.functional.binary_cross_entropy_with_logits(input = cnt_preds[mask].view(-1),
+                                                              target = cnt_targets[mask].view(-1),
+                                                              reduction = 'none')
+    cnt_loss = cnt_loss.new_zeros(batch_size).index_add_(0, batch_ind, cnt_loss)
+
+    if mode == 'iou':
+        reg_loss = iou_loss(reg_preds[mask], reg_targets[mask], reduction = 'none')
+    elif mode == 'giou':
+        reg_loss = giou_loss(reg_preds[mask], reg_targets[mask], reduction = 'none')
+    else:
+        raise NotImplementedError("reg loss only implemented ['iou','giou']")
+    reg_loss = reg_loss.new_zeros(batch_size).index_add_(0, batch_ind, reg_loss)
+
+    return cls_loss/num_pos, cnt_loss/num_pos, reg_loss/num_pos
+
+def iou_loss(preds,targets,reduction = 'sum'):
     lt = torch.min(preds[:,:2],targets[:,:2])
     rb = torch.min(preds[:,2:],targets[:,2:])
     wh = (rb+lt).clamp(min = 0)
@@ -242,10 +512,12 @@ def iou_loss(preds,targets):
     area2 = (targets[:,2] + targets[:,0]) * (targets[:,3] + targets[:,1])
     iou = overlap/(area1+area2-overlap)
     loss = -iou.clamp(min = 1e-6).log()
+    if reduction == 'none':
+        return loss
     
     return loss.sum()
 
-def giou_loss(preds,targets):
+def giou_loss(preds,targets,reduction = 'sum'):
 
     lt_min = torch.min(preds[:,:2],targets[:,:2])
     rb_min = torch.min(preds[:,2:],targets[:,2:])
@@ -263,15 +535,19 @@ def giou_loss(preds,targets):
 
     giou = iou-(G_area-union)/G_area.clamp(1e-10)
     loss = 1.-giou
+    if reduction == 'none':
+        return loss
     
     return loss.sum()
 
-def focal_loss_from_logits(preds, targets, gamma = 2.0, alpha = 0.25):
+def focal_loss_from_logits(preds, targets, gamma = 2.0, alpha = 0.25, reduction = 'sum'):
     
     preds = preds.sigmoid()
     pt = preds*targets+(1.0-preds)*(1.0-targets)
     w = alpha*targets+(1.0-alpha)*(1.0-targets)
     loss = -w*torch.pow((1.0-pt),gamma)*pt.log()
+    if reduction == 'none':
+        return loss
     
     return loss.sum()
 
@@ -279,21 +555,27 @@ def focal_loss_from_logits(preds, targets, gamma = 2.0, alpha = 0.25):
 
 
 class LOSS(nn.Module):
-    def __init__(self,config = None):
+    def __init__(self,config = None, fused = True):
         super().__init__()
         if config is None:
             self.config = DefaultConfig
         else:
             self.config = config
+        self.fused = fused
+    
     def forward(self,inputs):
 
         preds,targets = inputs
         cls_logits,cnt_logits,reg_preds = preds
         cls_targets,cnt_targets,reg_targets = targets
         mask_pos = (cnt_targets>-1).squeeze(dim = -1)                           # [batch_size,sum(_h*_w)]
-        cls_loss = compute_cls_loss(cls_logits,cls_targets,mask_pos).mean()
-        cnt_loss = compute_cnt_loss(cnt_logits,cnt_targets,mask_pos).mean()
-        reg_loss = compute_reg_loss(reg_preds,reg_targets,mask_pos).mean()
+        if self.fused:
+            cls_loss,cnt_loss,reg_loss = compute_fused_loss(preds,targets,mask_pos)
+            cls_loss,cnt_loss,reg_loss = cls_loss.mean(),cnt_loss.mean(),reg_loss.mean()
+        else:
+            cls_loss = compute_cls_loss(cls_logits,cls_targets,mask_pos).mean()
+            cnt_loss = compute_cnt_loss(cnt_logits,cnt_targets,mask_pos).mean()
+            reg_loss = compute_reg_loss(reg_preds,reg_targets,mask_pos).mean()
         
         if self.config.add_centerness:
             total_loss = cls_loss + cnt_loss + reg_loss
@@ -74,12 +74,12 @@ class M2Det(nn.Module):                                 # Multi-level Multi-scal
         
         # construct others
         if self.phase == 'test':
-            self.softmax = nn.Softmax().cuda()
-        self.Norm = nn.BatchNorm2d(256).cuda()#I changed from 256*8
+            self.softmax = nn.Softmax()
+        self.Norm = nn.BatchNorm2d(256)#I changed from 256*8
         self.leach = nn.ModuleList([BasicConv(
                     deep_out+shallow_out,
                     self.planes//2,
-                    kernel_size = (1,1),stride=(1,1))]*self.num_levels).cuda()
+                    kernel_size = (1,1),stride=(1,1))]*self.num_levels)
         '''
         # construct localization and recognition layers
         loc_ = list()
@@ -100,18 +100,22 @@ class M2Det(nn.Module):                                 # Multi-level Multi-scal
         self.sfam_module = SFAM(self.planes, self.num_levels, self.num_scales, 
                                 compress_ratio = 16
                                 )
+
+        # concatenations as modules and the end of the int8 part (SFAM and Norm stay float),
+        # all identities until torch.quantization.prepare/convert
+        self.base_cat = nn.quantized.FloatFunctional()
+        self.scale_cats = nn.ModuleList([nn.quantized.FloatFunctional() for _ in range(self.num_scales)])
+        self.dequant = torch.quantization.DeQuantStub()
     
     def forward(self,x1,x2):
-        base_feats = [x1,x2]                   
-        self.reduce = self.reduce.cuda()
-        self.up_reduce = self.up_reduce.cuda()
+        base_feats = [x1,x2]
        
-        base_feature = torch.cat(
-                (self.reduce(base_feats[0]), 
+        base_feature = self.base_cat.cat(
+                [self.reduce(base_feats[0]), 
                  F.interpolate(self.up_reduce(base_feats[1]),
                                scale_factor = 2,
                                mode = 'nearest'
-                               )),
+                               )],
                                1
                 )
         base_feature = base_feature
@@ -130,14 +134,22 @@ class M2Det(nn.Module):                                 # Multi-level Multi-scal
                         )
                     )
         # concat with same scales
-        sources = [torch.cat([_fx[i-1] for _fx in tum_outs],1) for i in range(self.num_scales, 0, -1)]
+        sources = [self.dequant(self.scale_cats[i-1].cat([_fx[i-1] for _fx in tum_outs],1)) for i in range(self.num_scales, 0, -1)]
         
         # forward_sfam
         if self.sfam:
             sources = self.sfam_module(sources)
-        sources[0] = self.Norm(sources[0]).cuda()
+        sources[0] = self.Norm(sources[0])
         return sources
     
+    def fuse_model(self):
+        '''
+        folds BatchNorm and ReLU into the convolutions of every BasicConv, the model must be in eval mode
+        '''
+        for module in self.modules():
+            if isinstance(module, BasicConv):
+                module.fuse_model()
+
     def init_model(self, base_model_path):
         if self.backbone == 'vgg16':
             if isinstance(base_model_path, str):
@@ -182,6 +194,31 @@ def build_net(phase = 'train', size = 320, config = None):
     
     return M2Det(phase, size, config)
 
+def fmap_sizes(height, width, num_scales = 5):
+    '''
+    (height, width) of the padded input image --> list of (h, w) of the M2Det outputs, largest first.
+    Follows the ResNet stem and layer2 (stride 8 base feature) and the TUM encoder convolutions,
+    so targets can be generated without running the network.
+    '''
+    def conv_out(n, kernel_size, stride, padding):
+        return (n + 2*padding - kernel_size)//stride + 1
+
+    sizes = []
+    for n in (int(height), int(width)):
+        n = conv_out(n, 7, 2, 3)                                # conv1
+        n = conv_out(n, 3, 2, 1)                                # maxpool
+        n = conv_out(n, 3, 2, 1)                                # layer2
+        level_sizes = [n]
+        for i in range(num_scales-1):
+            if i < num_scales-2:
+                n = conv_out(n, 3, 2, 1)
+            else:
+                n = conv_out(n, 3, 1, 0)
+            level_sizes.append(n)
+        sizes.append(level_sizes)
+    
+    return list(zip(*sizes))
+
 def print_info(info, _type = None):
         if _type is not None:
             if isinstance(info,str):
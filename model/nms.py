@@ -0,0 +1,101 @@
+import torch
+from typing import Optional
+
+
+def box_iou(boxes_a, boxes_b):
+    '''
+    boxes_a [batch_size,n,4], boxes_b [batch_size,m,4] in (x1,y1,x2,y2)
+    returns iou [batch_size,n,m]
+
+    Uses the same convention as DetectHead.box_nms: areas are computed with
+    the +1 pixel offset, intersections without it.
+    '''
+    area_a = (boxes_a[...,2]-boxes_a[...,0]+1)*(boxes_a[...,3]-boxes_a[...,1]+1)      # [batch_size,n]
+    area_b = (boxes_b[...,2]-boxes_b[...,0]+1)*(boxes_b[...,3]-boxes_b[...,1]+1)      # [batch_size,m]
+
+    lt = torch.max(boxes_a[:,:,None,:2], boxes_b[:,None,:,:2])                         # [batch_size,n,m,2]
+    rb = torch.min(boxes_a[:,:,None,2:], boxes_b[:,None,:,2:])                         # [batch_size,n,m,2]
+    wh = (rb-lt).clamp(min = 0)
+    inter = wh[...,0]*wh[...,1]                                                        # [batch_size,n,m]
+
+    return inter/(area_a[:,:,None]+area_b[:,None,:]-inter)
+
+def _greedy_keep(boxes, valid, iou_threshold: float, block_size: int, fast_steps: int = 4):
+    '''
+    boxes [batch_size,n,4] sorted by descending score, valid [batch_size,n] bool
+    returns keep [batch_size,n] bool, identical to running the greedy NMS loop per image
+
+    The IoU matrix is computed one column block at a time. Boxes of earlier blocks are
+    already final, so they suppress the block in a single reduction. Inside the block
+    'keep[i] = valid[i] & no kept j<i overlaps i' is solved by fixed-point iteration,
+    which reaches the greedy result after at most block_size steps (usually 2-3), so
+    convergence is checked once per block after fast_steps iterations.
+    '''
+    n = boxes.shape[1]
+    keep = valid.clone()
+    rows = torch.arange(n, device = boxes.device)
+
+    for start in range(0, n, block_size):
+        end = min(start+block_size, n)
+        iou = box_iou(boxes[:,:end], boxes[:,start:end])                                # [batch_size,end,blk]
+        over = (iou > iou_threshold)&(rows[:end,None] < rows[None,start:end])           # only higher scores suppress
+
+        block_keep = keep[:,start:end]&~(over[:,:start]&keep[:,:start,None]).any(dim = 1)
+        over_block = over[:,start:end]                                                  # [batch_size,blk,blk]
+        # a few unconditional steps, then a single host sync: only a block that has not
+        # settled yet runs the remaining steps up to the block_size bound
+        cur = block_keep
+        for _ in range(min(fast_steps, end-start)):
+            cur = block_keep&~(over_block&cur[:,:,None]).any(dim = 1)
+        new = block_keep&~(over_block&cur[:,:,None]).any(dim = 1)
+        if not torch.equal(new, cur):
+            for _ in range(end-start):
+                new = block_keep&~(over_block&new[:,:,None]).any(dim = 1)
+        keep[:,start:end] = new
+
+    return keep
+
+def batched_nms(boxes,                                  # [batch_size,n,4]
+                scores,                                 # [batch_size,n]
+                idxs,                                   # [batch_size,n] class index of each box
+                iou_threshold: float,
+                valid: Optional[torch.Tensor] = None,   # [batch_size,n] bool, boxes that take part in nms
+                block_size: int = 512,
+                max_block_elements: int = 2**26):
+    '''
+    Vectorized class-aware NMS over a whole padded batch.
+    returns keep [batch_size,n] bool in the original box order
+
+    Boxes are shifted by 'class index * (max coordinate of the image + 1)' exactly like
+    DetectHead.batched_nms, so only boxes of the same image and class suppress each other.
+    When batch_size*n*block_size would exceed max_block_elements the block is narrowed and,
+    for very large candidate counts, images are processed in chunks to bound memory.
+    The annotations keep it compilable by torch.jit.script for the exported model (model/export.py).
+    '''
+    batch_size, n = scores.shape
+    if valid is None:
+        valid = torch.ones_like(scores, dtype = torch.bool)
+    keep = torch.zeros_like(valid)
+    if n == 0 or batch_size == 0:
+        return keep
+
+    max_coordinate = boxes.masked_fill(~valid[...,None], float('-inf')).reshape(batch_size, -1).max(dim = -1)[0]
+    max_coordinate = torch.where(valid.any(dim = -1), max_coordinate, torch.zeros_like(max_coordinate))
+    offsets = idxs.to(boxes)*(max_coordinate[:,None]+1)                                 # [batch_size,n]
+    boxes_for_nms = boxes + offsets[...,None]
+
+    order = scores.masked_fill(~valid, float('-inf')).sort(dim = -1, descending = True)[1]
+    sorted_boxes = boxes_for_nms.gather(1, order[...,None].expand(-1,-1,4))
+    sorted_valid = valid.gather(1, order)
+
+    block_size = max(1, min(block_size, n, max_block_elements//n))
+    images_per_chunk = max(1, max_block_elements//(n*block_size))
+
+    keep_sorted = torch.cat([_greedy_keep(sorted_boxes[i:i+images_per_chunk],
+                                          sorted_valid[i:i+images_per_chunk],
+                                          iou_threshold,
+                                          block_size)
+                             for i in range(0, batch_size, images_per_chunk)], dim = 0)
+
+    return keep.scatter_(1, order, keep_sorted)
+
@@ -17,12 +17,12 @@ class BasicConv(nn.Module):
                               padding = padding, 
                               dilation = dilation, 
                               groups = groups, 
-                              bias = bias).cuda()
+                              bias = bias)
         self.bn = nn.BatchNorm2d(out_planes,
                                  eps = 1e-5, 
                                  momentum = 0.01, 
-                                 affine = True).cuda() if bn else None
-        self.relu = nn.ReLU(inplace = True).cuda() if relu else None
+                                 affine = True) if bn else None
+        self.relu = nn.ReLU(inplace = True) if relu else None
         
     def forward(self, x):
         x = self.conv(x)
@@ -30,7 +30,12 @@ class BasicConv(nn.Module):
             x = self.bn(x)
         if self.relu is not None:
             x = self.relu(x)
-        return x.cuda()
+        return x
+
+    def fuse_model(self):
+        names = ['conv'] + (['bn'] if self.bn is not None else []) + (['relu'] if self.relu is not None else [])
+        if len(names) > 1:
+            torch.quantization.fuse_modules(self, names, inplace = True)
 
 class TUM(nn.Module):
     def __init__(self, first_level = True, input_planes = 128, is_smooth = True, side_channel = 512, scales = 6):
@@ -74,17 +79,21 @@ class TUM(nn.Module):
                         )
             self.smooth = nn.Sequential(*smooth)
 
-    def _upsample_add(self, x, y, fuse_type = 'interp'):
+        # cat and add as modules, so they become quantized ops after torch.quantization.convert
+        self.side_cat = nn.quantized.FloatFunctional()
+        self.upsample_adds = nn.ModuleList([nn.quantized.FloatFunctional() for _ in range(len(self.latlayer))])
+
+    def _upsample_add(self, x, y, index, fuse_type = 'interp'):
         _,_,H,W = y.size()
         if fuse_type == 'interp':
-            return F.interpolate(x, size = (H,W), mode = 'nearest') + y
+            return self.upsample_adds[index].add(F.interpolate(x, size = (H,W), mode = 'nearest'), y)
         else:
             raise NotImplementedError
             
 
     def forward(self, x, y):
         if not self.first_level:
-            x = torch.cat([x,y],1)
+            x = self.side_cat.cat([x,y],1)
         conved_feat = [x]
         for i in range(len(self.layers)):
             x = self.layers[i](x)
@@ -94,7 +103,7 @@ class TUM(nn.Module):
         for i in range(len(self.latlayer)):
             deconved_feat.append(
                     self._upsample_add(
-                        deconved_feat[i], self.latlayer[i](conved_feat[len(self.layers)-1-i])
+                        deconved_feat[i], self.latlayer[i](conved_feat[len(self.layers)-1-i]), i
                         )
                     )
         if self.is_smooth:
@@ -118,15 +127,15 @@ class SFAM(nn.Module):
 
         self.fc1 = nn.ModuleList([nn.Conv2d(self.planes*self.num_levels,
                                                  self.planes*self.num_levels // 16,
-                                                 1, 1, 0)] * self.num_scales).cuda()
-        self.relu = nn.ReLU(inplace = True).cuda()
+                                                 1, 1, 0)] * self.num_scales)
+        self.relu = nn.ReLU(inplace = True)
         self.fc2 = nn.ModuleList([nn.Conv2d(self.planes*self.num_levels // 16,
                                                  self.planes*self.num_levels,
-                                                 1, 1, 0)] * self.num_scales).cuda()
+                                                 1, 1, 0)] * self.num_scales)
         self.fc3 = nn.ModuleList([nn.Conv2d(self.planes*self.num_levels,
-                                                 256,1, 1, 0)] * self.num_scales).cuda()
-        self.sigmoid = nn.Sigmoid().cuda()
-        self.avgpool = nn.AdaptiveAvgPool2d(1).cuda()
+                                                 256,1, 1, 0)] * self.num_scales)
+        self.sigmoid = nn.Sigmoid()
+        self.avgpool = nn.AdaptiveAvgPool2d(1)
 
     def forward(self, x):
         
@@ -0,0 +1,176 @@
+import inspect
+import numpy as np
+import torch
+import torch.nn as nn
+from .export import _FlatBody
+
+
+def export_onnx(detector, path, example_size = (800, 1088), opset_version = 11):
+    '''
+    detector FCOSDetector in mode "inference" (or wrapped in DataParallel)
+    Exports backbone, MLFPN neck and ClsCntRegHead to 'path' with dynamic batch, height and width.
+    Opset 11 is the newest torch==1.4 exports (onnxruntime 1.6 loads up to 13), the graph is plain
+    conv, norm, resize and concat.
+    Outputs are the raw logits of every level: cls_logits_i [b,class_num,h_i,w_i], cnt_logits_i
+    [b,1,h_i,w_i], reg_preds_i [b,4,h_i,w_i]; decode, top-k and nms run in NumpyDetectHead.
+    '''
+    if isinstance(detector, nn.DataParallel):
+        detector = detector.module
+    head = detector.detection_head
+    num_levels = len(head.strides)
+    device = next(detector.parameters()).device
+
+    body = _FlatBody(detector.fcos_body).eval()
+    output_names = ["%s_%d"%(name, i) for name in ("cls_logits", "cnt_logits", "reg_preds") for i in range(num_levels)]
+    dynamic_axes = {name: {0: "batch", 2: "h_%s"%name, 3: "w_%s"%name} for name in output_names}
+    dynamic_axes["images"] = {0: "batch", 2: "height", 3: "width"}
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # newer torch defaults to the dynamo exporter, which can not emit opset 11
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(body, torch.zeros(1, 3, *example_size, device = device), path,
+                          input_names = ["images"],
+                          output_names = output_names,
+                          dynamic_axes = dynamic_axes,
+                          opset_version = opset_version,
+                          **kwargs)
+    print("INFO===>exported onnx model to %s"%path)
+
+def _sigmoid(x):
+    return 1./(1.+np.exp(-x))
+
+def box_iou_np(boxes_a, boxes_b):
+    '''
+    boxes_a [batch_size,n,4], boxes_b [batch_size,m,4], same convention as nms.box_iou
+    returns iou [batch_size,n,m]
+    '''
+    area_a = (boxes_a[...,2]-boxes_a[...,0]+1)*(boxes_a[...,3]-boxes_a[...,1]+1)
+    area_b = (boxes_b[...,2]-boxes_b[...,0]+1)*(boxes_b[...,3]-boxes_b[...,1]+1)
+    lt = np.maximum(boxes_a[:,:,None,:2], boxes_b[:,None,:,:2])
+    rb = np.minimum(boxes_a[:,:,None,2:], boxes_b[:,None,:,2:])
+    wh = np.clip(rb-lt, 0, None)
+    inter = wh[...,0]*wh[...,1]
+
+    return inter/(area_a[:,:,None]+area_b[:,None,:]-inter)
+
+def batched_nms_np(boxes, scores, idxs, iou_threshold, valid):
+    '''
+    NumPy version of nms.batched_nms with the whole candidate set as one block
+    boxes [batch_size,n,4], scores, idxs, valid [batch_size,n]
+    returns keep [batch_size,n] bool in the original box order
+    '''
+    batch_size, n = scores.shape
+    keep = np.zeros_like(valid)
+    if n == 0 or batch_size == 0:
+        return keep
+
+    max_coordinate = np.where(valid[...,None], boxes, -np.inf).reshape(batch_size, -1).max(axis = -1)
+    max_coordinate = np.where(valid.any(axis = -1), max_coordinate, 0).astype(boxes.dtype)
+    boxes_for_nms = boxes + (idxs.astype(boxes.dtype)*(max_coordinate[:,None]+1))[...,None]
+
+    order = np.argsort(-np.where(valid, scores, -np.inf), axis = -1, kind = 'stable')
+    sorted_boxes = np.take_along_axis(boxes_for_nms, order[...,None], axis = 1)
+    sorted_valid = np.take_along_axis(valid, order, axis = 1)
+
+    # keep[i] = valid[i] & no kept j<i overlaps i, solved by fixed-point iteration like nms._greedy_keep
+    over = box_iou_np(sorted_boxes, sorted_boxes) > iou_threshold
+    over &= np.triu(np.ones((n, n), dtype = bool), 1)[None]
+    cur = sorted_valid
+    for _ in range(n):
+        new = sorted_valid&~(over&cur[:,:,None]).any(axis = 1)
+        if np.array_equal(new, cur):
+            break
+        cur = new
+    np.put_along_axis(keep, order, cur, axis = 1)
+
+    return keep
+
+class NumpyDetectHead(object):
+    '''
+    NumPy port of fcos.DetectHead (topk + _post_process) and fcos.ClipBoxes, which stay the
+    reference: a change there has to be mirrored here, the parity check in __main__ catches drift.
+    Runs on the outputs of the ONNX graph with the same fixed-size padded outputs:
+    scores, classes [batch_size,max_num], boxes [batch_size,max_num,4], num_dets [batch_size]
+    '''
+    def __init__(self, strides, score_threshold, nms_iou_threshold, max_detection_boxes_num, add_centerness):
+        self.strides = strides
+        self.score_threshold = score_threshold
+        self.nms_iou_threshold = nms_iou_threshold
+        self.max_detection_boxes_num = max_detection_boxes_num
+        self.add_centerness = add_centerness
+
+    def _reshape_cat_out(self, inputs):
+        batch_size, c = inputs[0].shape[:2]
+        out = []
+        coords = []
+        for pred, stride in zip(inputs, self.strides):
+            h, w = pred.shape[2:]
+            # same as loss._make_coords
+            shift_y, shift_x = np.meshgrid(np.arange(0, h * stride, stride, dtype = np.float32),
+                                           np.arange(0, w * stride, stride, dtype = np.float32), indexing = 'ij')
+            coords.append(np.stack([shift_x.reshape(-1), shift_y.reshape(-1)], -1) + stride // 2)
+            out.append(pred.transpose(0,2,3,1).reshape(batch_size, -1, c))
+        return np.concatenate(out, axis = 1), np.concatenate(coords, axis = 0)
+
+    def __call__(self, outs, img_hw):
+        num_levels = len(self.strides)
+        cls_logits, coords = self._reshape_cat_out(outs[:num_levels])                       # [batch_size,sum(_h*_w),class_num]
+        cnt_logits, _ = self._reshape_cat_out(outs[num_levels:2*num_levels])               # [batch_size,sum(_h*_w),1]
+        reg_preds, _ = self._reshape_cat_out(outs[2*num_levels:])                          # [batch_size,sum(_h*_w),4]
+
+        cls_preds = _sigmoid(cls_logits)
+        cls_classes = cls_preds.argmax(axis = -1)
+        cls_scores = np.take_along_axis(cls_preds, cls_classes[...,None], axis = -1)[...,0]
+        if self.add_centerness:
+            cls_scores = np.sqrt(cls_scores*_sigmoid(cnt_logits[...,0]))
+        cls_classes = cls_classes + 1
+        boxes = np.concatenate([coords[None]-reg_preds[...,:2], coords[None]+reg_preds[...,2:]], axis = -1)
+
+        max_num = min(self.max_detection_boxes_num, cls_scores.shape[-1])
+        topk_ind = np.argpartition(-cls_scores, max_num-1, axis = -1)[:,:max_num]
+        topk_ind = np.take_along_axis(topk_ind, np.argsort(-np.take_along_axis(cls_scores, topk_ind, axis = -1), axis = -1, kind = 'stable'), axis = -1)
+        scores_topk = np.take_along_axis(cls_scores, topk_ind, axis = -1)                  # [batch_size,max_num]
+        classes_topk = np.take_along_axis(cls_classes, topk_ind, axis = -1)
+        boxes_topk = np.take_along_axis(boxes, topk_ind[...,None], axis = 1)
+
+        keep = batched_nms_np(boxes_topk, scores_topk, classes_topk, self.nms_iou_threshold,
+                              scores_topk >= self.score_threshold)
+        num_dets = keep.sum(axis = -1)
+        ind = np.broadcast_to(np.arange(max_num), keep.shape)
+        order = np.argsort(np.where(keep, ind, ind + max_num), axis = -1)
+        pad = ind >= num_dets[:,None]
+        scores = np.where(pad, 0, np.take_along_axis(scores_topk, order, axis = -1)).astype(np.float32)
+        classes = np.where(pad, 0, np.take_along_axis(classes_topk, order, axis = -1)).astype(np.int64)
+        boxes = np.where(pad[...,None], 0, np.take_along_axis(boxes_topk, order[...,None], axis = 1)).astype(np.float32)
+
+        h, w = img_hw
+        boxes = np.clip(boxes, 0, None)
+        boxes[...,[0,2]] = np.clip(boxes[...,[0,2]], None, w-1)
+        boxes[...,[1,3]] = np.clip(boxes[...,[1,3]], None, h-1)
+
+        return scores, classes, boxes, num_dets.astype(np.int64)
+
+class OnnxDetector(object):
+    '''
+    ONNX Runtime body + NumpyDetectHead behind the FCOSDetector inference interface:
+    called with a [batch_size,3,h,w] float tensor, returns (scores, classes, boxes, num_dets) as
+    CPU tensors, so InferenceRunner and the eval loops use it unchanged.
+    '''
+    def __init__(self, path, config, num_threads = None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers = ['CPUExecutionProvider'])
+        self.head = NumpyDetectHead(config.strides, config.score_threshold, config.nms_iou_threshold,
+                                    config.max_detection_boxes_num, config.add_centerness)
+
+    def eval(self):
+        return self
+
+    def __call__(self, batch_imgs):
+        imgs = batch_imgs.detach().cpu().numpy() if torch.is_tensor(batch_imgs) else np.asarray(batch_imgs)
+        outs = self.session.run(None, {"images": np.ascontiguousarray(imgs, dtype = np.float32)})
+        return tuple(torch.from_numpy(t) for t in self.head(outs, imgs.shape[2:]))
+
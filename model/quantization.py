@@ -0,0 +1,38 @@
+import torch
+import torch.nn as nn
+
+
+def quantize_detector(detector, calib_batches, backend = 'fbgemm'):
+    '''
+    Post-training static int8 quantization of an FCOSDetector (mode "inference"), in place, on the CPU.
+    Conv+BN(+ReLU) are fused in every Bottleneck, the ResNet stem and every BasicConv of the MLFPN
+    neck; backbone and neck (8 TUMs) then run in int8 with activation ranges observed on
+    calib_batches, normalized [batch_size,3,h,w] images e.g. from VOCDataset.collate_fn.
+    SFAM, its BatchNorm and ClsCntRegHead (GroupNorm, exp) stay float, so DetectHead decodes
+    the outputs unchanged.
+    returns the detector
+    '''
+    if isinstance(detector, nn.DataParallel):
+        detector = detector.module
+    body = detector.fcos_body
+    detector.cpu().eval()
+    body.fuse_model()
+
+    torch.backends.quantized.engine = backend
+    qconfig = torch.quantization.get_default_qconfig(backend)
+    for module in [body.quant, body.backbone, body.mlfpn]:
+        module.qconfig = qconfig
+    body.mlfpn.sfam_module.qconfig = None
+    body.mlfpn.Norm.qconfig = None
+    torch.quantization.prepare(body, inplace = True)
+
+    num_imgs = 0
+    with torch.no_grad():
+        for imgs in calib_batches:
+            body(imgs)
+            num_imgs += len(imgs)
+            print(num_imgs, end = '\r')
+    torch.quantization.convert(body, inplace = True)
+    print("INFO===>int8 backbone and neck calibrated on %d imgs"%num_imgs)
+
+    return detector
@@ -0,0 +1,52 @@
+import numpy as np
+import argparse
+import time
+from multiprocessing import Pool
+from PIL import Image
+from dataset.VOC_dataset import VOCDataset, get_resize_scale
+from dataset.image_shards import ShardWriter
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--root_dir", type = str, default = './data/VOCdevkit/VOC2007', help = "VOC root directory")
+parser.add_argument("--split", type = str, default = 'trainval', help = "image set to preprocess")
+parser.add_argument("--out_dir", type = str, default = './data/cache/VOC2007_trainval_800x1333', help = "output directory of the shards")
+parser.add_argument("--min_side", type = int, default = 800, help = "resize_size[0] of VOCDataset")
+parser.add_argument("--max_side", type = int, default = 1333, help = "resize_size[1] of VOCDataset")
+parser.add_argument("--shard_size_mb", type = int, default = 1024, help = "approximate size of one shard file")
+parser.add_argument("--n_cpu", type = int, default = 8, help = "number of processes decoding and resizing")
+
+_dataset = None
+
+def _init_worker(dataset):
+    global _dataset
+    _dataset = dataset
+
+def _load_resized(index):
+    '''
+    decode and resize one image exactly like VOCDataset.__getitem__ does without augmentation
+    '''
+    img = np.array(Image.open(_dataset._imgpath%_dataset.img_ids[index]))
+    h, w, _ = img.shape
+    scale = get_resize_scale(h, w, _dataset.resize_size)
+    img_paded = _dataset.preprocess_img_boxes(img, None, _dataset.resize_size)
+
+    return img_paded, (int(scale * h), int(scale * w)), scale
+
+def write_shards(dataset, out_dir, shard_size_mb = 1024, n_cpu = 8):
+    writer = ShardWriter(out_dir, dataset.img_ids, dataset.resize_size, shard_size_mb)
+    start_t = time.time()
+    with Pool(n_cpu, initializer = _init_worker, initargs = (dataset,)) as pool:
+        for num, (img_paded, resized_hw, scale) in enumerate(pool.imap(_load_resized, range(len(dataset)), chunksize = 16)):
+            writer.append(img_paded, resized_hw, scale)
+            print(num + 1, end = '\r')
+    writer.close()
+    print("===>wrote %d imgs in %d shards to %s, cost time %.1f s"%(len(dataset), writer.num_shards, out_dir, time.time()-start_t))
+
+if __name__=="__main__":
+    opt = parser.parse_args()
+    dataset = VOCDataset(root_dir = opt.root_dir,
+                         resize_size = [opt.min_side, opt.max_side],
+                         split = opt.split,
+                         is_train = False
+                         )
+    write_shards(dataset, opt.out_dir, opt.shard_size_mb, opt.n_cpu)
@@ -0,0 +1,94 @@
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+from model.fcos import FCOSDetector
+from model.config import DefaultConfig
+from model.export import export_torchscript
+from model.quantization import quantize_detector
+from dataset.VOC_dataset import VOCDataset, get_resize_scale
+from eval_voc import StreamingEvaluator
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--root_dir", type = str, default = './data/VOCdevkit/VOC2007', help = "VOC root directory")
+parser.add_argument("--checkpoint", type = str, default = "./checkpoint/model_16.pth", help = "fp32 model weights")
+parser.add_argument("--calib_split", type = str, default = 'trainval', help = "image set the activation ranges are observed on")
+parser.add_argument("--calib_imgs", type = int, default = 100, help = "number of calibration images")
+parser.add_argument("--eval_split", type = str, default = 'test', help = "image set mAP is measured on")
+parser.add_argument("--num_eval_imgs", type = int, default = 0, help = "evaluate on the first n images only, 0 for all")
+parser.add_argument("--min_side", type = int, default = 800, help = "resize_size[0] of VOCDataset")
+parser.add_argument("--max_side", type = int, default = 1333, help = "resize_size[1] of VOCDataset")
+parser.add_argument("--batch_size", type = int, default = 1, help = "images per forward pass")
+parser.add_argument("--n_cpu", type = int, default = 4, help = "data loader workers")
+parser.add_argument("--backend", type = str, default = 'fbgemm', help = "quantized engine, fbgemm (x86) or qnnpack (arm)")
+parser.add_argument("--out", type = str, default = None, help = "save the int8 model as torchscript here")
+
+def evaluate(model, loader, scales, num_cls):
+    '''
+    returns mAP@0.5 as computed by eval_voc.py and the p50 forward latency (ms), classes without
+    ground truth in a --num_eval_imgs subset (nan AP) are left out of the mean
+    '''
+    evaluator = StreamingEvaluator(num_cls, iou_thread = 0.5, coco = False)
+    latencies = []
+    num = 0
+    for imgs, boxes, classes in loader:
+        start_t = time.time()
+        with torch.no_grad():
+            scores, pred_classes, pred_boxes, num_dets = model(imgs)
+        latencies.append((time.time() - start_t)*1000.)
+        evaluator.add(scores, pred_classes, pred_boxes, num_dets, boxes, classes, scales[num:num+len(imgs)])
+        num += len(imgs)
+        print(num, end = '\r')
+    all_AP, _ = evaluator.summarize()
+    aps = np.array([float(ap) for ap in all_AP.values()])
+    mAP = float(np.nanmean(aps)) if not np.isnan(aps).all() else 0.
+
+    return mAP, float(np.percentile(latencies, 50))
+
+
+if __name__=="__main__":
+    opt = parser.parse_args()
+    resize_size = [opt.min_side, opt.max_side]
+
+    class Config(DefaultConfig):
+        pretrained = False
+
+    model = torch.nn.DataParallel(FCOSDetector(mode = "inference", config = Config))
+    model.load_state_dict(torch.load(opt.checkpoint, map_location = torch.device('cpu')))
+    model = model.module.eval()
+    print("===>success loading model")
+
+    calib_dataset = VOCDataset(root_dir = opt.root_dir, resize_size = resize_size,
+                               split = opt.calib_split, use_difficult = False, is_train = False, augment = None)
+    calib_subset = torch.utils.data.Subset(calib_dataset, range(min(opt.calib_imgs, len(calib_dataset))))
+    calib_loader = torch.utils.data.DataLoader(calib_subset,
+                                               batch_size = opt.batch_size,
+                                               shuffle = False,
+                                               num_workers = opt.n_cpu,
+                                               collate_fn = calib_dataset.collate_fn)
+    int8_model = quantize_detector(copy.deepcopy(model), (imgs for imgs, _, _ in calib_loader), backend = opt.backend)
+
+    eval_dataset = VOCDataset(root_dir = opt.root_dir, resize_size = resize_size,
+                              split = opt.eval_split, use_difficult = False, is_train = False, augment = None)
+    num_eval_imgs = len(eval_dataset) if opt.num_eval_imgs <= 0 else min(opt.num_eval_imgs, len(eval_dataset))
+    print("INFO===>eval dataset has %d imgs, evaluating %d"%(len(eval_dataset), num_eval_imgs))
+    eval_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(eval_dataset, range(num_eval_imgs)),
+                                              batch_size = opt.batch_size,
+                                              shuffle = False,
+                                              num_workers = opt.n_cpu,
+                                              collate_fn = eval_dataset.collate_fn)
+    scales = np.array([get_resize_scale(h, w, resize_size) for h, w in eval_dataset.img_sizes()[:num_eval_imgs]])
+    num_cls = len(eval_dataset.CLASSES_NAME)
+
+    fp32_mAP, fp32_latency = evaluate(model, eval_loader, scales, num_cls)
+    int8_mAP, int8_latency = evaluate(int8_model, eval_loader, scales, num_cls)
+
+    print("             mAP      p50 forward (ms)")
+    print("fp32      %.4f      %10.1f"%(fp32_mAP, fp32_latency))
+    print("int8      %.4f      %10.1f"%(int8_mAP, int8_latency))
+    print("delta    %+.4f      speedup %.2fx"%(int8_mAP - fp32_mAP, fp32_latency/max(int8_latency, 1e-9)))
+
+    if opt.out is not None:
+        example = next(iter(eval_loader))[0]
+        export_torchscript(int8_model, opt.out, example_size = tuple(example.shape[2:]))
@@ -0,0 +1,30 @@
+import os
+import numpy as np
+from dataset.VOC_dataset import VOCDataset
+
+XML = '''<annotation><size><width>100</width><height>80</height><depth>3</depth></size>
+<object><name>%s</name><difficult>0</difficult><bndbox><xmin>%d</xmin><ymin>5</ymin><xmax>50</xmax><ymax>60</ymax></bndbox></object>
+</annotation>'''
+
+
+def _voc_root(root, name, xmin):
+    os.makedirs(os.path.join(root, "Annotations"))
+    os.makedirs(os.path.join(root, "ImageSets", "Main"))
+    with open(os.path.join(root, "ImageSets", "Main", "test.txt"), 'w') as f:
+        f.write("000001\n")
+    with open(os.path.join(root, "Annotations", "000001.xml"), 'w') as f:
+        f.write(XML%(name, xmin))
+    # same size and mtime for both roots, only the content differs
+    os.utime(os.path.join(root, "Annotations", "000001.xml"), (1e9, 1e9))
+    return root
+
+def test_roots_sharing_anno_index_dir(tmp_path):
+    index_dir = str(tmp_path / "index")
+    root_a = _voc_root(str(tmp_path / "a"), "dog", 10)
+    root_b = _voc_root(str(tmp_path / "b"), "cat", 20)
+    for root in [root_a, root_b, root_a]:
+        indexed = VOCDataset(root, split = 'test', is_train = False, anno_index_dir = index_dir)
+        parsed = VOCDataset(root, split = 'test', is_train = False)
+        for got, ref in zip(indexed.load_anno(0), parsed._parse_anno("000001")):
+            assert np.array_equal(got, ref)
+    assert len(os.listdir(index_dir)) == 2
@@ -0,0 +1,18 @@
+import math
+import numpy as np
+from dataset.augment import _rotate_boxes
+from benchmark import rotate_boxes_loop
+
+
+def test_rotate_boxes_matches_loop():
+    rng = np.random.RandomState(0)
+    w, h = 500, 375
+    for n in [0, 1, 10, 100]:
+        xy = rng.rand(n, 2)*np.array([w-50, h-50])
+        boxes = np.concatenate([xy, xy + rng.rand(n, 2)*50 + 1], axis = 1).astype(np.float32)
+        # large angles too, so boxes get clipped at the image border
+        for degrees in [-30., -10., 0., 7.5, 45.]:
+            a = degrees/180.0*math.pi
+            got = _rotate_boxes(boxes, a, w/2.0, h/2.0, w, h)
+            assert got.dtype == np.float32 and got.shape == (n, 4)
+            assert np.allclose(got, rotate_boxes_loop(boxes.copy(), a, w/2.0, h/2.0, w, h), atol = 1e-4)
@@ -0,0 +1,73 @@
+import torch
+from dataset.batch_augment import BatchAugment, _fill_padding
+
+MEAN, STD = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+
+def _batch(extents, H = 64, W = 96, seed = 0):
+    '''
+    normalized batch like VOCDataset.collate_fn, random pixels inside each extent, black padding
+    returns batch_imgs [n,3,H,W], pixels [n,3,H,W] in [0,1]
+    '''
+    g = torch.Generator().manual_seed(seed)
+    pixels = torch.zeros(len(extents), 3, H, W)
+    for k, (h, w) in enumerate(extents):
+        pixels[k, :, :h, :w] = torch.randint(0, 256, (3, h, w), generator = g).float()/255.
+    mean, std = torch.tensor(MEAN)[:, None, None], torch.tensor(STD)[:, None, None]
+    return (pixels - mean)/std, pixels
+
+def test_jitter_matches_pixel_space():
+    extents = [(64, 96), (40, 70), (64, 33)]
+    batch_imgs, pixels = _batch(extents)
+    augment = BatchAugment(MEAN, STD, brightness = 0.4, contrast = 0.4, saturation = 0.4, hue = 0.1)
+    hw = torch.tensor(extents, dtype = torch.float32)
+
+    torch.manual_seed(0)
+    out = augment._jitter(batch_imgs, hw, torch.ones(len(extents), dtype = torch.bool))
+
+    # the same random affine, applied to the [0,1] pixels and normalized afterwards
+    channel_mean = torch.stack([pixels[k, :, :h, :w].mean(dim = [1, 2]) for k, (h, w) in enumerate(extents)])
+    torch.manual_seed(0)
+    A, t = augment._jitter_affine(channel_mean)
+    for k, (h, w) in enumerate(extents):
+        x = pixels[k, :, :h, :w].reshape(3, -1)
+        expected = ((A[k] @ x + t[k]).clamp(0, 1).view(3, h, w) - torch.tensor(MEAN)[:, None, None])/torch.tensor(STD)[:, None, None]
+        assert (out[k, :, :h, :w] - expected).abs().max() < 1e-4
+        assert torch.equal(out[k, :, h:], batch_imgs[k, :, h:])
+        assert torch.equal(out[k, :, :h, w:], batch_imgs[k, :, :h, w:])
+
+def test_fill_padding():
+    out = torch.randn(2, 3, 5, 7)
+    pad_value = torch.tensor([1., 2., 3.])
+    filled = _fill_padding(out, torch.tensor([[5., 7.], [3., 4.]]), pad_value)
+    assert torch.equal(filled[0], out[0])
+    assert torch.equal(filled[1, :, :3, :4], out[1, :, :3, :4])
+    assert bool((filled[1, :, 3:] == pad_value[:, None, None]).all())
+    assert bool((filled[1, :, :, 4:] == pad_value[:, None, None]).all())
+
+def test_flip_uses_given_extent():
+    # black content at the right edge must not shrink the extent
+    batch_imgs, _ = _batch([(64, 96)])
+    batch_imgs[..., 60:] = BatchAugment(MEAN, STD).pad_value[:, None, None]
+    augment = BatchAugment(MEAN, STD, flip_prob = 1., jitter_prob = 0., crop_prob = 0.)
+    boxes = torch.tensor([[[50., 10., 90., 40.], [0., 0., 95., 63.]]])
+    classes = torch.tensor([[1, 2]])
+    out, out_boxes = augment(batch_imgs, boxes, classes, torch.tensor([[64, 96]]))
+    assert torch.equal(out_boxes, torch.tensor([[[6., 10., 46., 40.], [1., 0., 95., 63.]]]))
+    assert (out - batch_imgs.flip(3)).abs().max() < 1e-4
+
+def test_crop_keeps_aspect_ratio():
+    batch_imgs, _ = _batch([(64, 96)] * 4)
+    # remain_min close to 1, a window never cuts the box
+    augment = BatchAugment(MEAN, STD, flip_prob = 0., jitter_prob = 0., crop_prob = 1., remain_min = 0.999)
+    boxes = torch.tensor([[[20., 20., 40., 40.]]]).repeat(4, 1, 1)
+    classes = torch.ones(4, 1, dtype = torch.long)
+    torch.manual_seed(0)
+    out, out_boxes = augment(batch_imgs, boxes, classes, torch.tensor([[64, 96]] * 4))
+    assert out.shape == batch_imgs.shape
+    assert bool((out_boxes >= 0).all()) and bool((out_boxes[..., 2] <= 95).all()) and bool((out_boxes[..., 3] <= 63).all())
+    # the original box was square, it stays square after the crop
+    wh = out_boxes[..., 2:] - out_boxes[..., :2]
+    cropped = wh[..., 0] != 20
+    assert bool(cropped.any())
+    assert (wh[..., 0] - wh[..., 1]).abs().max() < 1e-3
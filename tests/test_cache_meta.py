@@ -0,0 +1,17 @@
+import os
+from dataset.cache_meta import invalidate_meta, write_meta, read_meta
+
+
+def test_meta_marks_complete_directory(tmp_path):
+    cache_dir = str(tmp_path)
+    assert read_meta(cache_dir) is None
+    open(os.path.join(cache_dir, 'boxes.npy'), 'w').close()
+    write_meta(cache_dir, dict(key = 1))
+    assert read_meta(cache_dir, ['boxes.npy']) == dict(key = 1)
+    assert read_meta(cache_dir, ['boxes.npy', 'classes.npy']) is None
+    assert sorted(os.listdir(cache_dir)) == ['boxes.npy', 'meta.json']
+
+    # a rebuild drops the marker before touching the data files
+    invalidate_meta(cache_dir)
+    assert read_meta(cache_dir, ['boxes.npy']) is None
+    invalidate_meta(cache_dir)
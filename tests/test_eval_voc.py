@@ -0,0 +1,25 @@
+import os
+import numpy as np
+import eval_voc
+from eval_voc import eval_ap_2d, eval_ap_2d_parallel
+from benchmark import synthetic_detections, eval_ap_2d_loop
+
+
+def test_eval_ap_2d_matches_loop():
+    # rounded scores give ties, empty images and classes without predictions are covered too
+    data = synthetic_detections(30, 20, num_cls = 6)
+    data[2][3], data[3][3], data[4][3] = data[2][3][:0], data[3][3][:0], data[4][3][:0]
+    for iou_thread in [0.3, 0.5, 0.75]:
+        assert eval_ap_2d(*data, iou_thread, 8) == eval_ap_2d_loop(*data, iou_thread, 8)
+
+def test_parallel_matches_eval_ap_2d(monkeypatch, tmp_path):
+    # watch the shared input directory, it must be gone once the pool is done
+    monkeypatch.setattr(eval_voc, "_shared_memory_dir", lambda: str(tmp_path))
+    # num_workers is capped by the cpu count, make sure the pool runs on small machines too
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+    data = synthetic_detections(40, 30, num_cls = 6)
+    iou_threads = np.linspace(0.5, 0.95, 10)
+    reference = {float(t): eval_ap_2d(*data, t, 6) for t in iou_threads}
+    for workers in [0, 2]:
+        assert eval_ap_2d_parallel(*data, iou_threads, 6, num_workers = workers) == reference
+    assert os.listdir(str(tmp_path)) == []
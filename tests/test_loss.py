@@ -0,0 +1,48 @@
+import pytest
+import torch
+from model.loss import LOSS, compute_fused_loss, compute_cls_loss, compute_cnt_loss, compute_reg_loss
+
+SHAPES = [(16,16),(8,8),(4,4),(2,2),(1,1)]
+
+
+def _preds_targets(seed = 0):
+    '''
+    random head outputs for a batch of 4 and targets with ~10% positives, image 3 has none
+    '''
+    torch.manual_seed(seed)
+    preds = [[torch.randn(4,20,h,w) for h,w in SHAPES],
+             [torch.randn(4,1,h,w) for h,w in SHAPES],
+             [torch.rand(4,4,h,w)*50+1 for h,w in SHAPES]]
+    num = sum(h*w for h,w in SHAPES)
+    mask = torch.rand(4,num) < 0.1
+    mask[3] = False
+    cls_targets = torch.randint(1,21,(4,num,1))*mask[...,None]
+    cnt_targets = torch.where(mask[...,None], torch.rand(4,num,1), -torch.ones(4,num,1))
+    reg_targets = torch.where(mask[...,None], torch.rand(4,num,4)*50+1, -torch.ones(4,num,4))
+    return preds, [cls_targets,cnt_targets,reg_targets], mask
+
+@pytest.mark.parametrize("mode", ['giou', 'iou'])
+def test_fused_matches_per_image(mode):
+    preds, targets, mask = _preds_targets()
+    fused = compute_fused_loss(preds, targets, mask, mode = mode)
+    reference = [compute_cls_loss(preds[0], targets[0], mask),
+                 compute_cnt_loss(preds[1], targets[1], mask),
+                 compute_reg_loss(preds[2], targets[2], mask, mode = mode)]
+    for a, b in zip(fused, reference):
+        assert a.shape == b.shape == (4,)
+        assert torch.allclose(a, b, rtol = 1e-5, atol = 1e-6)
+
+def test_loss_module_fused_default_gradients():
+    preds, targets, _ = _preds_targets(seed = 1)
+    grads = []
+    for loss_fn in [LOSS(), LOSS(fused = False)]:
+        leaves = [[p.clone().requires_grad_() for p in level] for level in preds]
+        losses = loss_fn([leaves, targets])
+        losses[-1].backward()
+        grads.append((losses, [p.grad for level in leaves for p in level]))
+    (fused_losses, fused_grads), (ref_losses, ref_grads) = grads
+    assert LOSS().fused
+    for a, b in zip(fused_losses, ref_losses):
+        assert torch.allclose(a, b, rtol = 1e-5, atol = 1e-6)
+    for a, b in zip(fused_grads, ref_grads):
+        assert torch.allclose(a, b, rtol = 1e-4, atol = 1e-6)
@@ -0,0 +1,38 @@
+import pytest
+import torch
+from model.nms import batched_nms, _greedy_keep
+from model.fcos import DetectHead
+
+
+def _random_boxes(batch_size, n, num_cls, seed = 0):
+    g = torch.Generator().manual_seed(seed)
+    xy = torch.rand(batch_size, n, 2, generator = g)*600
+    wh = torch.rand(batch_size, n, 2, generator = g)*200+1
+    boxes = torch.cat([xy, xy+wh], dim = -1)
+    scores = torch.rand(batch_size, n, generator = g)
+    classes = torch.randint(1, num_cls+1, (batch_size, n), generator = g)
+    return boxes, scores, classes
+
+@pytest.mark.parametrize("n,num_cls,thr", [(0, 3, 0.5), (1, 3, 0.5), (50, 1, 0.5), (300, 5, 0.6), (1000, 20, 0.6), (1000, 20, 0.3)])
+def test_batched_nms_matches_box_nms(n, num_cls, thr):
+    boxes, scores, classes = _random_boxes(4, n, num_cls)
+    valid = scores >= 0.05
+    keep = batched_nms(boxes, scores, classes, thr, valid = valid, block_size = 128)
+
+    for b in range(4):
+        boxes_b, scores_b, classes_b = boxes[b][valid[b]], scores[b][valid[b]], classes[b][valid[b]]
+        if boxes_b.numel() == 0:
+            ref = set()
+        else:
+            offsets = classes_b.to(boxes_b)*(boxes_b.max()+1)
+            ref = set(DetectHead.box_nms(boxes_b+offsets[:,None], scores_b, thr).tolist())
+        got = set(torch.nonzero(keep[b][valid[b]]).view(-1).tolist())
+        assert ref == got
+    assert not bool((keep & ~valid).any())
+
+def test_greedy_keep_long_suppression_chain():
+    # each box overlaps only its neighbour, so the fixed point needs more than fast_steps iterations
+    x = torch.arange(40, dtype = torch.float32)*6
+    boxes = torch.stack([x, torch.zeros_like(x), x+10, torch.full_like(x, 10)], dim = -1)[None]
+    keep = _greedy_keep(boxes, torch.ones(1, 40, dtype = torch.bool), 0.1, block_size = 40, fast_steps = 1)
+    assert keep[0].tolist() == [i%2 == 0 for i in range(40)]
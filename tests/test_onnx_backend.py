@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+from model.fcos import FCOSDetector, DetectHead, ClipBoxes
+from model.config import DefaultConfig
+from model.export import _FlatBody
+from model.onnx_backend import NumpyDetectHead
+
+
+class Config(DefaultConfig):
+    pretrained = False
+
+def _raw_outputs(shape, seed = 0):
+    '''
+    flat [cls_logits*5, cnt_logits*5, reg_preds*5] of a randomly initialised body, as numpy
+    '''
+    torch.manual_seed(seed)
+    detector = FCOSDetector(mode = "inference", config = Config).eval()
+    imgs = torch.randn(*shape)
+    with torch.no_grad():
+        outs = [t.numpy() for t in _FlatBody(detector.fcos_body).eval()(imgs)]
+    return detector, imgs, outs
+
+@pytest.mark.parametrize("shape", [(1, 3, 256, 320), (2, 3, 320, 416)])
+def test_numpy_head_matches_detect_head(shape):
+    _, imgs, outs = _raw_outputs(shape)
+    num_levels = len(Config.strides)
+    # boxes large enough for nms to suppress
+    for i in range(2*num_levels, 3*num_levels):
+        outs[i] = np.abs(outs[i])*100.
+
+    torch_head = DetectHead(Config.score_threshold, Config.nms_iou_threshold, Config.max_detection_boxes_num, Config.strides, Config)
+    with torch.no_grad():
+        ref = list(torch_head([[torch.from_numpy(t.copy()) for t in outs[i*num_levels:(i+1)*num_levels]] for i in range(3)]))
+    ref[2] = ClipBoxes()(imgs, ref[2])
+    head = NumpyDetectHead(Config.strides, Config.score_threshold, Config.nms_iou_threshold,
+                           Config.max_detection_boxes_num, Config.add_centerness)
+    got = head(outs, imgs.shape[2:])
+
+    assert np.array_equal(ref[3].numpy(), got[3])
+    assert int(got[3].sum()) > 0
+    for r, g, n in zip(ref[2].numpy(), got[2], got[3]):
+        assert np.abs(r[:n]-g[:n]).max() < 1e-3
+
+def test_onnx_body_matches_fcos_body(tmp_path):
+    pytest.importorskip("onnxruntime")
+    from model.onnx_backend import export_onnx, OnnxDetector
+
+    detector, _, _ = _raw_outputs((1, 3, 256, 320))
+    path = str(tmp_path / "fcos.onnx")
+    export_onnx(detector, path, example_size = (256, 320))
+    onnx_detector = OnnxDetector(path, Config)
+
+    body = _FlatBody(detector.fcos_body).eval()
+    for shape in [(1, 3, 256, 320), (2, 3, 320, 416)]:
+        imgs = torch.randn(*shape)
+        with torch.no_grad():
+            ref_outs = [t.numpy() for t in body(imgs)]
+        onnx_outs = onnx_detector.session.run(None, {"images": imgs.numpy()})
+        assert max(float(np.abs(a-b).max()) for a, b in zip(ref_outs, onnx_outs)) < 1e-3
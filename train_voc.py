@@ -2,14 +2,19 @@ import pdb
 import torch
 from dataset.VOC_dataset import VOCDataset
 import math, time
-from dataset.augment import Transforms
+from dataset.augment import Transforms, AffineTransforms, seed_worker
 import os
 import numpy as np
 import random
 import torch.backends.cudnn as cudnn
 import argparse
 from model.fcos import FCOSDetector
+from model.config import DefaultConfig
+from model.loss import TargetCollate
+from model.mlfpn import fmap_sizes
 from dataset.VOC_dataset import VOCDataset
+from dataset.sampler import GroupedBatchSampler, aspect_ratio_groups
+from dataset.batch_augment import BatchAugment
 from tensorboardX import SummaryWriter
 writer = SummaryWriter()
 
@@ -18,8 +23,15 @@ parser.add_argument("--epochs", type = int, default = 30, help = "number of epoc
 parser.add_argument("--batch_size", type = int, default = 32, help = "size of each image batch")
 parser.add_argument("--n_cpu", type = int, default = 36, help = "number of cpu threads to use during batch generation")
 parser.add_argument("--n_gpu", type = str, default = '0,1,2,3,4,5,6,7', help = "number of cpu threads to use during batch generation")
+parser.add_argument("--group_batches", action = "store_true", help = "batch images of similar aspect ratio and size together")
+parser.add_argument("--affine_augment", action = "store_true", help = "augment with a single OpenCV affine warp instead of the PIL transforms")
+parser.add_argument("--batch_augment", action = "store_true", help = "jitter, flip and crop whole batches on the gpu instead of per sample in the workers")
+parser.add_argument("--targets_in_workers", action = "store_true", help = "generate FCOS targets in the data loader workers")
+parser.add_argument("--anno_index_dir", type = str, default = None, help = "parse the xml annotations once into a memory-mapped index here, e.g. ./data/cache/VOC2007_anno_index")
 
 opt = parser.parse_args()
+if opt.batch_augment and opt.targets_in_workers:
+    parser.error("--targets_in_workers assigns targets before --batch_augment moves the boxes")
 os.environ["CUDA_VISIBLE_DEVICES"] = opt.n_gpu
 torch.manual_seed(0)
 torch.cuda.manual_seed(0)
@@ -28,13 +40,16 @@ np.random.seed(0)
 cudnn.benchmark = False
 cudnn.deterministic = True
 random.seed(0)
-transform = Transforms()
+transform = AffineTransforms() if opt.affine_augment else Transforms()
 train_dataset = VOCDataset(root_dir = './data/VOCdevkit/VOC2007',
                            resize_size = [800,1333], 
                            split = 'trainval', 
                            use_difficult = False, 
                            is_train = True, 
-                           augment = transform
+                           augment = None if opt.batch_augment else transform,
+                           anno_index_dir = opt.anno_index_dir,
+                           return_img_hw = opt.batch_augment,
+                           random_flip = not opt.batch_augment
                            )
 
 model = FCOSDetector(mode = "training")                                     #.cuda()
@@ -51,13 +66,35 @@ for param in model.parameters():
 
 BATCH_SIZE = opt.batch_size
 EPOCHS = opt.epochs
-train_loader = torch.utils.data.DataLoader(train_dataset, 
-                                           batch_size = BATCH_SIZE, 
-                                           shuffle = True,
-                                           collate_fn = train_dataset.collate_fn,
-                                           num_workers = opt.n_cpu, 
-                                           worker_init_fn = np.random.seed(0)
-                                           )
+collate_fn = train_dataset.collate_fn
+if opt.targets_in_workers:
+    collate_fn = TargetCollate(train_dataset.collate_fn,
+                               DefaultConfig.strides,
+                               DefaultConfig.limit_range,
+                               fmap_sizes
+                               )
+if opt.group_batches:
+    batch_sampler = GroupedBatchSampler(aspect_ratio_groups(train_dataset.padded_sizes()),
+                                        BATCH_SIZE,
+                                        shuffle = True
+                                        )
+    train_loader = torch.utils.data.DataLoader(train_dataset, 
+                                               batch_sampler = batch_sampler,
+                                               collate_fn = collate_fn,
+                                               num_workers = opt.n_cpu, 
+                                               worker_init_fn = seed_worker
+                                               )
+else:
+    train_loader = torch.utils.data.DataLoader(train_dataset, 
+                                               batch_size = BATCH_SIZE, 
+                                               shuffle = True,
+                                               collate_fn = collate_fn,
+                                               num_workers = opt.n_cpu, 
+                                               worker_init_fn = seed_worker
+                                               )
+batch_augment = None
+if opt.batch_augment:
+    batch_augment = BatchAugment(train_dataset.mean, train_dataset.std)
 print("total_images : {}".format(len(train_dataset)))
 steps_per_epoch = len(train_dataset) // BATCH_SIZE
 TOTAL_STEPS = steps_per_epoch * EPOCHS
@@ -79,10 +116,15 @@ for epoch in range(start_epoch,EPOCHS):
     model.train()
     for epoch_step, data in enumerate(train_loader):
 
-        batch_imgs, batch_boxes, batch_classes = data
+        batch_imgs, batch_boxes, batch_classes = data[:3]
         batch_imgs = batch_imgs.cuda()
         batch_boxes = batch_boxes.cuda()
         batch_classes = batch_classes.cuda()
+        if batch_augment is not None:
+            batch_imgs, batch_boxes = batch_augment(batch_imgs, batch_boxes, batch_classes, data[3])
+        inputs = [batch_imgs, batch_boxes, batch_classes]
+        if opt.targets_in_workers:
+            inputs.append([t.cuda(non_blocking = True) for t in data[3]])
         #print("batch img is cuda: ", batch_imgs.is_cuda())
 
         #lr = lr_func()
@@ -101,7 +143,7 @@ for epoch in range(start_epoch,EPOCHS):
         start_time = time.time()
 
         optimizer.zero_grad()
-        losses = model([batch_imgs, batch_boxes, batch_classes])
+        losses = model(inputs)
         
         loss = losses[-1].cuda()
         
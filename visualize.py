@@ -0,0 +1,153 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+
+def class_colors(num_cls):
+    '''
+    returns [num_cls,3] uint8 RGB, evenly spaced hues, index 0 (background) unused
+    '''
+    hsv = np.stack([np.linspace(0, 180, num_cls, endpoint = False),
+                    np.full(num_cls, 200), np.full(num_cls, 230)], axis = -1).astype(np.uint8)
+    return cv2.cvtColor(hsv[None], cv2.COLOR_HSV2RGB)[0]
+
+def _ranges(starts, lengths):
+    '''
+    concatenation of arange(starts[i], starts[i]+lengths[i]) and the index i of every element
+    '''
+    idx = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[idx] + offsets, idx
+
+def draw_boxes(img, boxes, colors, thickness = 2):
+    '''
+    img uint8 [h,w,3] drawn in place, boxes [n,4] (x1,y1,x2,y2) pixels, colors [n,3] uint8
+    the outlines of all boxes are written with one fancy-index assignment per line of thickness,
+    earlier boxes (higher scores) stay on top where outlines overlap
+    '''
+    if len(boxes) == 0:
+        return img
+    h, w = img.shape[:2]
+    boxes = np.round(boxes[::-1]).astype(np.int64)
+    colors = np.asarray(colors)[::-1]
+    x1, x2 = np.clip(boxes[:, 0], 0, w-1), np.clip(boxes[:, 2], 0, w-1)
+    y1, y2 = np.clip(boxes[:, 1], 0, h-1), np.clip(boxes[:, 3], 0, h-1)
+    x2, y2 = np.maximum(x1, x2), np.maximum(y1, y2)
+    for t in range(thickness):
+        xs, idx_x = _ranges(x1, x2 - x1 + 1)
+        ys, idx_y = _ranges(y1, y2 - y1 + 1)
+        rows = np.concatenate([np.clip(y1 + t, 0, h-1)[idx_x], np.clip(y2 - t, 0, h-1)[idx_x], ys, ys])
+        cols = np.concatenate([xs, xs, np.clip(x1 + t, 0, w-1)[idx_y], np.clip(x2 - t, 0, w-1)[idx_y]])
+        idx = np.concatenate([idx_x, idx_x, idx_y, idx_y])
+        # the last write wins, so order the pixels by box
+        order = np.argsort(idx, kind = 'stable')
+        img[rows[order], cols[order]] = colors[idx[order]]
+
+    return img
+
+def draw_detections(img, boxes, classes, scores, class_names, palette, thickness = 2):
+    '''
+    img uint8 RGB [h,w,3] drawn in place, boxes [n,4] in its pixels, classes [n], scores [n]
+    '''
+    colors = palette[classes]
+    draw_boxes(img, boxes, colors, thickness)
+    for box, cls, score, color in zip(boxes.tolist(), classes.tolist(), scores.tolist(), colors.tolist()):
+        text = "%s %.3f"%(class_names[int(cls)], score)
+        (tw, th), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)
+        x, y = int(box[0]), max(int(box[1]), th + baseline)
+        cv2.rectangle(img, (x, y - th - baseline), (x + tw, y), color, -1)
+        cv2.putText(img, text, (x, y - baseline), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+
+    return img
+
+class AsyncRenderer(object):
+    '''
+    Draws InferenceRunner results with OpenCV and writes them to out_dir on a pool of threads,
+    off the inference thread (drawing and jpeg encoding release the GIL). At most max_pending
+    images wait in the pool, submit() blocks beyond that.
+    '''
+    def __init__(self, out_dir, class_names, num_workers = 4, max_pending = 16, thickness = 2):
+        self.out_dir = out_dir
+        self.class_names = class_names
+        self.palette = class_colors(len(class_names))
+        self.thickness = thickness
+        self._pool = ThreadPoolExecutor(num_workers)
+        self._slots = threading.Semaphore(max_pending)
+        self._futures = []
+        os.makedirs(out_dir, exist_ok = True)
+
+    def _render(self, result):
+        try:
+            h, w = result['img_hw']
+            nh, nw = int(result['scale'] * h), int(result['scale'] * w)
+            img = np.ascontiguousarray(result['img'][:nh, :nw])
+            draw_detections(img, result['boxes'], result['classes'], result['scores'],
+                            self.class_names, self.palette, self.thickness)
+            path = os.path.join(self.out_dir, os.path.basename(result['path']))
+            if not cv2.imwrite(path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst = img)):
+                raise IOError("===>can not write image %s"%path)
+        finally:
+            self._slots.release()
+
+    def submit(self, result):
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._render, result))
+
+    def close(self):
+        self._pool.shutdown(wait = True)
+        for future in self._futures:
+            future.result()
+
+class DetectionWriter(object):
+    '''
+    Writes InferenceRunner results without rendering, boxes in original image pixels.
+        .jsonl  one line per image: {"image", "height", "width", "boxes", "scores", "classes", "labels"}
+        .npz    names [num_imgs], img_hw [num_imgs,2], offsets [num_imgs+1] and the concatenated
+                boxes [num_dets,4] float32, scores [num_dets] float32, classes [num_dets] int64,
+                detections of image i are offsets[i]:offsets[i+1]
+    '''
+    def __init__(self, path, class_names):
+        self.path = path
+        self.class_names = class_names
+        self.jsonl = path.endswith('.jsonl')
+        if not self.jsonl and not path.endswith('.npz'):
+            raise ValueError("===>output must be a .jsonl or .npz file, got %s"%path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        if self.jsonl:
+            self._file = open(path, 'w')
+        else:
+            self._arrays = dict(names = [], img_hw = [], boxes = [], scores = [], classes = [])
+
+    def write(self, result):
+        boxes = result['boxes']/result['scale']
+        name = os.path.basename(result['path'])
+        if self.jsonl:
+            classes = result['classes'].tolist()
+            self._file.write(json.dumps(dict(image = name,
+                                             height = int(result['img_hw'][0]),
+                                             width = int(result['img_hw'][1]),
+                                             boxes = np.round(boxes.astype(np.float64), 2).tolist(),
+                                             scores = np.round(result['scores'].astype(np.float64), 4).tolist(),
+                                             classes = classes,
+                                             labels = [self.class_names[c] for c in classes])) + '\n')
+        else:
+            for key, value in zip(['names', 'img_hw', 'boxes', 'scores', 'classes'],
+                                  [name, result['img_hw'], boxes, result['scores'], result['classes']]):
+                self._arrays[key].append(value)
+
+    def close(self):
+        if self.jsonl:
+            self._file.close()
+            return
+        counts = [len(s) for s in self._arrays['scores']]
+        np.savez(self.path,
+                 names = np.array(self._arrays['names']),
+                 img_hw = np.array(self._arrays['img_hw'], dtype = np.int64).reshape(-1, 2),
+                 offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                 boxes = np.concatenate([np.zeros((0, 4))] + self._arrays['boxes']).astype(np.float32),
+                 scores = np.concatenate([np.zeros((0,))] + self._arrays['scores']).astype(np.float32),
+                 classes = np.concatenate([np.zeros((0,), dtype = np.int64)] + self._arrays['classes']).astype(np.int64))